@@ -1,26 +1,53 @@
 from flask import Flask
 from app.config import config, create_config_with_db
 from app.models import db
+from app.schema import check_schema
+from app.shards import create_shard_engines, load_shard_registry
 
 
-def create_app(config_name='default', db_path=None):
+def create_app(config_name='default', db_path=None, shards=None, require_current_schema=True):
+    """Create the app, creating empty databases from the models.
+
+    With ``require_current_schema``, every database must already be at the
+    current schema version; see ``app.schema``.
+    """
     app = Flask(__name__)
     
     config_obj = create_config_with_db(config_name, db_path=db_path)
     app.config.from_object(config_obj)
     
+    if shards is None and app.config.get('SHARDS_FILE'):
+        shards = load_shard_registry(app.config['SHARDS_FILE'])
+    
+    engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    engine_options['connect_args'] = {
+        **engine_options.get('connect_args', {}),
+        'timeout': app.config['DB_BUSY_TIMEOUT']
+    }
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    
     db.init_app(app)
     
     with app.app_context():
-        db.create_all()
+        check_schema(db.engine, require_current_schema)
+    
+    if shards:
+        app.config['SHARDS'] = shards
+        app.extensions['shard_engines'] = create_shard_engines(shards, app.config['DB_BUSY_TIMEOUT'])
+        for engine in app.extensions['shard_engines'].values():
+            check_schema(engine, require_current_schema)
     
     from app.blueprints.students import students_bp
     from app.blueprints.grades import grades_bp
     from app.blueprints.export import export_bp
+    from app.blueprints.district import district_bp
+    from app.blueprints.api import api_bp
     
     app.register_blueprint(students_bp)
     app.register_blueprint(grades_bp)
     app.register_blueprint(export_bp)
+    app.register_blueprint(district_bp)
+    app.register_blueprint(api_bp)
     
     @app.route('/')
     def index():
@@ -0,0 +1,132 @@
+"""Cold storage for the grades of closed terms.
+
+Archived grades live in a separate SQLite file with the same column layout as
+the main database. The file is attached to a connection under the schema name
+``archive`` whenever an archived term has to be read, so rankings, statistics
+and exports run the same queries against ``archive.grades`` that they run
+against ``grades`` for current terms.
+"""
+import os
+from contextlib import contextmanager
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, text
+from app.models import db
+from app.retry import retry_on_lock
+from app.signals import notify_grades_changed
+
+ARCHIVE_SCHEMA = 'archive'
+
+archive_metadata = MetaData(schema=ARCHIVE_SCHEMA)
+
+archived_students = Table(
+    'students', archive_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('email', String(120), nullable=False),
+    Column('created_at', DateTime),
+)
+
+archived_subjects = Table(
+    'subjects', archive_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('key', String(100), nullable=False),
+)
+
+archived_grades = Table(
+    'grades', archive_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('student_id', Integer, nullable=False),
+    Column('subject_id', Integer, nullable=False),
+    Column('term_id', Integer, index=True),
+    Column('score', Float, nullable=False),
+    Column('created_at', DateTime),
+)
+
+
+def default_archive_path():
+    """``students.db`` archives to ``students-archive.db`` next to it."""
+    database = db.session.get_bind().url.database
+    if not database or database == ':memory:':
+        raise ValueError('An archive path is required for in-memory databases.')
+    root, ext = os.path.splitext(database)
+    return f'{root}-archive{ext or ".db"}'
+
+
+@contextmanager
+def _attached(connection, archive_path):
+    # ATTACH is not allowed inside a transaction, so it goes straight to the
+    # driver before SQLAlchemy begins one on this connection.
+    raw = connection.connection.driver_connection
+    raw.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    try:
+        yield connection
+    finally:
+        if connection.in_transaction():
+            connection.rollback()
+        if raw.in_transaction:
+            raw.rollback()
+        raw.execute('DETACH DATABASE archive')
+
+
+@contextmanager
+def archive_connection(archive_path):
+    """Yield a connection with ``archive_path`` attached as ``archive``."""
+    if not os.path.exists(archive_path):
+        raise ValueError(f'Archive file "{archive_path}" does not exist.')
+    with db.session.get_bind().connect() as connection:
+        with _attached(connection, archive_path):
+            yield connection
+
+
+def archive_term(term, archive_path, vacuum=False):
+    """Move every grade of ``term`` into the archive file at ``archive_path``.
+
+    The copy into the archive, the delete from the main database and the
+    update of ``term.archive_path`` commit atomically across both files.
+    Students and subjects referenced by the moved grades are copied too, so
+    the archive can be read on its own. Returns the number of grades moved.
+    """
+    moved = _move_grades(term.id, archive_path)
+    if vacuum:
+        with db.session.get_bind().connect() as connection:
+            connection.connection.driver_connection.execute('VACUUM')
+
+    db.session.expire(term)
+    notify_grades_changed()
+    return moved
+
+
+@retry_on_lock
+def _move_grades(term_id, archive_path):
+    """Copy the grades of ``term_id`` into the archive and delete them here.
+
+    Runs as one transaction on its own connection; returns the number moved.
+    """
+    params = {'term_id': term_id, 'path': archive_path}
+    with db.session.get_bind().connect() as connection:
+        with _attached(connection, archive_path):
+            with connection.begin():
+                archive_metadata.create_all(connection)
+                connection.execute(text(
+                    'INSERT OR REPLACE INTO archive.students (id, name, email, created_at) '
+                    'SELECT id, name, email, created_at FROM main.students WHERE id IN '
+                    '(SELECT student_id FROM main.grades WHERE term_id = :term_id)'
+                ), params)
+                connection.execute(text(
+                    'INSERT OR REPLACE INTO archive.subjects (id, name, key) '
+                    'SELECT id, name, key FROM main.subjects WHERE id IN '
+                    '(SELECT subject_id FROM main.grades WHERE term_id = :term_id)'
+                ), params)
+                moved = connection.execute(text(
+                    'INSERT INTO archive.grades '
+                    '(id, student_id, subject_id, term_id, score, created_at) '
+                    'SELECT id, student_id, subject_id, term_id, score, created_at '
+                    'FROM main.grades WHERE term_id = :term_id'
+                ), params).rowcount
+                connection.execute(text(
+                    'DELETE FROM main.grades WHERE term_id = :term_id'
+                ), params)
+                connection.execute(text(
+                    'UPDATE main.terms SET archive_path = :path WHERE id = :term_id'
+                ), params)
+    return moved
@@ -0,0 +1,267 @@
+"""Online backups and restores of the SQLite database.
+
+Backups use SQLite's backup API instead of copying the file. A copy taken
+while another process writes can tear a page and produce a corrupt file;
+the backup API reads consistent pages and, because it copies
+``BACKUP_PAGES_PER_STEP`` pages at a time and sleeps between steps, only
+holds the read lock briefly so writers keep working. If another
+connection writes during the backup, SQLite restarts the copy so the
+result is always a consistent point-in-time image.
+
+Each backup is written under a temporary name, checked with
+``PRAGMA integrity_check``, optionally gzip-compressed and then renamed into
+place, so a backup file that exists is complete. Backups are named
+``<database>-<UTC timestamp>.db[.gz]`` and the oldest ones beyond the
+retention count are deleted.
+
+A restore validates the backup (integrity, and a schema this version of
+the app can use or upgrade) before copying it over the live database,
+again with the backup API so open connections see the restored data
+rather than a file swapped out from under them.
+
+Every process keeps caches of the database (subject ids, student records,
+leaderboards, analytics snapshots) that a restore makes wrong. The restored
+copy therefore gets a new epoch, a ``PRAGMA user_version`` above both the
+live database's and the backup's, and each process compares it at the
+start of every transaction (see ``app.models``) and drops its caches of
+that database when it changed. Its change log is also replaced by a single
+entry past the live data version, with a gap before it, so the data version
+never goes back and anything built at an older version sees the gap and
+rebuilds.
+"""
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from flask import current_app
+from app.models import db, drop_caches
+from app.schema import SCHEMA_VERSION
+from app.shards import current_shard
+
+TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S%fZ'
+
+
+def database_path():
+    """The file of the database the session is bound to."""
+    database = db.session.get_bind().url.database
+    if not database or database == ':memory:':
+        raise ValueError('In-memory databases cannot be backed up or restored.')
+    return os.path.abspath(database)
+
+
+def default_backup_dir():
+    """``BACKUP_DIR``, or ``students-backups/`` next to ``students.db``."""
+    return current_app.config.get('BACKUP_DIR') or f'{os.path.splitext(database_path())[0]}-backups'
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=current_app.config['DB_BUSY_TIMEOUT'])
+    connection.isolation_level = None
+    return connection
+
+
+def _open_read_only(path):
+    return sqlite3.connect(f'{Path(path).resolve().as_uri()}?mode=ro', uri=True)
+
+
+def _backup_pattern(database):
+    stem = re.escape(os.path.splitext(os.path.basename(database))[0])
+    return re.compile(rf'^{stem}-(\d{{8}}T\d{{12}}Z)\.db(\.gz)?$')
+
+
+def list_backups(backup_dir, database=None):
+    """Backups of ``database`` in ``backup_dir``, newest first, as dicts."""
+    pattern = _backup_pattern(database or database_path())
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in os.listdir(backup_dir):
+        match = pattern.match(name)
+        if match:
+            path = os.path.join(backup_dir, name)
+            backups.append({
+                'path': path,
+                'created_at': datetime.strptime(match.group(1), TIMESTAMP_FORMAT),
+                'compressed': bool(match.group(2)),
+                'size': os.path.getsize(path)
+            })
+    backups.sort(key=lambda backup: backup['created_at'], reverse=True)
+    return backups
+
+
+def check_database_file(path):
+    """Check that ``path`` is an intact database this app can use.
+
+    Returns its schema version; raises ``ValueError`` if the file is not a
+    database, fails ``PRAGMA integrity_check`` or has a newer schema.
+    """
+    connection = _open_read_only(path)
+    try:
+        problems = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+        if problems != ['ok']:
+            raise ValueError(f'"{path}" failed the integrity check: {"; ".join(problems[:5])}')
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'students' not in tables:
+            raise ValueError(f'"{path}" is not a student grades database.')
+        version = 0
+        if 'schema_version' in tables:
+            version = connection.execute('SELECT version FROM schema_version').fetchone()
+            version = version[0] if version else 0
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f'"{path}" is not a valid database: {e}') from e
+    finally:
+        connection.close()
+    if version > SCHEMA_VERSION:
+        raise ValueError(
+            f'"{path}" has schema version {version}, newer than this version of the app '
+            f'supports ({SCHEMA_VERSION}).'
+        )
+    return version
+
+
+def backup_database(backup_dir=None, compress=False, verify=True, keep=None,
+                    pages=None, sleep=None, progress=None):
+    """Back up the database behind the session into ``backup_dir``.
+
+    ``pages`` are copied per step with ``sleep`` seconds between steps
+    (``BACKUP_PAGES_PER_STEP`` and ``BACKUP_STEP_SLEEP`` by default);
+    ``progress(remaining, total)`` is called after each step. With ``keep``,
+    only that many of the newest backups are kept. Returns a dict with the
+    backup ``path``, its ``size``, the ``pages`` copied, the schema
+    ``version`` (when verified) and the ``pruned`` paths.
+    """
+    config = current_app.config
+    source_path = database_path()
+    backup_dir = os.path.abspath(backup_dir or default_backup_dir())
+    os.makedirs(backup_dir, exist_ok=True)
+    pages = pages or config['BACKUP_PAGES_PER_STEP']
+    sleep = config['BACKUP_STEP_SLEEP'] if sleep is None else sleep
+
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    timestamp = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+    path = os.path.join(backup_dir, f'{stem}-{timestamp}.db' + ('.gz' if compress else ''))
+    fd, partial = tempfile.mkstemp(dir=backup_dir, prefix=f'.{stem}-', suffix='.partial')
+    os.close(fd)
+    copied = 0
+    try:
+        source = _connect(source_path)
+        target = sqlite3.connect(partial)
+        try:
+            def step(status, remaining, total):
+                nonlocal copied
+                copied = total
+                if progress is not None:
+                    progress(remaining, total)
+
+            source.backup(target, pages=pages, progress=step, sleep=sleep)
+        finally:
+            target.close()
+            source.close()
+
+        version = check_database_file(partial) if verify else None
+        if compress:
+            compressed = partial + '.gz'
+            with open(partial, 'rb') as f, gzip.open(compressed, 'wb') as out:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+            os.replace(compressed, partial)
+        os.replace(partial, path)
+    except BaseException:
+        for leftover in (partial, partial + '.gz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+
+    pruned = prune_backups(backup_dir, keep, source_path) if keep else []
+    return {'path': path, 'size': os.path.getsize(path), 'pages': copied,
+            'version': version, 'pruned': pruned}
+
+
+def _change_log_version(connection):
+    """``max(id)`` of the change log, or ``None`` for a database without one."""
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_log'").fetchone():
+        return connection.execute('SELECT coalesce(max(id), 0) FROM change_log').fetchone()[0]
+    return None
+
+
+def _advance_epoch(staged, live):
+    """Give the ``staged`` copy a newer epoch and data version than ``live``; returns the epoch."""
+    epoch = max(
+        staged.execute('PRAGMA user_version').fetchone()[0],
+        live.execute('PRAGMA user_version').fetchone()[0]
+    ) + 1
+    staged.execute(f'PRAGMA user_version = {epoch}')
+    version = _change_log_version(staged)
+    if version is not None:
+        # Skip one id past the newest version either database reached, so
+        # changes_since() reports a gap to every reader.
+        version = max(version, _change_log_version(live) or 0) + 2
+        staged.execute('BEGIN')
+        staged.execute('DELETE FROM change_log')
+        staged.execute("INSERT INTO change_log (id, table_name, row_id) VALUES (?, 'restore', 0)", (version,))
+        staged.execute('COMMIT')
+    return epoch
+
+
+def prune_backups(backup_dir, keep, database=None):
+    """Delete all but the ``keep`` newest backups; returns the deleted paths."""
+    pruned = [backup['path'] for backup in list_backups(backup_dir, database)[keep:]]
+    for path in pruned:
+        os.remove(path)
+    return pruned
+
+
+def restore_database(backup_path, verify=True, backup_current=True, backup_dir=None):
+    """Replace the database behind the session with ``backup_path``.
+
+    The backup is copied (and unpacked, if compressed) to a temporary file
+    and checked before anything is overwritten, and with ``backup_current``
+    the database being replaced is backed up (unverified, since a damaged
+    database is often why it is restored) into ``backup_dir``. The copy
+    gets a new epoch (see above) and this process's caches of the database
+    are dropped. Returns a dict with the backup's schema ``version``
+    (``None`` without ``verify``; one below ``SCHEMA_VERSION`` needs the
+    ``upgrade`` command afterwards), the new ``epoch`` and the ``previous``
+    backup path, if any.
+    """
+    if not os.path.isfile(backup_path):
+        raise ValueError(f'Backup file "{backup_path}" does not exist.')
+    target_path = database_path()
+
+    fd, staged = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.restore')
+    try:
+        if backup_path.endswith('.gz'):
+            try:
+                with os.fdopen(fd, 'wb') as out, gzip.open(backup_path, 'rb') as f:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+            except (OSError, EOFError) as e:
+                raise ValueError(f'"{backup_path}" is not a valid compressed backup: {e}') from e
+        else:
+            os.close(fd)
+            shutil.copyfile(backup_path, staged)
+
+        version = check_database_file(staged) if verify else None
+        previous = backup_database(backup_dir, verify=False)['path'] if backup_current else None
+
+        engine = db.session.get_bind()
+        db.session.remove()
+        # Copying into the live file (rather than renaming over it) takes the
+        # write lock, waiting for writers, and other connections pick up the
+        # new pages on their next read.
+        source = _connect(staged)
+        target = _connect(target_path)
+        try:
+            epoch = _advance_epoch(source, target)
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        engine.dispose()
+        drop_caches(current_app._get_current_object(), current_shard())
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+    return {'version': version, 'epoch': epoch, 'previous': previous}
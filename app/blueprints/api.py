@@ -0,0 +1,64 @@
+from flask import Blueprint, jsonify, request
+from app.services import GradeService, StudentService
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+#: Most IDs one lookup request may ask for.
+MAX_LOOKUP_IDS = 10000
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.split(',')
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    raise ValueError('Expected a list or a comma-separated string.')
+
+
+def lookup_arguments():
+    """The ``ids`` and ``fields`` of a lookup, from the query string or a JSON body.
+    
+    Long ID lists can be POSTed as ``{"ids": [...], "fields": [...]}``.
+    """
+    source = request.get_json(silent=True) if request.method == 'POST' else None
+    if source is None:
+        source = request.args
+    elif not isinstance(source, dict):
+        raise ValueError('Expected a JSON object.')
+    tokens = _as_list(source.get('ids')) or []
+    try:
+        ids = [int(token) for token in tokens if token.strip()]
+    except ValueError:
+        raise ValueError('IDs must be integers.') from None
+    if not ids:
+        raise ValueError('No IDs given.')
+    if len(ids) > MAX_LOOKUP_IDS:
+        raise ValueError(f'At most {MAX_LOOKUP_IDS} IDs per request.')
+    return ids, _as_list(source.get('fields'))
+
+
+def lookup_response(name, lookup):
+    try:
+        ids, fields = lookup_arguments()
+        records, missing = lookup(ids, fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({name: records, 'missing': missing})
+
+
+@api_bp.route('/students', methods=['GET', 'POST'])
+def lookup_students():
+    return lookup_response('students', StudentService.lookup_students)
+
+
+@api_bp.route('/grades', methods=['GET', 'POST'])
+def lookup_grades():
+    return lookup_response('grades', GradeService.lookup_grades)
+
+
+@api_bp.route('/cache/students')
+def student_cache_stats():
+    """Hit-rate statistics of this process's student record cache."""
+    return jsonify(StudentService.get_cache().stats())
@@ -0,0 +1,69 @@
+from flask import Blueprint, Response, abort, current_app, flash, g, redirect, render_template, request, session, url_for
+from app.services import DistrictService
+from app.blueprints.students import ranking_filters
+
+district_bp = Blueprint('district', __name__, url_prefix='/district')
+
+
+@district_bp.before_app_request
+def route_to_school():
+    shards = current_app.config.get('SHARDS')
+    if not shards:
+        return
+    school = request.args.get('school') or session.get('school')
+    if school:
+        if school not in shards:
+            abort(404)
+        g.shard = school
+
+
+@district_bp.route('/school/<name>')
+def select_school(name):
+    if name not in (current_app.config.get('SHARDS') or {}):
+        flash('School not found.', 'danger')
+        return redirect(url_for('index'))
+    session['school'] = name
+    flash(f'Switched to {name}.', 'success')
+    return redirect(url_for('students.list_students'))
+
+
+@district_bp.route('/rankings')
+def rankings():
+    if not current_app.config.get('SHARDS'):
+        flash('No schools are configured.', 'danger')
+        return redirect(url_for('students.rankings'))
+    try:
+        filters = {name: value for name, value in ranking_filters().items() if value is not None}
+        rankings = DistrictService.get_rankings(request.args.get('term'), **filters)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('district.rankings'))
+    return render_template('district/rankings.html', rankings=rankings)
+
+
+@district_bp.route('/export/students')
+def export_students():
+    try:
+        csv_data = DistrictService.export_students_to_csv(request.args.get('term'))
+        return Response(
+            csv_data,
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment;filename=district_students.csv'}
+        )
+    except Exception as e:
+        flash(f'Error exporting students: {str(e)}', 'danger')
+        return redirect(url_for('index'))
+
+
+@district_bp.route('/export/grades')
+def export_grades():
+    try:
+        csv_data = DistrictService.export_grades_to_csv(request.args.get('term'))
+        return Response(
+            csv_data,
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment;filename=district_grades.csv'}
+        )
+    except Exception as e:
+        flash(f'Error exporting grades: {str(e)}', 'danger')
+        return redirect(url_for('index'))
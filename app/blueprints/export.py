@@ -1,5 +1,5 @@
-from flask import Blueprint, Response, flash, redirect, url_for
-from app.services import ExportService
+from flask import Blueprint, Response, flash, redirect, request, stream_with_context, url_for
+from app.services import ExportService, TermService
 
 export_bp = Blueprint('export', __name__, url_prefix='/export')
 
@@ -7,7 +7,8 @@ export_bp = Blueprint('export', __name__, url_prefix='/export')
 @export_bp.route('/students')
 def export_students():
     try:
-        csv_data = ExportService.export_students_to_csv()
+        term = TermService.resolve_term(request.args.get('term'))
+        csv_data = ExportService.export_students_to_csv(term=term)
         return Response(
             csv_data,
             mimetype='text/csv',
@@ -21,7 +22,8 @@ def export_students():
 @export_bp.route('/grades')
 def export_grades():
     try:
-        csv_data = ExportService.export_grades_to_csv()
+        term = TermService.resolve_term(request.args.get('term'))
+        csv_data = ExportService.export_grades_to_csv(term=term)
         return Response(
             csv_data,
             mimetype='text/csv',
@@ -30,3 +32,18 @@ def export_grades():
     except Exception as e:
         flash(f'Error exporting grades: {str(e)}', 'danger')
         return redirect(url_for('students.list_students'))
+
+
+@export_bp.route('/pivot')
+def export_pivot():
+    try:
+        term = TermService.resolve_term(request.args.get('term'))
+        headers, rows = ExportService.pivot(term=term, aggregate=request.args.get('aggregate', 'latest'))
+        return Response(
+            stream_with_context(ExportService.iter_csv(headers, rows)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment;filename=pivot.csv'}
+        )
+    except Exception as e:
+        flash(f'Error exporting grade matrix: {str(e)}', 'danger')
+        return redirect(url_for('students.list_students'))
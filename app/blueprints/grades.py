@@ -1,8 +1,11 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_wtf import FlaskForm
-from wtforms import StringField, FloatField, SelectField, SubmitField
-from wtforms.validators import DataRequired, NumberRange
-from app.services import GradeService, StudentService
+from wtforms import StringField, FloatField, SelectField, SubmitField, DateField
+from wtforms.validators import DataRequired, InputRequired, NumberRange, Optional
+from app.services import (
+    GradeService, StudentNotFoundError, StudentService, CurveService, TermService, TrendService
+)
+from app.leaderboard import get_leaderboard
 
 grades_bp = Blueprint('grades', __name__, url_prefix='/grades')
 
@@ -14,20 +17,64 @@ class GradeForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+class CurveForm(FlaskForm):
+    subject = StringField('Subject', validators=[DataRequired()])
+    method = SelectField('Method', choices=[
+        ('add', 'Add points'),
+        ('multiply', 'Multiply by factor'),
+        ('mean', 'Rescale to target mean')
+    ])
+    value = FloatField('Value', validators=[InputRequired()])
+    start = DateField('From', validators=[Optional()])
+    end = DateField('To', validators=[Optional()])
+    preview = SubmitField('Preview')
+    apply = SubmitField('Apply Curve')
+
+
+@grades_bp.route('/curve', methods=['GET', 'POST'])
+def curve():
+    form = CurveForm()
+    preview = None
+    
+    if form.validate_on_submit():
+        dry_run = not form.apply.data
+        try:
+            preview = CurveService.curve(
+                form.subject.data, form.method.data, form.value.data,
+                form.start.data, form.end.data, dry_run=dry_run
+            )
+            if preview['applied']:
+                flash(f'Curve applied to {preview["count"]} grade(s)!', 'success')
+                return redirect(url_for('grades.curve'))
+        except Exception as e:
+            flash(f'Error applying curve: {str(e)}', 'danger')
+    
+    return render_template('grades/curve.html', form=form, preview=preview)
+
+
 @grades_bp.route('/student/<int:student_id>')
 def list_grades(student_id):
-    student = StudentService.get_student_by_id(student_id)
+    student = StudentService.get_student_record(student_id)
     if not student:
         flash('Student not found.', 'danger')
         return redirect(url_for('students.list_students'))
     
     grades = GradeService.get_grades_by_student(student_id)
-    return render_template('grades/list.html', student=student, grades=grades)
+    average = sum(grade.score for grade in grades) / len(grades) if grades else 0.0
+    term = TermService.get_current_term()
+    board = get_leaderboard(term)
+    window = request.args.get('window', TrendService.WINDOW, type=int)
+    window = window if window and window > 0 else TrendService.WINDOW
+    return render_template('grades/list.html', student=student, grades=grades, average=average, term=term,
+                           rank=board.rank_of(student_id), ranked=len(board),
+                           trends=TrendService.get_grade_trends(student_id, window=window),
+                           trend=TrendService.get_student_trend(student_id), window=window,
+                           slope_days=TrendService.SLOPE_DAYS)
 
 
 @grades_bp.route('/student/<int:student_id>/add', methods=['GET', 'POST'])
 def add_grade(student_id):
-    student = StudentService.get_student_by_id(student_id)
+    student = StudentService.get_student_record(student_id)
     if not student:
         flash('Student not found.', 'danger')
         return redirect(url_for('students.list_students'))
@@ -41,6 +88,9 @@ def add_grade(student_id):
             GradeService.create_grade(student_id, form.subject.data, form.score.data)
             flash('Grade added successfully!', 'success')
             return redirect(url_for('grades.list_grades', student_id=student_id))
+        except StudentNotFoundError:
+            flash('Student not found.', 'danger')
+            return redirect(url_for('students.list_students'))
         except Exception as e:
             flash(f'Error adding grade: {str(e)}', 'danger')
     
@@ -49,7 +99,7 @@ def add_grade(student_id):
 
 @grades_bp.route('/<int:grade_id>/edit', methods=['GET', 'POST'])
 def edit_grade(grade_id):
-    grade = GradeService.get_grade_by_id(grade_id)
+    grade = GradeService.get_grade_by_id(grade_id, student='joined')
     if not grade:
         flash('Grade not found.', 'danger')
         return redirect(url_for('students.list_students'))
@@ -1,31 +1,25 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField
-from wtforms.validators import DataRequired, Email, ValidationError
-from app.services import StudentService
-from app.models import Student
+from wtforms.validators import DataRequired, Email
+from app.services import DuplicateEmailError, StudentService, TermService, TrendService
+from app.leaderboard import RankedStudent, get_leaderboard, with_students
+from app.live import get_feed, stream_rankings
 
 students_bp = Blueprint('students', __name__, url_prefix='/students')
 
+RANKINGS_PER_PAGE = 50
+
 
 class StudentForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     email = StringField('Email', validators=[DataRequired(), Email()])
     submit = SubmitField('Submit')
-    
-    def __init__(self, student_id=None, *args, **kwargs):
-        super(StudentForm, self).__init__(*args, **kwargs)
-        self.student_id = student_id
-    
-    def validate_email(self, field):
-        existing = Student.query.filter_by(email=field.data).first()
-        if existing and (self.student_id is None or existing.id != self.student_id):
-            raise ValidationError('Email already registered.')
 
 
 @students_bp.route('/')
 def list_students():
-    students = StudentService.get_all_students()
+    students = StudentService.get_all_students(grades='selectin')
     return render_template('students/list.html', students=students)
 
 
@@ -37,6 +31,8 @@ def create_student():
             StudentService.create_student(form.name.data, form.email.data)
             flash('Student created successfully!', 'success')
             return redirect(url_for('students.list_students'))
+        except DuplicateEmailError:
+            form.email.errors.append('Email already registered.')
         except Exception as e:
             flash(f'Error creating student: {str(e)}', 'danger')
     return render_template('students/create.html', form=form)
@@ -49,12 +45,14 @@ def edit_student(student_id):
         flash('Student not found.', 'danger')
         return redirect(url_for('students.list_students'))
     
-    form = StudentForm(student_id=student_id, obj=student)
+    form = StudentForm(obj=student)
     if form.validate_on_submit():
         try:
             StudentService.update_student(student_id, form.name.data, form.email.data)
             flash('Student updated successfully!', 'success')
             return redirect(url_for('students.list_students'))
+        except DuplicateEmailError:
+            form.email.errors.append('Email already registered.')
         except Exception as e:
             flash(f'Error updating student: {str(e)}', 'danger')
     
@@ -70,7 +68,97 @@ def delete_student(student_id):
     return redirect(url_for('students.list_students'))
 
 
+@students_bp.route('/bulk-delete', methods=['POST'])
+def bulk_delete_students():
+    student_ids = request.form.getlist('student_ids', type=int)
+    if not student_ids:
+        flash('No students selected.', 'warning')
+        return redirect(url_for('students.list_students'))
+    
+    try:
+        counts = StudentService.bulk_delete_students(student_ids)
+        flash(f'Deleted {counts["students"]} student(s) and {counts["grades"]} grade(s).', 'success')
+    except Exception as e:
+        flash(f'Error deleting students: {str(e)}', 'danger')
+    return redirect(url_for('students.list_students'))
+
+
+def ranking_filters():
+    """The ``subject``, ``min_grades`` and ``limit`` query-string filters."""
+    min_grades = request.args.get('min_grades', type=int)
+    limit = request.args.get('limit', type=int)
+    return {
+        'subject': request.args.get('subject') or None,
+        'min_grades': min_grades if min_grades and min_grades > 1 else None,
+        'limit': limit if limit and limit > 0 else None
+    }
+
+
 @students_bp.route('/rankings')
 def rankings():
-    rankings = StudentService.get_rankings()
-    return render_template('students/rankings.html', rankings=rankings)
+    try:
+        term = TermService.resolve_term(request.args.get('term'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('students.rankings'))
+    
+    filters = ranking_filters()
+    terms = TermService.get_all_terms()
+    if any(value is not None for value in filters.values()):
+        # Filtered and top-K views come straight from SQL; the leaderboard
+        # only covers the unfiltered order.
+        rows = StudentService.get_rankings(term=term, **{
+            name: value for name, value in filters.items() if value is not None
+        })
+        rankings = [
+            (RankedStudent(rank, item['student'].id, item['average'], item['count']), item['student'])
+            for rank, item in enumerate(rows, 1)
+        ]
+        return render_template('students/rankings.html', rankings=rankings, term=term, terms=terms,
+                               page=1, pages=1, total=None, filters=filters)
+    
+    live_version = get_feed(term).ensure_started(term)
+    board = get_leaderboard(term)
+    pages = max(1, -(-len(board) // RANKINGS_PER_PAGE))
+    page = min(request.args.get('page', 1, type=int) or 1, pages)
+    rankings = with_students(board.page(max(page, 1), RANKINGS_PER_PAGE))
+    return render_template('students/rankings.html', rankings=rankings, term=term, terms=terms,
+                           page=max(page, 1), pages=pages, total=len(board), filters=filters,
+                           live_version=live_version, per_page=RANKINGS_PER_PAGE)
+
+
+@students_bp.route('/rankings/live')
+def rankings_live():
+    """Server-Sent Events with the ranking changes after version ``since``."""
+    try:
+        term = TermService.resolve_term(request.args.get('term'))
+    except ValueError as e:
+        return Response(str(e), status=404, mimetype='text/plain')
+    
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    return Response(
+        stream_with_context(stream_rankings(term, since)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@students_bp.route('/at-risk')
+def at_risk():
+    try:
+        term = TermService.resolve_term(request.args.get('term'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('students.at_risk'))
+    
+    thresholds = {
+        'max_average': request.args.get('max_average', TrendService.AT_RISK_AVERAGE, type=float),
+        'max_slope': request.args.get('max_slope', TrendService.AT_RISK_SLOPE, type=float),
+        'min_grades': request.args.get('min_grades', TrendService.AT_RISK_MIN_GRADES, type=int),
+    }
+    report = TrendService.get_at_risk(term=term, **thresholds)
+    return render_template('students/at_risk.html', report=report, term=term,
+                           terms=TermService.get_all_terms(), thresholds=thresholds,
+                           slope_days=TrendService.SLOPE_DAYS)
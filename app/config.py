@@ -8,6 +8,26 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     WTF_CSRF_ENABLED = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or f'sqlite:///{BASE_DIR}/students.db'
+    SHARDS_FILE = os.environ.get('SHARDS_FILE')
+    DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5))
+    DB_RETRY_ATTEMPTS = int(os.environ.get('DB_RETRY_ATTEMPTS', 8))
+    DB_RETRY_BASE_DELAY = float(os.environ.get('DB_RETRY_BASE_DELAY', 0.01))
+    DB_RETRY_MAX_DELAY = float(os.environ.get('DB_RETRY_MAX_DELAY', 0.5))
+    ANALYTICS_SNAPSHOT = os.environ.get('ANALYTICS_SNAPSHOT', '').lower() in ('1', 'true', 'yes')
+    SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE')
+    LIVE_RANKINGS_POLL_INTERVAL = float(os.environ.get('LIVE_RANKINGS_POLL_INTERVAL', 2))
+    LIVE_RANKINGS_STREAM_SECONDS = float(os.environ.get('LIVE_RANKINGS_STREAM_SECONDS', 300))
+    STUDENT_CACHE_SIZE = int(os.environ.get('STUDENT_CACHE_SIZE', 10000))
+    RAISE_ON_LAZY_LOAD = os.environ.get('RAISE_ON_LAZY_LOAD', '').lower() in ('1', 'true', 'yes')
+    GRADE_GROUP_COMMIT = os.environ.get('GRADE_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+    GRADE_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GRADE_GROUP_COMMIT_MAX_BATCH', 64))
+    GRADE_GROUP_COMMIT_MAX_DELAY_MS = float(os.environ.get('GRADE_GROUP_COMMIT_MAX_DELAY_MS', 5))
+    GRADE_GROUP_COMMIT_QUEUE_SIZE = int(os.environ.get('GRADE_GROUP_COMMIT_QUEUE_SIZE', 1024))
+    GRADE_GROUP_COMMIT_TIMEOUT = float(os.environ.get('GRADE_GROUP_COMMIT_TIMEOUT', 30))
+    BACKUP_DIR = os.environ.get('BACKUP_DIR')
+    BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 1024))
+    BACKUP_STEP_SLEEP = float(os.environ.get('BACKUP_STEP_SLEEP', 0.01))
 
 
 class DevelopmentConfig(Config):
@@ -19,6 +39,9 @@ class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SHARDS_FILE = None
+    SNAPSHOT_FILE = None
+    RAISE_ON_LAZY_LOAD = True
 
 
 class ProductionConfig(Config):
@@ -0,0 +1,257 @@
+"""Group commit for grade inserts.
+
+With group commit enabled, ``GradeService.create_grade`` hands the new grade
+to a single writer thread instead of committing it itself. The writer drains
+the queue for a few milliseconds (or until a batch is full) and commits
+everything it collected in one transaction, so a burst of concurrent writers
+pays for one fsync instead of one each. Every row is inserted inside its own
+savepoint, which lets one bad row fail on its own while the rest of the batch
+commits; every caller waits on a ``Future`` for its own result. A batch that
+loses the write lock is rolled back and retried whole, with the backoff and
+counters of ``retry_on_lock``; its futures fail only once retries run out.
+"""
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from flask import current_app, g
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from app.models import db, Grade, immediate_transaction
+from app.retry import backoff_delay, is_lock_error, retry_stats
+from app.shards import current_shard
+from app.signals import notify_grades_changed
+
+
+class GroupCommitMetrics:
+    """Batch sizes and enqueue-to-commit latencies of the writer."""
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.batches = 0
+        self.rows = 0
+        self.failures = 0
+        self.max_batch_size = 0
+
+    def record_batch(self, size, failures, latencies):
+        with self._lock:
+            self.batches += 1
+            self.rows += size
+            self.failures += failures
+            self.max_batch_size = max(self.max_batch_size, size)
+            self._latencies.extend(latencies)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                'batches': self.batches,
+                'rows': self.rows,
+                'failures': self.failures,
+                'mean_batch_size': self.rows / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_batch_size,
+            }
+        for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            result[f'latency_{name}_ms'] = (
+                latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+                if latencies else 0.0
+            )
+        result['latency_mean_ms'] = statistics.fmean(latencies) * 1000 if latencies else 0.0
+        return result
+
+
+class _PendingGrade:
+    __slots__ = ('values', 'shard', 'future', 'enqueued_at')
+
+    def __init__(self, values, shard):
+        self.values = values
+        self.shard = shard
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class GroupCommitWriter:
+    """Owns the queue and the writer thread for one app."""
+
+    def __init__(self, app, max_batch=64, max_delay=0.005, queue_size=1024):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.metrics = GroupCommitMetrics()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_batch_size = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='grade-group-commit', daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, student_id, subject, score, term_id=None, timeout=None):
+        """Queue a grade insert and return a ``Future`` for its grade id.
+
+        Blocks for up to ``timeout`` seconds while the queue is full, then
+        raises ``RuntimeError``.
+        """
+        self._ensure_started()
+        pending = _PendingGrade(
+            {'student_id': student_id, 'subject': subject, 'score': score, 'term_id': term_id},
+            current_shard()
+        )
+        try:
+            self._queue.put(pending, timeout=timeout)
+        except queue.Full:
+            raise RuntimeError('The grade write queue is full; try again shortly.') from None
+        return pending.future
+
+    def stop(self):
+        """Flush what is queued and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _collect(self, first):
+        # A lone writer should not pay the batching delay, so the writer only
+        # waits for more rows when the previous batch shows there is company.
+        batch = [first]
+        deadline = time.perf_counter() + (self.max_delay if self._last_batch_size > 1 else 0)
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            by_shard = {}
+            for item in batch:
+                by_shard.setdefault(item.shard, []).append(item)
+            for shard, items in by_shard.items():
+                try:
+                    with self.app.app_context():
+                        g.shard = shard
+                        self._write_with_retry(items)
+                except Exception as e:
+                    for item in items:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+
+    def _write_with_retry(self, items):
+        config = self.app.config
+        name = f'{type(self).__qualname__}._write'
+        retries = 0
+        while True:
+            try:
+                with immediate_transaction():
+                    results = self._write(items)
+            except OperationalError as e:
+                db.session.rollback()
+                if not is_lock_error(e):
+                    raise
+                if retries + 1 >= config['DB_RETRY_ATTEMPTS']:
+                    retry_stats.record(name, retries, failed=True)
+                    raise
+                time.sleep(backoff_delay(retries, config['DB_RETRY_BASE_DELAY'], config['DB_RETRY_MAX_DELAY']))
+                retries += 1
+            else:
+                retry_stats.record(name, retries, failed=False)
+                self._finish(items, results)
+                return
+
+    def _write(self, items):
+        """Insert ``items`` in one transaction; lock errors abort the whole batch."""
+        from app.services import SubjectService
+
+        # Begin (BEGIN IMMEDIATE) outside the per-row savepoints, so waiting
+        # too long for the write lock fails the batch rather than each row.
+        db.session.connection()
+        results = []
+        for item in items:
+            known_keys = set(db.session.info.get('new_subject_keys', ()))
+            try:
+                with db.session.begin_nested():
+                    values = dict(item.values)
+                    values['subject_id'] = SubjectService.resolve_id(values.pop('subject'))
+                    grade_id = db.session.execute(
+                        insert(Grade.__table__).values(**values)
+                    ).inserted_primary_key[0]
+                results.append((item, grade_id, None))
+            except Exception as e:
+                if is_lock_error(e):
+                    raise
+                # Subjects interned by the failed row were rolled back with it.
+                cache = SubjectService.get_cache()
+                for key in set(db.session.info.get('new_subject_keys', ())) - known_keys:
+                    cache.discard(key)
+                    db.session.info['new_subject_keys'].discard(key)
+                results.append((item, None, e))
+
+        try:
+            db.session.commit()
+        except Exception as e:
+            if is_lock_error(e):
+                raise
+            db.session.rollback()
+            results = [(item, None, error or e) for item, _, error in results]
+        return results
+
+    def _finish(self, items, results):
+        finished = time.perf_counter()
+        failures = 0
+        for item, grade_id, error in results:
+            if error is None:
+                item.future.set_result(grade_id)
+            else:
+                failures += 1
+                item.future.set_exception(error)
+        self.metrics.record_batch(
+            len(items), failures, [finished - item.enqueued_at for item in items]
+        )
+
+        student_ids = {item.values['student_id'] for item, _, error in results if error is None}
+        if student_ids:
+            notify_grades_changed(student_ids)
+
+
+_create_lock = threading.Lock()
+
+
+def get_group_writer():
+    """The app's group-commit writer, created on first use."""
+    app = current_app._get_current_object()
+    writer = app.extensions.get('group_commit')
+    if writer is None:
+        with _create_lock:
+            writer = app.extensions.get('group_commit')
+            if writer is None:
+                writer = GroupCommitWriter(
+                    app,
+                    max_batch=app.config['GRADE_GROUP_COMMIT_MAX_BATCH'],
+                    max_delay=app.config['GRADE_GROUP_COMMIT_MAX_DELAY_MS'] / 1000,
+                    queue_size=app.config['GRADE_GROUP_COMMIT_QUEUE_SIZE'],
+                )
+                app.extensions['group_commit'] = writer
+    return writer
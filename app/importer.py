@@ -0,0 +1,372 @@
+"""Bulk CSV imports of students and grades as a staged pipeline.
+
+Rows flow through three stages connected by bounded queues, so only a few
+chunks are in memory however large the file is:
+
+* **parse** (a thread) reads the CSV and groups rows into chunks;
+* **validate** (a thread feeding a process pool) checks each chunk in a
+  worker process, where email validation and score parsing do not compete
+  for the GIL, and passes the results on in file order;
+* **insert** (the calling thread, which owns the app context and the only
+  database connection) writes each chunk with one bulk ``INSERT`` in its
+  own transaction, retried if it loses the write lock to another writer.
+
+Each stage reports the rows it handled, the seconds it spent working and
+its throughput, which shows which stage bounds the import.
+"""
+import csv
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from email_validator import EmailNotValidError, validate_email
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app.models import db, Grade, Student, normalize_email, normalize_subject_name
+from app.retry import retry_on_lock
+from app.services import MAX_IN_CHUNK, RosterService, SubjectService, TermService
+from app.signals import notify_grades_changed
+
+#: Invalid rows kept in the result for reporting; the rest are only counted.
+MAX_REPORTED_INVALID = 100
+
+_DONE = object()
+
+
+class StageStats:
+    """Rows handled and seconds spent by one pipeline stage."""
+
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, rows, seconds):
+        self.rows += rows
+        self.seconds += seconds
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'seconds': self.seconds,
+            'rate': self.rows / self.seconds if self.seconds else 0.0
+        }
+
+
+def read_grade_rows(f):
+    """Yield ``(line, student, subject, score, term)`` from a grades CSV.
+
+    Students are identified by a ``student_id`` or an ``email`` column; the
+    ``term`` column is optional.
+    """
+    reader = csv.DictReader(f)
+    fields = {(field or '').strip().lower(): field for field in reader.fieldnames or []}
+    if 'subject' not in fields or 'score' not in fields or not ('student_id' in fields or 'email' in fields):
+        raise ValueError('Grades CSV must have "student_id" (or "email"), "subject" and "score" columns.')
+    student_field = fields.get('student_id') or fields['email']
+
+    def value(row, name):
+        return (row[fields[name]] or '') if name in fields else ''
+
+    for row in reader:
+        yield (reader.line_num, row[student_field] or '', value(row, 'subject'),
+               value(row, 'score'), value(row, 'term'))
+
+
+def validate_students(chunk):
+    """Check names and email syntax; runs in a worker process."""
+    valid, invalid = [], []
+    for line, name, email in chunk:
+        name = name.strip()
+        if not name:
+            invalid.append({'line': line, 'value': email, 'reason': 'missing name'})
+            continue
+        try:
+            validate_email(email, check_deliverability=False)
+        except EmailNotValidError as e:
+            invalid.append({'line': line, 'value': email, 'reason': str(e)})
+            continue
+        valid.append({'line': line, 'name': name, 'email': normalize_email(email)})
+    return valid, invalid
+
+
+def validate_grades(chunk):
+    """Check student references, subjects and scores; runs in a worker process."""
+    valid, invalid = [], []
+    for line, student, subject, score, term in chunk:
+        student = student.strip()
+        subject = normalize_subject_name(subject)
+        if not student:
+            invalid.append({'line': line, 'value': student, 'reason': 'missing student'})
+            continue
+        if not subject:
+            invalid.append({'line': line, 'value': student, 'reason': 'missing subject'})
+            continue
+        try:
+            score = float(score)
+        except ValueError:
+            invalid.append({'line': line, 'value': score, 'reason': 'score is not a number'})
+            continue
+        if not 0 <= score <= 100:
+            invalid.append({'line': line, 'value': score, 'reason': 'score must be between 0 and 100'})
+            continue
+        if student.isdigit():
+            student = int(student)
+        else:
+            try:
+                validate_email(student, check_deliverability=False)
+            except EmailNotValidError as e:
+                invalid.append({'line': line, 'value': student, 'reason': str(e)})
+                continue
+            student = normalize_email(student)
+        valid.append({'line': line, 'student': student, 'subject': subject, 'score': score,
+                      'term': term.strip()})
+    return valid, invalid
+
+
+def _timed_validate(validate, chunk):
+    started = time.perf_counter()
+    valid, invalid = validate(chunk)
+    return valid, invalid, len(chunk), time.perf_counter() - started
+
+
+def run_pipeline(rows, validate, write, workers=1, chunk_size=1000, queue_size=4):
+    """Stream ``rows`` through parse, ``validate`` and ``write`` stages.
+
+    ``validate(chunk)`` must be a picklable module-level function returning
+    ``(valid_rows, invalid_rows)``; it runs in ``workers`` processes (inline
+    with one). ``write(valid_rows)`` runs in the calling thread, in file
+    order, and returns ``(written, problems)`` where ``problems`` are more
+    invalid rows. Returns ``{'written', 'invalid', 'invalid_rows',
+    'stages', 'seconds'}``.
+    """
+    stages = {name: StageStats() for name in ('parse', 'validate', 'insert')}
+    parsed = queue.Queue(maxsize=queue_size)
+    validated = queue.Queue(maxsize=queue_size)
+    cancelled = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not cancelled.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not cancelled.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def run_stage(target):
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                errors.append(e)
+                cancelled.set()
+        return threading.Thread(target=run, daemon=True)
+
+    def parse():
+        iterator = iter(rows)
+        while True:
+            started = time.perf_counter()
+            chunk = []
+            for row in iterator:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    break
+            stages['parse'].add(len(chunk), time.perf_counter() - started)
+            if not chunk:
+                break
+            if not put(parsed, chunk):
+                return
+        put(parsed, _DONE)
+
+    def dispatch():
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        pending = deque()
+
+        def forward(result):
+            valid, invalid, count, seconds = result
+            stages['validate'].add(count, seconds)
+            return put(validated, (valid, invalid))
+
+        try:
+            while True:
+                chunk = get(parsed)
+                if chunk is _DONE:
+                    break
+                if pool is None:
+                    if not forward(_timed_validate(validate, chunk)):
+                        return
+                    continue
+                pending.append(pool.submit(_timed_validate, validate, chunk))
+                # Keep every worker busy, but hand results on in file order.
+                while len(pending) > workers * 2 or (pending and pending[0].done()):
+                    if not forward(pending.popleft().result()):
+                        return
+            while pending:
+                if not forward(pending.popleft().result()):
+                    return
+            put(validated, _DONE)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    started = time.perf_counter()
+    threads = [run_stage(parse), run_stage(dispatch)]
+    for thread in threads:
+        thread.start()
+
+    written = invalid_count = 0
+    invalid_rows = []
+
+    def report(problems):
+        nonlocal invalid_count
+        invalid_count += len(problems)
+        invalid_rows.extend(problems[:MAX_REPORTED_INVALID - len(invalid_rows)])
+
+    try:
+        while True:
+            item = get(validated)
+            if item is _DONE:
+                break
+            valid, invalid = item
+            report(invalid)
+            if valid:
+                write_started = time.perf_counter()
+                count, problems = write(valid)
+                stages['insert'].add(len(valid), time.perf_counter() - write_started)
+                written += count
+                report(problems)
+    except BaseException:
+        cancelled.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+    invalid_rows.sort(key=lambda row: row['line'])
+    return {
+        'written': written,
+        'invalid': invalid_count,
+        'invalid_rows': invalid_rows,
+        'stages': {name: stats.as_dict() for name, stats in stages.items()},
+        'seconds': time.perf_counter() - started
+    }
+
+
+@retry_on_lock
+def _commit_chunk(stmt, rows):
+    try:
+        result = db.session.connection().execute(stmt, rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount
+
+
+def import_students(f, workers=1, chunk_size=1000, queue_size=4):
+    """Import students from a CSV with name and email columns.
+
+    Addresses that are already registered (or repeated in the file) are
+    skipped and counted as ``duplicates``.
+    """
+    stmt = sqlite_insert(Student).on_conflict_do_nothing(index_elements=[Student.email])
+    now = datetime.utcnow()
+    duplicates = 0
+
+    def write(rows):
+        nonlocal duplicates
+        inserted = _commit_chunk(stmt, [
+            {'name': row['name'], 'email': row['email'], 'created_at': now} for row in rows
+        ])
+        duplicates += len(rows) - inserted
+        return inserted, []
+
+    result = run_pipeline(RosterService.read_roster(f), validate_students, write, workers, chunk_size, queue_size)
+    result['duplicates'] = duplicates
+    return result
+
+
+def import_grades(f, workers=1, chunk_size=1000, queue_size=4):
+    """Import grades from a CSV with student_id (or email), subject, score and term columns.
+
+    Grades without a term go to the current term. Rows naming an unknown
+    student or term, or an archived term, are reported as invalid.
+    """
+    current_term = TermService.get_current_term()
+    terms = {}
+    touched = set()
+    now = datetime.utcnow()
+
+    def resolve_term(name):
+        if not name:
+            return current_term
+        if name not in terms:
+            terms[name] = TermService.get_term_by_name(name)
+        return terms[name]
+
+    # The student lookups, the subjects interned for the chunk and its insert
+    # are one transaction, so the whole chunk is retried on lock errors.
+    @retry_on_lock
+    def write(rows):
+        emails = {row['student'] for row in rows if isinstance(row['student'], str)}
+        numbers = {row['student'] for row in rows if isinstance(row['student'], int)}
+        by_email, known_ids = {}, set()
+        for start in range(0, len(emails), MAX_IN_CHUNK):
+            chunk = sorted(emails)[start:start + MAX_IN_CHUNK]
+            by_email.update(db.session.execute(
+                select(Student.email, Student.id).where(Student.email.in_(chunk))
+            ).all())
+        for start in range(0, len(numbers), MAX_IN_CHUNK):
+            chunk = sorted(numbers)[start:start + MAX_IN_CHUNK]
+            known_ids.update(db.session.scalars(select(Student.id).where(Student.id.in_(chunk))))
+
+        inserts, problems = [], []
+        for row in rows:
+            student = row['student']
+            student_id = by_email.get(student) if isinstance(student, str) else (
+                student if student in known_ids else None
+            )
+            if student_id is None:
+                problems.append({'line': row['line'], 'value': student, 'reason': 'unknown student'})
+                continue
+            term = resolve_term(row['term'])
+            if row['term'] and term is None:
+                problems.append({'line': row['line'], 'value': row['term'], 'reason': 'unknown term'})
+                continue
+            if term is not None and term.is_archived:
+                problems.append({'line': row['line'], 'value': term.name, 'reason': 'term is archived'})
+                continue
+            inserts.append({
+                'student_id': student_id,
+                'subject_id': SubjectService.resolve_id(row['subject']),
+                'term_id': term.id if term is not None else None,
+                'score': row['score'],
+                'created_at': now
+            })
+        if inserts:
+            _commit_chunk(insert(Grade), inserts)
+            touched.update(row['student_id'] for row in inserts)
+        else:
+            # Commit subjects interned for rows that turned out to be invalid.
+            db.session.commit()
+        return len(inserts), problems
+
+    try:
+        result = run_pipeline(read_grade_rows(f), validate_grades, write, workers, chunk_size, queue_size)
+    finally:
+        if touched:
+            notify_grades_changed(touched)
+    return result
@@ -0,0 +1,195 @@
+"""In-memory leaderboards for rank lookups in logarithmic time.
+
+A leaderboard holds every ranked student of one term (or of all terms) in a
+``SortedList`` ordered the same way as ``StudentService.get_rankings``: by
+average descending, then by student id. It is built from the database the
+first time it is asked for and remembers the data version (see
+``app.snapshot``) it reflects.
+
+Every lookup compares that version with the database's. When it has moved,
+whoever wrote (this process, another web worker, the CLI), the board reads
+the change log since its version and re-aggregates and repositions only the
+students whose grades changed; if the log no longer reaches back that far or
+too many students changed, it is rebuilt. ``grades_changed`` runs the same
+catch-up right after a write in this process, and a change that may touch
+anyone drops the board so the next request rebuilds it.
+
+No database work happens under a process-wide lock: a thread waiting for
+one while its own read transaction is open would keep a committing writer
+waiting too, and readers queued behind that writer would wait on the lock
+holder. Builds and catch-ups run concurrently instead, each tagged with its
+version, and only move a board forward.
+
+Boards only hold ids, averages and grade counts; names and emails are read
+for the rows actually shown, so renaming a student needs no invalidation.
+"""
+import threading
+from collections import namedtuple
+from flask import current_app
+from sortedcontainers import SortedList
+from sqlalchemy.exc import OperationalError
+from app.models import db, Student, Term
+from app.shards import current_shard
+from app.signals import grades_changed, rankings_changed
+from app.snapshot import changes_since, data_version
+
+RankedStudent = namedtuple('RankedStudent', ['rank', 'student_id', 'average', 'count'])
+
+#: Changed students above which a board is rebuilt rather than caught up.
+MAX_CATCH_UP_STUDENTS = 5000
+
+
+class Leaderboard:
+    """Order-statistic view of the rankings of one term."""
+
+    def __init__(self, rankings, version):
+        self._lock = threading.Lock()
+        self.version = version
+        self._order = SortedList()
+        self._entries = {}
+        for item in rankings:
+            self._put(item['student'].id, item['average'], item['count'])
+
+    def __len__(self):
+        return len(self._order)
+
+    def _put(self, student_id, average, count):
+        key = (-average, student_id)
+        self._order.add(key)
+        self._entries[student_id] = (key, count)
+
+    def _remove(self, student_id):
+        entry = self._entries.pop(student_id, None)
+        if entry is not None:
+            self._order.remove(entry[0])
+
+    def update(self, student_ids, rankings, version):
+        """Replace the entries of ``student_ids`` with fresh ``rankings`` rows.
+
+        Students in ``student_ids`` without a row have no ranked grades left
+        and are removed. The rows were read at data ``version``; an update
+        older than the board is ignored.
+        """
+        with self._lock:
+            if version <= self.version:
+                return
+            self.version = version
+            for student_id in student_ids:
+                self._remove(student_id)
+            for item in rankings:
+                self._put(item['student'].id, item['average'], item['count'])
+
+    def _ranked(self, position, key):
+        average, student_id = -key[0], key[1]
+        return RankedStudent(position + 1, student_id, average, self._entries[student_id][1])
+
+    def rank_of(self, student_id):
+        """The ``RankedStudent`` for ``student_id``, or ``None`` if unranked."""
+        with self._lock:
+            entry = self._entries.get(student_id)
+            if entry is None:
+                return None
+            return self._ranked(self._order.index(entry[0]), entry[0])
+
+    def top(self, k):
+        return self.slice(0, k)
+
+    def page(self, page, per_page):
+        """The ``page``-th (1-based) run of ``per_page`` ranked students."""
+        return self.slice((page - 1) * per_page, per_page)
+
+    def slice(self, offset, limit):
+        with self._lock:
+            keys = list(self._order.islice(offset, offset + limit))
+            return [self._ranked(offset + i, key) for i, key in enumerate(keys)]
+
+
+_install_lock = threading.Lock()
+
+
+def _boards(app):
+    return app.extensions.setdefault('leaderboards', {})
+
+
+def get_leaderboard(term=None):
+    """The leaderboard of ``term`` (all terms if ``None``) for the routed school."""
+    from app.services import StudentService
+
+    app = current_app._get_current_object()
+    key = (current_shard(), term.id if term is not None else None)
+    # Read in the same transaction as the rankings below, so the version
+    # stored with a rebuilt board is exactly the one it reflects.
+    version = data_version(db.session.connection())
+    board = _boards(app).get(key)
+    if board is not None and board.version < version and not _catch_up(board, term, version):
+        board = None
+    if board is None:
+        board = Leaderboard(StudentService.get_rankings(term=term), version)
+        with _install_lock:
+            current = _boards(app).get(key)
+            if current is None or current.version < version:
+                _boards(app)[key] = board
+    return board
+
+
+def _catch_up(board, term, version, student_ids=()):
+    """Bring ``board`` to ``version`` from the change log; ``False`` if it must be rebuilt.
+
+    ``student_ids`` are re-ranked as well, whatever the log says.
+    """
+    from app.services import StudentService
+
+    if board.version >= version:
+        return True
+    changes = changes_since(db.session.connection(), board.version, version)
+    if changes is None:
+        return False
+    changed = set(student_ids)
+    changed.update(row_id for table, row_id in changes if table in ('grade_students', 'students'))
+    if len(changed) > MAX_CATCH_UP_STUDENTS:
+        return False
+    rankings = StudentService.get_rankings(term=term, student_ids=changed) if changed else []
+    board.update(changed, rankings, version)
+    return True
+
+
+def with_students(ranked):
+    """Pair each ``RankedStudent`` with its ``Student``, in rank order."""
+    ids = [item.student_id for item in ranked]
+    students = {student.id: student for student in Student.query.filter(Student.id.in_(ids))}
+    return [(item, students[item.student_id]) for item in ranked if item.student_id in students]
+
+
+def drop_leaderboards(shard=None):
+    """Forget the boards of ``shard``, e.g. after a write by another process."""
+    _apply_change(_boards(current_app._get_current_object()), None, shard)
+
+
+@grades_changed.connect
+def _on_grades_changed(app, student_ids=None, shard=None, **kwargs):
+    boards = app.extensions.get('leaderboards')
+    if boards is not None:
+        # A board being built meanwhile misses this change, but is tagged
+        # with an older version and catches up on its next lookup.
+        try:
+            _apply_change(boards, student_ids, shard)
+        except OperationalError:
+            # The write is already committed: a read that lost a lock race
+            # must not fail it (or make retry_on_lock run it again), so the
+            # boards are dropped and the next lookup rebuilds them.
+            _apply_change(boards, None, shard)
+    rankings_changed.send(app, shard=shard)
+
+
+def _apply_change(boards, student_ids, shard):
+    version = data_version(db.session.connection()) if student_ids is not None and boards else None
+    for key, board in list(boards.items()):
+        board_shard, term_id = key
+        if board_shard != shard:
+            continue
+        if student_ids is None:
+            boards.pop(key, None)
+            continue
+        term = db.session.get(Term, term_id) if term_id is not None else None
+        if not _catch_up(board, term, version, student_ids):
+            boards.pop(key, None)
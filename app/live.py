@@ -0,0 +1,212 @@
+"""Live ranking updates pushed to browsers with Server-Sent Events.
+
+Every open rankings page subscribes to the feed of its term. A feed keeps
+the last ranks it published and, when the leaderboards announce a change
+(``rankings_changed``), the first subscriber to wake up diffs the board
+against them once and appends the delta (students whose rank, average or
+grade count moved, plus the ones who dropped out) to a short history. All
+other subscribers of the feed just send that same delta, so a change costs
+one diff no matter how many pages are open.
+
+Events carry the feed version as their id. A page is rendered with the
+current version and streams from there; a browser that reconnects sends the
+last id it saw and is replayed the deltas it missed, or told to reload if
+they are no longer in the history. Deltas hold absolute values, so applying
+one twice is harmless.
+
+Writes by other processes (the CLI, other web workers) do not reach this
+process's signals, so subscribers also compare ``data_version`` every
+``LIVE_RANKINGS_POLL_INTERVAL`` seconds, again once per feed.
+"""
+import json
+import threading
+import time
+from collections import deque
+from flask import current_app
+from app.leaderboard import get_leaderboard
+from app.models import db, Student, Term
+from app.shards import current_shard
+from app.signals import rankings_changed
+from app.snapshot import data_version
+
+#: Deltas kept per feed for reconnecting browsers.
+FEED_HISTORY = 64
+
+#: Milliseconds a browser waits before reconnecting a closed stream.
+RECONNECT_MS = 1000
+
+NAME_CHUNK = 900
+
+
+class RankingFeed:
+    """Published ranking deltas of one term of one school."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._compute_lock = threading.Lock()
+        self.version = 0
+        self.dirty = False
+        self.data_version = None
+        self.checked_at = time.monotonic()
+        self._ranks = None
+        self._history = deque(maxlen=FEED_HISTORY)
+        self.computations = 0
+
+    def ensure_started(self, term):
+        """Take the baseline ranks if needed and return the current version."""
+        if self._ranks is None:
+            with self._compute_lock:
+                if self._ranks is None:
+                    self._compute(term)
+        return self.version
+
+    def mark_dirty(self):
+        with self._cond:
+            self.dirty = True
+            self._cond.notify_all()
+
+    def events_since(self, version):
+        """``[(version, delta)]`` after ``version``, or ``None`` if some were dropped."""
+        with self._cond:
+            if version == self.version:
+                return []
+            if version > self.version or not self._history or self._history[0][0] > version + 1:
+                return None
+            return [event for event in self._history if event[0] > version]
+
+    def wait(self, version, timeout):
+        """Block until a delta after ``version`` exists or one is due, at most ``timeout``."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.version > version or (self.dirty and not self._compute_lock.locked()),
+                timeout
+            )
+
+    def refresh(self, term_id, poll_interval):
+        """Publish a delta if the rankings changed; a no-op if another subscriber is on it."""
+        with self._cond:
+            due = self.dirty or time.monotonic() - self.checked_at >= poll_interval
+        if not due or not self._compute_lock.acquire(blocking=False):
+            return
+        try:
+            if not self.dirty:
+                self.checked_at = time.monotonic()
+                if data_version(db.session.connection()) == self.data_version:
+                    return
+            self._compute(db.session.get(Term, term_id) if term_id is not None else None)
+        finally:
+            self._compute_lock.release()
+            # Do not hold a read transaction (and its snapshot) between polls.
+            db.session.remove()
+            with self._cond:
+                self._cond.notify_all()
+
+    def _compute(self, term):
+        with self._cond:
+            self.dirty = False
+        current = data_version(db.session.connection())
+        board = get_leaderboard(term)
+        ranks = {
+            item.student_id: (item.rank, round(item.average, 4), item.count)
+            for item in board.slice(0, len(board))
+        }
+        previous, self._ranks, self.data_version = self._ranks, ranks, current
+        self.computations += 1
+        if previous is None:
+            return
+
+        changed = [student_id for student_id, entry in ranks.items() if previous.get(student_id) != entry]
+        removed = [student_id for student_id in previous if student_id not in ranks]
+        if not changed and not removed:
+            return
+
+        names = {}
+        for start in range(0, len(changed), NAME_CHUNK):
+            chunk = changed[start:start + NAME_CHUNK]
+            for student in Student.query.filter(Student.id.in_(chunk)):
+                names[student.id] = (student.name, student.email)
+        with self._cond:
+            self.version += 1
+            self._history.append((self.version, {
+                'version': self.version,
+                'total': len(ranks),
+                'changes': sorted((
+                    {
+                        'id': student_id,
+                        'rank': ranks[student_id][0],
+                        'average': ranks[student_id][1],
+                        'count': ranks[student_id][2],
+                        'name': names[student_id][0],
+                        'email': names[student_id][1]
+                    }
+                    for student_id in changed if student_id in names
+                ), key=lambda change: change['rank']),
+                'removed': removed
+            }))
+            self._cond.notify_all()
+
+
+_feeds_lock = threading.Lock()
+
+
+def get_feed(term=None):
+    """The ranking feed of ``term`` (all terms if ``None``) for the routed school."""
+    app = current_app._get_current_object()
+    key = (current_shard(), term.id if term is not None else None)
+    with _feeds_lock:
+        feeds = app.extensions.setdefault('ranking_feeds', {})
+        feed = feeds.get(key)
+        if feed is None:
+            feed = feeds[key] = RankingFeed()
+    return feed
+
+
+def format_event(event, data=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_rankings(term, since):
+    """Yield the SSE messages of ``term``'s feed after version ``since``.
+
+    The stream ends after ``LIVE_RANKINGS_STREAM_SECONDS`` so long-lived
+    connections do not pin server threads; browsers reconnect on their own.
+    """
+    config = current_app.config
+    poll_interval = config['LIVE_RANKINGS_POLL_INTERVAL']
+    deadline = time.monotonic() + config['LIVE_RANKINGS_STREAM_SECONDS']
+    term_id = term.id if term is not None else None
+    feed = get_feed(term)
+    feed.ensure_started(term)
+    db.session.remove()
+
+    yield f'retry: {RECONNECT_MS}\n\n'
+    while True:
+        events = feed.events_since(since)
+        if events is None:
+            yield format_event('reload', {'version': feed.version}, feed.version)
+            return
+        for version, delta in events:
+            yield format_event('rankings', delta, version)
+            since = version
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not events:
+            yield ': keepalive\n\n'
+        feed.wait(since, min(poll_interval, remaining))
+        feed.refresh(term_id, poll_interval)
+
+
+@rankings_changed.connect
+def _on_rankings_changed(app, shard=None, **kwargs):
+    feeds = app.extensions.get('ranking_feeds')
+    if not feeds:
+        return
+    for (feed_shard, _), feed in list(feeds.items()):
+        if feed_shard == shard:
+            feed.mark_dirty()
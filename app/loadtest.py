@@ -0,0 +1,278 @@
+"""Start the app under the production server and measure it under load.
+
+A throwaway database is seeded, ``serve`` is started in a subprocess, and
+client threads perform a weighted mix of page reads, exports and form posts
+for a fixed time. Each client keeps its own session cookie and posts forms
+with the CSRF token from the form page, as a browser would. Results hold
+throughput and latency percentiles per route in a JSON layout that later
+runs can be compared against. Used by ``loadtest`` and ``benchmark-serve``.
+"""
+import http.cookiejar
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+from itertools import chain
+from sqlalchemy import insert
+from app import create_app
+from app.models import db, Grade, Student
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBJECTS = ['Math', 'English', 'Science', 'History', 'Art', 'Music', 'Biology', 'Chemistry']
+
+
+def seed_database(db_path, students=200, grades_per_student=10, seed=0):
+    """Fill a new database with ``students`` students and their grades."""
+    from app.services import SubjectService
+
+    rng = random.Random(seed)
+    app = create_app('default', db_path=db_path)
+    with app.app_context():
+        subject_ids = [SubjectService.resolve_id(name) for name in SUBJECTS]
+        db.session.execute(insert(Student.__table__), [
+            {'name': f'Student {i:05d}', 'email': f'student{i}@example.com'} for i in range(1, students + 1)
+        ])
+        student_ids = db.session.execute(db.select(Student.id)).scalars().all()
+        db.session.execute(insert(Grade.__table__), [
+            {'student_id': student_id, 'subject_id': rng.choice(subject_ids), 'score': rng.uniform(40, 100)}
+            for student_id in student_ids for _ in range(grades_per_student)
+        ])
+        db.session.commit()
+        db.engine.dispose()
+    return student_ids
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(db_path, port, workers, threads=1, extra_env=None, timeout=30):
+    """Start ``serve`` in a subprocess and wait until it answers."""
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT, FLASK_ENV='production', **(extra_env or {}))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'cli.commands', '--db', db_path, 'serve',
+         '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--threads', str(threads),
+         '--timeout', str(timeout)],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+            return process
+        except (urllib.error.URLError, ConnectionError, OSError):
+            if process.poll() is not None or time.monotonic() > deadline:
+                stop_server(process)
+                raise RuntimeError('The server did not start.')
+            time.sleep(0.1)
+
+
+def stop_server(process):
+    """Stop the server gracefully (``TERM``), waiting for in-flight requests."""
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+#: Operations a simulated user performs, with the route they are reported under.
+ROUTES = {
+    'students': 'GET /students/',
+    'rankings': 'GET /students/rankings',
+    'student_grades': 'GET /grades/student/<id>',
+    'export_students': 'GET /export/students',
+    'export_grades': 'GET /export/grades',
+    'export_pivot': 'GET /export/pivot',
+    'add_grade': 'POST /grades/student/<id>/add',
+    'add_student': 'POST /students/create',
+}
+#: Relative weights of the operations in the default mix.
+DEFAULT_MIX = {
+    'students': 25, 'rankings': 20, 'student_grades': 25, 'export_students': 3,
+    'export_grades': 3, 'export_pivot': 4, 'add_grade': 15, 'add_student': 5,
+}
+READ_MIX = {'students': 1, 'rankings': 1, 'student_grades': 2}
+RESULT_FORMAT = 1
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects (a successful form post) instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class LoadClient:
+    """One simulated user, with its own cookies and CSRF token."""
+
+    def __init__(self, base_url, student_ids, rng):
+        self.base_url = base_url
+        self.student_ids = student_ids
+        self.rng = rng
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+        self.csrf_token = None
+        self.created = 0
+
+    def _open(self, path, data=None):
+        """``(status, seconds)`` of one request; the body is read in full."""
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        started = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=60) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            status = e.code
+        return status, time.perf_counter() - started
+
+    def _post_form(self, form_path, data):
+        # Form pages embed the session's CSRF token; it stays valid for the
+        # session, so it is fetched once and again only after a rejection.
+        if self.csrf_token is None:
+            with self.opener.open(self.base_url + form_path, timeout=60) as response:
+                match = _CSRF_TOKEN.search(response.read().decode('utf-8'))
+            self.csrf_token = match.group(1) if match else ''
+        status, seconds = self._open(form_path, dict(data, csrf_token=self.csrf_token))
+        if status == 400:
+            self.csrf_token = None
+        # A successful post redirects; a re-rendered form (200) means it was rejected.
+        return 300 <= status < 400, seconds
+
+    def perform(self, operation):
+        """Run ``operation``; returns ``(ok, seconds)``."""
+        student_id = self.rng.choice(self.student_ids)
+        if operation == 'add_grade':
+            return self._post_form(f'/grades/student/{student_id}/add', {
+                'subject': self.rng.choice(SUBJECTS), 'score': f'{self.rng.uniform(40, 100):.1f}'
+            })
+        if operation == 'add_student':
+            self.created += 1
+            tag = f'{id(self):x}-{self.created}'
+            return self._post_form('/students/create', {
+                'name': f'Load Student {tag}', 'email': f'load-{tag}-{self.rng.random():.8f}@example.com'
+            })
+        path = {
+            'students': '/students/',
+            'rankings': '/students/rankings',
+            'student_grades': f'/grades/student/{student_id}',
+            'export_students': '/export/students',
+            'export_grades': '/export/grades',
+            'export_pivot': '/export/pivot',
+        }[operation]
+        status, seconds = self._open(path)
+        return status == 200, seconds
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_loadtest(base_url, student_ids, mix, concurrency, duration, seed=0):
+    """Drive the ``mix`` of operations from ``concurrency`` clients for ``duration`` seconds.
+
+    Returns the results in the saved JSON layout: ``totals`` and per-route
+    ``routes``, each with requests, errors, throughput and latency
+    percentiles in milliseconds.
+    """
+    operations = [name for name in mix if mix[name] > 0]
+    weights = [mix[name] for name in operations]
+    samples = {ROUTES[name]: [] for name in operations}
+    attempts = {ROUTES[name]: 0 for name in operations}
+    errors = {ROUTES[name]: 0 for name in operations}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def run_client(index):
+        rng = random.Random(seed * 1000 + index)
+        client = LoadClient(base_url, student_ids, rng)
+        latencies = {route: [] for route in samples}
+        sent = dict.fromkeys(samples, 0)
+        failed = dict.fromkeys(samples, 0)
+        while time.monotonic() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            route = ROUTES[operation]
+            try:
+                ok, seconds = client.perform(operation)
+            except (urllib.error.URLError, ConnectionError, OSError):
+                ok, seconds = False, 0.0
+            else:
+                latencies[route].append(seconds)
+            sent[route] += 1
+            failed[route] += not ok
+        with lock:
+            for route in samples:
+                samples[route].extend(latencies[route])
+                attempts[route] += sent[route]
+                errors[route] += failed[route]
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - started
+
+    def summarize(latencies, request_count, error_count):
+        """Latencies cover every answered request, including error responses."""
+        latencies = sorted(latencies)
+        return {
+            'requests': request_count,
+            'errors': error_count,
+            'throughput': len(latencies) / seconds,
+            'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+    return {
+        'format': RESULT_FORMAT,
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'config': {'concurrency': concurrency, 'duration': duration, 'mix': dict(mix)},
+        'seconds': seconds,
+        'totals': summarize(list(chain.from_iterable(samples.values())), sum(attempts.values()),
+                            sum(errors.values())),
+        'routes': {
+            route: summarize(samples[route], attempts[route], errors[route]) for route in sorted(samples)
+        },
+    }
+
+
+def compare_results(current, previous):
+    """``{route: (throughput change, p95 change)}`` as ratios against ``previous``."""
+    if previous.get('format') != RESULT_FORMAT:
+        raise ValueError(f'Saved results are not in format {RESULT_FORMAT}.')
+    changes = {}
+    pairs = [('total', current['totals'], previous['totals'])] + [
+        (route, stats, previous['routes'][route])
+        for route, stats in current['routes'].items() if route in previous['routes']
+    ]
+    for route, now, before in pairs:
+        changes[route] = (
+            now['throughput'] / before['throughput'] - 1 if before['throughput'] else None,
+            now['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else None,
+        )
+    return changes
@@ -1,7 +1,123 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import raiseload, validates
+from sqlalchemy.ext.hybrid import hybrid_property
+from datetime import date, datetime
+from app.shards import ShardRoutingSession, current_shard
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardRoutingSession})
+
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # Let SQLAlchemy issue BEGIN itself so SAVEPOINTs and DDL are transactional;
+    # pysqlite's implicit transaction handling breaks both.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+
+_transaction_mode = threading.local()
+
+
+@contextmanager
+def immediate_transaction():
+    """Begin the next transaction in this thread with ``BEGIN IMMEDIATE``.
+    
+    A deferred transaction that reads first and writes later can deadlock
+    with another one doing the same, and SQLite fails one of them at once
+    instead of waiting. Taking the write lock up front makes writers queue
+    on the busy timeout instead. Transactions begun after that one, such as
+    reads after its commit, are deferred again.
+    """
+    previous = getattr(_transaction_mode, 'immediate', False)
+    _transaction_mode.immediate = True
+    try:
+        yield
+    finally:
+        _transaction_mode.immediate = previous
+
+
+@event.listens_for(Engine, 'begin')
+def _begin_sqlite_transaction(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    # In-memory databases share one connection between sessions (StaticPool),
+    # so a second session simply joins the transaction that is already open.
+    if not connection.connection.driver_connection.in_transaction:
+        if getattr(_transaction_mode, 'immediate', False):
+            _transaction_mode.immediate = False
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+        else:
+            connection.exec_driver_sql('BEGIN')
+
+
+@event.listens_for(ShardRoutingSession, 'do_orm_execute')
+def _raise_on_lazy_load(orm_execute_state):
+    # With RAISE_ON_LAZY_LOAD (on in tests), relationships a query did not
+    # load eagerly raise on access instead of issuing one SELECT per object.
+    # Many-to-one lookups that the identity map can answer are still allowed.
+    if (orm_execute_state.is_select and not orm_execute_state.is_relationship_load
+            and has_app_context() and current_app.config.get('RAISE_ON_LAZY_LOAD')):
+        orm_execute_state.statement = orm_execute_state.statement.options(raiseload('*', sql_only=True))
+
+
+def database_epoch(connection):
+    """The restore epoch (``PRAGMA user_version``) of the database behind ``connection``."""
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+#: Per-database caches in ``app.extensions``, keyed by shard (leaderboards
+#: by ``(shard, term_id)``).
+CACHE_EXTENSIONS = ('subject_caches', 'student_caches', 'grade_snapshots', 'leaderboards')
+
+
+def drop_caches(app, shard=None):
+    """Forget everything ``app`` cached about the database of ``shard``."""
+    for name in CACHE_EXTENSIONS:
+        caches = app.extensions.get(name)
+        if not caches:
+            continue
+        for key in list(caches):
+            if (key[0] if name == 'leaderboards' else key) == shard:
+                caches.pop(key, None)
+
+
+@event.listens_for(ShardRoutingSession, 'after_begin')
+def _check_database_epoch(session, transaction, connection):
+    # A restore (see app.backup) gives the database a new epoch; caches built
+    # from the database it replaced, in any process, must not be used again.
+    if not has_app_context():
+        return
+    app = current_app._get_current_object()
+    shard = current_shard()
+    epochs = app.extensions.setdefault('database_epochs', {})
+    epoch = database_epoch(connection)
+    known = epochs.get(shard)
+    if known != epoch:
+        if known is not None:
+            drop_caches(app, shard)
+        epochs[shard] = epoch
+
+
+def normalize_subject_name(name):
+    """Collapse runs of whitespace so "  Math  101" and "Math 101" match."""
+    return ' '.join(str(name).split())
+
+
+def normalize_email(email):
+    """The stored form of an email address: trimmed and lower-cased."""
+    return str(email).strip().lower()
+
+
+def subject_key(name):
+    """Case-insensitive lookup key used to intern subject names."""
+    return normalize_subject_name(name).casefold()
 
 
 class Student(db.Model):
@@ -9,28 +125,231 @@ class Student(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
+    # Stored normalized, so the unique index is case-insensitive.
     email = db.Column(db.String(120), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    grades = db.relationship('Grade', backref='student', lazy=True, cascade='all, delete-orphan')
+    # Loaded lazily unless a query asks otherwise; see ``app.services.GRADE_LOADING``.
+    grades = db.relationship('Grade', backref='student', lazy=True, cascade='all, delete-orphan',
+                             passive_deletes=True, order_by=lambda: (Grade.created_at.desc(), Grade.id.desc()))
     
     def __repr__(self):
         return f'<Student {self.name}>'
     
+    @validates('email')
+    def _normalize_email(self, key, email):
+        return normalize_email(email)
+    
     def average_grade(self):
         if not self.grades:
             return 0.0
         return sum(g.score for g in self.grades) / len(self.grades)
 
 
+class Subject(db.Model):
+    __tablename__ = 'subjects'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    key = db.Column(db.String(100), unique=True, nullable=False)
+    
+    def __repr__(self):
+        return f'<Subject {self.name}>'
+
+
+class Term(db.Model):
+    __tablename__ = 'terms'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    archive_path = db.Column(db.String(255))
+    
+    def __repr__(self):
+        return f'<Term {self.name}>'
+    
+    @property
+    def is_archived(self):
+        return self.archive_path is not None
+    
+    def is_closed(self, today=None):
+        return self.end_date < (today or date.today())
+
+
 class Grade(db.Model):
     __tablename__ = 'grades'
+    __table_args__ = (
+        db.Index('ix_grades_term_student', 'term_id', 'student_id'),
+        db.Index('ix_grades_student_created', 'student_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
-    subject = db.Column(db.String(100), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'),
+                           nullable=False, index=True)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subjects.id'), nullable=False, index=True)
+    term_id = db.Column(db.Integer, db.ForeignKey('terms.id'))
     score = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    term = db.relationship('Term')
+    
+    @hybrid_property
+    def subject(self):
+        if self.subject_id is None:
+            return None
+        from app.services import SubjectService
+        return SubjectService.get_name(self.subject_id)
+    
+    @subject.inplace.setter
+    def _subject_setter(self, name):
+        from app.services import SubjectService
+        self.subject_id = SubjectService.resolve_id(name)
+    
+    @subject.inplace.expression
+    @classmethod
+    def _subject_expression(cls):
+        return select(Subject.name).where(Subject.id == cls.subject_id).scalar_subquery()
+    
     def __repr__(self):
         return f'<Grade {self.subject}: {self.score}>'
+
+
+#: The number of the last migration applied (see ``app.schema``); one row.
+schema_version = db.Table(
+    'schema_version',
+    db.Column('version', db.Integer, nullable=False),
+)
+
+
+#: One row per inserted, updated or deleted grade or student, written by the
+#: triggers below. ``max(id)`` is the data version analytics snapshots compare
+#: against, and the rows after a snapshot's version say what to reload. Grade
+#: changes also log the student of the grade as ``grade_students``, so
+#: leaderboards can re-rank exactly those students even once a grade is gone.
+change_log = db.Table(
+    'change_log',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('table_name', db.String(20), nullable=False),
+    db.Column('row_id', db.Integer, nullable=False),
+)
+
+def _change_log_trigger(table, action, row):
+    values = f"('{table}', {row}.id)"
+    extra = ''
+    if table == 'grades':
+        values += f", ('grade_students', {row}.student_id)"
+        if action == 'UPDATE':
+            extra = (" INSERT INTO change_log (table_name, row_id) SELECT 'grade_students', OLD.student_id"
+                     " WHERE OLD.student_id != NEW.student_id;")
+    return (
+        f'CREATE TRIGGER log_{table}_{action.lower()} AFTER {action} ON {table} '
+        f'BEGIN INSERT INTO change_log (table_name, row_id) VALUES {values};{extra} END'
+    )
+
+
+CHANGE_LOG_TRIGGERS = {
+    f'log_{table}_{action.lower()}': _change_log_trigger(table, action, row)
+    for table in ('grades', 'students')
+    for action, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))
+}
+
+
+def install_change_log_triggers(connection, table):
+    """(Re)create the change-log triggers of ``table`` on ``connection``."""
+    for name, sql in CHANGE_LOG_TRIGGERS.items():
+        if name.startswith(f'log_{table}_'):
+            connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}')
+            connection.exec_driver_sql(sql)
+
+
+for _table in (Student.__table__, Grade.__table__):
+    event.listen(
+        _table, 'after_create',
+        lambda target, connection, **kw: install_change_log_triggers(connection, target.name)
+    )
+
+#: Change-log entries kept. Every ``CHANGE_LOG_PRUNE_EVERY`` entries a trigger
+#: deletes the ones older than that, so the log stays bounded whether or not
+#: anything reads it. Readers that fell further behind (snapshots,
+#: leaderboards, caches) see a gap and rebuild from the tables instead.
+CHANGE_LOG_RETENTION = 100000
+CHANGE_LOG_PRUNE_EVERY = 1000
+
+
+def change_log_pruning_trigger(retention=CHANGE_LOG_RETENTION, every=CHANGE_LOG_PRUNE_EVERY):
+    return (
+        f'CREATE TRIGGER prune_change_log AFTER INSERT ON change_log WHEN NEW.id % {every} = 0 '
+        f'BEGIN DELETE FROM change_log WHERE id <= NEW.id - {retention}; END'
+    )
+
+
+def install_change_log_pruning(connection, retention=CHANGE_LOG_RETENTION, every=CHANGE_LOG_PRUNE_EVERY):
+    """(Re)create the trigger that keeps the newest ``retention`` change-log entries."""
+    connection.exec_driver_sql('DROP TRIGGER IF EXISTS prune_change_log')
+    connection.exec_driver_sql(change_log_pruning_trigger(retention, every))
+
+
+event.listen(change_log, 'after_create', lambda target, connection, **kw: install_change_log_pruning(connection))
+
+
+#: Least-squares sums of each student's grades per term (``term_key`` 0 for
+#: grades without a term), kept current by the triggers below so trends and
+#: the at-risk report never rescan the grades. ``x`` is a grade's date in days
+#: since 2000-01-01 and ``y`` its score.
+student_trends = db.Table(
+    'student_trends',
+    db.Column('student_id', db.Integer, primary_key=True),
+    db.Column('term_key', db.Integer, primary_key=True),
+    db.Column('n', db.Integer, nullable=False),
+    db.Column('sum_x', db.Float, nullable=False),
+    db.Column('sum_y', db.Float, nullable=False),
+    db.Column('sum_xx', db.Float, nullable=False),
+    db.Column('sum_xy', db.Float, nullable=False),
+)
+
+TREND_EPOCH = 2451544.5  # julianday('2000-01-01')
+
+
+def _trend_add(row):
+    x = f'(julianday({row}.created_at) - {TREND_EPOCH})'
+    return (
+        'INSERT INTO student_trends (student_id, term_key, n, sum_x, sum_y, sum_xx, sum_xy) '
+        f'VALUES ({row}.student_id, coalesce({row}.term_id, 0), 1, {x}, {row}.score, {x} * {x}, {x} * {row}.score) '
+        'ON CONFLICT (student_id, term_key) DO UPDATE SET n = n + 1, '
+        'sum_x = sum_x + excluded.sum_x, sum_y = sum_y + excluded.sum_y, '
+        'sum_xx = sum_xx + excluded.sum_xx, sum_xy = sum_xy + excluded.sum_xy;'
+    )
+
+
+def _trend_remove(row):
+    x = f'(julianday({row}.created_at) - {TREND_EPOCH})'
+    key = f'student_id = {row}.student_id AND term_key = coalesce({row}.term_id, 0)'
+    return (
+        f'UPDATE student_trends SET n = n - 1, sum_x = sum_x - {x}, sum_y = sum_y - {row}.score, '
+        f'sum_xx = sum_xx - {x} * {x}, sum_xy = sum_xy - {x} * {row}.score WHERE {key}; '
+        f'DELETE FROM student_trends WHERE {key} AND n <= 0;'
+    )
+
+
+TREND_TRIGGERS = {
+    'trend_grades_insert': f'CREATE TRIGGER trend_grades_insert AFTER INSERT ON grades BEGIN {_trend_add("NEW")} END',
+    'trend_grades_update': (
+        'CREATE TRIGGER trend_grades_update AFTER UPDATE OF student_id, term_id, score, created_at '
+        f'ON grades BEGIN {_trend_remove("OLD")} {_trend_add("NEW")} END'
+    ),
+    'trend_grades_delete': f'CREATE TRIGGER trend_grades_delete AFTER DELETE ON grades BEGIN {_trend_remove("OLD")} END',
+}
+
+
+def install_trend_triggers(connection):
+    """(Re)create the triggers that maintain ``student_trends`` on ``connection``."""
+    for name, sql in TREND_TRIGGERS.items():
+        connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}')
+        connection.exec_driver_sql(sql)
+
+
+event.listen(
+    Grade.__table__, 'after_create',
+    lambda target, connection, **kw: install_trend_triggers(connection)
+)
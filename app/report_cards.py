@@ -0,0 +1,104 @@
+"""Render one HTML report card per student into a directory.
+
+The main process reads every grade with one query ordered by student
+(``ReportCardService.iter_report_cards``) and hands the cards to a pool of
+worker processes in batches. Each worker renders with its own Jinja
+environment and never touches the database. A card is written to a
+temporary file and renamed into place, so after an interruption every
+``student-<id>.html`` in the directory is complete and a rerun skips it.
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from flask import current_app
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from app.services import ReportCardService
+
+TEMPLATE = 'reports/report_card.html'
+
+_template = None
+
+
+def card_filename(student_id):
+    return f'student-{student_id}.html'
+
+
+def _init_worker(template_folder):
+    global _template
+    environment = Environment(
+        loader=FileSystemLoader(template_folder), autoescape=select_autoescape(['html'])
+    )
+    _template = environment.get_template(TEMPLATE)
+
+
+def _render_batch(output_dir, cards, generated):
+    for card in cards:
+        path = os.path.join(output_dir, card_filename(card['student']['id']))
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(_template.render(card=card, generated=generated))
+        os.replace(tmp_path, path)
+    return len(cards)
+
+
+def render_report_cards(term, output_dir, workers=1, batch_size=50, resume=True, progress=None):
+    """Render a report card for every student with grades in ``term``.
+
+    With ``resume``, students whose card already exists are skipped.
+    ``progress`` is called with the number of students handled (rendered or
+    skipped) as batches finish. Returns ``{'rendered', 'skipped', 'seconds'}``.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    existing = set(os.listdir(output_dir)) if resume else set()
+    template_folder = os.path.join(current_app.root_path, current_app.template_folder)
+    generated = datetime.now()
+    stats = {'rendered': 0, 'skipped': 0}
+    started = time.perf_counter()
+
+    def advance(key, count):
+        stats[key] += count
+        if progress is not None:
+            progress(count)
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(template_folder,))
+    else:
+        _init_worker(template_folder)
+    pending = set()
+
+    def drain(limit):
+        while len(pending) > limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                advance('rendered', future.result())
+
+    def submit(batch):
+        if pool is None:
+            advance('rendered', _render_batch(output_dir, batch, generated))
+            return
+        pending.add(pool.submit(_render_batch, output_dir, batch, generated))
+        # Keep a couple of batches queued per worker without reading ahead further.
+        drain(workers * 2)
+
+    try:
+        batch = []
+        for card in ReportCardService.iter_report_cards(term):
+            if card_filename(card['student']['id']) in existing:
+                advance('skipped', 1)
+                continue
+            batch.append(card)
+            if len(batch) == batch_size:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        drain(0)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
@@ -0,0 +1,139 @@
+"""Retry service-layer transactions that lose a race for the SQLite write lock.
+
+SQLite allows one writer at a time. A writer that cannot get the lock within
+the connection's busy timeout, or that would deadlock with another writer
+upgrading from a read transaction, fails with ``database is locked``. Such a
+transaction did nothing, so it is rolled back and run again after a short,
+randomized, exponentially growing pause.
+"""
+import functools
+import random
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app.models import db, immediate_transaction
+
+LOCK_ERROR_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(
+        message in str(error.orig) for message in LOCK_ERROR_MESSAGES
+    )
+
+
+class RetryStats:
+    """Per-operation counts of calls, retries and calls that gave up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, name, retries, failed):
+        with self._lock:
+            counts = self._counts.setdefault(name, {'calls': 0, 'retries': 0, 'failures': 0})
+            counts['calls'] += 1
+            counts['retries'] += retries
+            counts['failures'] += int(failed)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counts.items()}
+
+    def totals(self):
+        totals = {'calls': 0, 'retries': 0, 'failures': 0}
+        for counts in self.snapshot().values():
+            for key in totals:
+                totals[key] += counts[key]
+        return totals
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+retry_stats = RetryStats()
+
+_local = threading.local()
+
+
+def backoff_delay(attempt, base, cap):
+    """Full-jitter exponential backoff for the given zero-based attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def end_read_transaction():
+    """End the session's transaction, which must only have read.
+
+    Rolls it back so the next statement starts a fresh transaction. Raises
+    ``RuntimeError`` if the session holds changes that are not committed yet,
+    pending or already flushed, rather than committing them outside the
+    caller's control.
+    """
+    session = db.session()
+    if session.new or session.dirty or session.deleted or session.info.get('flushed'):
+        raise RuntimeError('The session has uncommitted changes; commit or roll them back first.')
+    session.rollback()
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_flush(session, flush_context):
+    session.info['flushed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _forget_flush(session):
+    session.info.pop('flushed', None)
+
+
+def retry_on_lock(func):
+    """Run ``func`` as a transaction that is retried on lock errors.
+
+    Every attempt runs in an immediate transaction (see
+    ``immediate_transaction``), so lock errors only come from waiting longer
+    than the busy timeout. Only the outermost decorated call retries; a
+    decorated service method called from another one takes part in its
+    caller's transaction and attempt. Limits come from ``DB_RETRY_ATTEMPTS``,
+    ``DB_RETRY_BASE_DELAY`` and ``DB_RETRY_MAX_DELAY``.
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'active', False):
+            return func(*args, **kwargs)
+
+        config = current_app.config
+        attempts = config['DB_RETRY_ATTEMPTS']
+        retries = 0
+        _local.active = True
+        try:
+            # End any read transaction the caller left open, so the attempt
+            # starts a fresh transaction that holds the write lock throughout.
+            end_read_transaction()
+            while True:
+                try:
+                    with immediate_transaction():
+                        result = func(*args, **kwargs)
+                except OperationalError as e:
+                    if not is_lock_error(e):
+                        raise
+                    if retries + 1 >= attempts:
+                        retry_stats.record(name, retries, failed=True)
+                        raise
+                    db.session.rollback()
+                    time.sleep(backoff_delay(
+                        retries, config['DB_RETRY_BASE_DELAY'], config['DB_RETRY_MAX_DELAY']
+                    ))
+                    retries += 1
+                else:
+                    retry_stats.record(name, retries, failed=False)
+                    return result
+        finally:
+            _local.active = False
+
+    return wrapper
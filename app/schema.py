@@ -0,0 +1,348 @@
+"""Schema versioning and in-place upgrades for existing databases.
+
+The ``schema_version`` table holds the number of the last migration applied.
+At startup ``check_schema`` compares it with ``SCHEMA_VERSION`` and does
+nothing else when they match; new databases are created from the models in
+one go. Older databases are upgraded with the ``upgrade`` command, which runs
+the pending ``MIGRATIONS`` in order. Every step is idempotent: it inspects
+the current schema and does nothing when it is already up to date.
+"""
+from sqlalchemy import inspect, select, text
+from app.models import (
+    db, Grade, CHANGE_LOG_RETENTION, CHANGE_LOG_TRIGGERS, TREND_EPOCH, TREND_TRIGGERS,
+    change_log_pruning_trigger, immediate_transaction, install_change_log_pruning,
+    install_change_log_triggers, install_trend_triggers, normalize_email, normalize_subject_name,
+    schema_version, subject_key
+)
+
+#: Page cache for the upgrade connection, so table rebuilds stay in memory.
+MIGRATION_CACHE_KIB = 256 * 1024
+
+
+def _column_names(connection, table):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+
+def _register_functions(connection):
+    """Expose the Python name normalizers to SQL on this connection."""
+    raw = connection.connection.driver_connection
+    raw.create_function('subject_key', 1, subject_key, deterministic=True)
+    raw.create_function('subject_name', 1, normalize_subject_name, deterministic=True)
+    raw.create_function('normalize_email', 1, normalize_email, deterministic=True)
+
+
+def migrate_subjects(connection):
+    """Move free-text ``grades.subject`` values into the ``subjects`` table.
+
+    Distinct names are interned with one ``INSERT ... SELECT ... GROUP BY`` and
+    the grades table is rebuilt with a ``subject_id`` column in a single pass,
+    so the cost is one scan of the grades table regardless of its size.
+    Returns a summary of the change, or ``None`` if there was nothing to do.
+    """
+    columns = _column_names(connection, 'grades')
+    if 'subject' not in columns or 'subject_id' in columns:
+        return None
+
+    _register_functions(connection)
+    connection.execute(text(
+        'INSERT OR IGNORE INTO subjects (name, key) '
+        'SELECT subject_name(MIN(subject)), subject_key(subject) '
+        'FROM grades GROUP BY subject_key(subject)'
+    ))
+    connection.execute(text('ALTER TABLE grades RENAME TO grades_legacy'))
+    Grade.__table__.create(connection)
+    result = connection.execute(text(
+        'INSERT INTO grades (id, student_id, subject_id, score, created_at) '
+        'SELECT g.id, g.student_id, s.id, g.score, g.created_at '
+        'FROM grades_legacy g JOIN subjects s ON s.key = subject_key(g.subject)'
+    ))
+    connection.execute(text('DROP TABLE grades_legacy'))
+    return f'{result.rowcount} grade row(s) converted'
+
+
+def add_grade_terms(connection):
+    """Add the nullable ``grades.term_id`` column and its partition index."""
+    if 'term_id' in _column_names(connection, 'grades'):
+        return None
+
+    connection.execute(text('ALTER TABLE grades ADD COLUMN term_id INTEGER REFERENCES terms (id)'))
+    connection.execute(text('CREATE INDEX ix_grades_term_student ON grades (term_id, student_id)'))
+    return 'added grades.term_id'
+
+
+def cascade_grade_deletes(connection):
+    """Rebuild ``grades`` so deleting a student deletes its grades in SQL.
+
+    Also adds the ``grades.student_id`` index the cascade needs to avoid a
+    full table scan per deleted student.
+    """
+    foreign_keys = inspect(connection).get_foreign_keys('grades')
+    student_fk = next(fk for fk in foreign_keys if fk['referred_table'] == 'students')
+    if (student_fk.get('options') or {}).get('ondelete', '').upper() == 'CASCADE':
+        return None
+
+    columns = ', '.join(column.name for column in Grade.__table__.columns)
+    connection.execute(text('ALTER TABLE grades RENAME TO grades_legacy'))
+    for index in inspect(connection).get_indexes('grades_legacy'):
+        connection.execute(text(f'DROP INDEX {index["name"]}'))
+    Grade.__table__.create(connection)
+    result = connection.execute(text(
+        f'INSERT INTO grades ({columns}) SELECT {columns} FROM grades_legacy'
+    ))
+    connection.execute(text('DROP TABLE grades_legacy'))
+    return f'{result.rowcount} grade row(s) rebuilt with ON DELETE CASCADE'
+
+
+def add_change_log_triggers(connection):
+    """Install the triggers that record grade and student changes."""
+    existing = set(connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    )).scalars())
+    missing = sorted({name.split('_')[1] for name in CHANGE_LOG_TRIGGERS if name not in existing})
+    if not missing:
+        return None
+
+    for table in missing:
+        install_change_log_triggers(connection, table)
+    return f'change-log triggers installed on {", ".join(missing)}'
+
+
+def add_student_trends(connection):
+    """Install the ``student_trends`` triggers and fill the table from the grades."""
+    existing = set(connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    )).scalars())
+    if all(name in existing for name in TREND_TRIGGERS):
+        return None
+
+    install_trend_triggers(connection)
+    connection.execute(text('DELETE FROM student_trends'))
+    x = f'(julianday(created_at) - {TREND_EPOCH})'
+    result = connection.execute(text(
+        'INSERT INTO student_trends (student_id, term_key, n, sum_x, sum_y, sum_xx, sum_xy) '
+        f'SELECT student_id, coalesce(term_id, 0), count(*), sum({x}), sum(score), '
+        f'sum({x} * {x}), sum({x} * score) FROM grades GROUP BY student_id, coalesce(term_id, 0)'
+    ))
+    return f'trends computed for {result.rowcount} student term(s)'
+
+
+def add_grade_date_index(connection):
+    """Index each student's grades by date, for the grades page and trends."""
+    indexes = {index['name'] for index in inspect(connection).get_indexes('grades')}
+    if 'ix_grades_student_created' in indexes:
+        return None
+
+    connection.execute(text('CREATE INDEX ix_grades_student_created ON grades (student_id, created_at)'))
+    return 'added ix_grades_student_created'
+
+
+#: Collisions listed in the summary of ``normalize_emails``; the rest are counted.
+MAX_REPORTED_COLLISIONS = 10
+
+
+def normalize_emails(connection):
+    """Store every email normalized, so the unique index is case-insensitive.
+    
+    All rows are rewritten with one ``UPDATE``. Students whose addresses
+    only differ in case or surrounding spaces cannot all be normalized: in
+    each such group the student already holding the normalized address (or
+    else the oldest) is, the others are left as they are and reported, to
+    be merged or corrected by hand.
+    """
+    _register_functions(connection)
+    if not connection.execute(text(
+        'SELECT 1 FROM students WHERE email != normalize_email(email) LIMIT 1'
+    )).first():
+        return None
+    
+    connection.execute(text(
+        'CREATE TEMP TABLE email_keys AS '
+        'SELECT normalize_email(email) AS key, count(*) AS n, group_concat(id) AS ids, '
+        'coalesce(min(CASE WHEN email = normalize_email(email) THEN id END), min(id)) AS keep '
+        'FROM students GROUP BY normalize_email(email)'
+    ))
+    try:
+        result = connection.execute(text(
+            'UPDATE students SET email = normalize_email(email) '
+            'WHERE email != normalize_email(email) AND id IN (SELECT keep FROM email_keys)'
+        ))
+        collisions = connection.execute(text(
+            'SELECT key, ids FROM email_keys WHERE n > 1 ORDER BY key'
+        )).all()
+    finally:
+        connection.execute(text('DROP TABLE temp.email_keys'))
+    
+    summary = f'{result.rowcount} email(s) normalized'
+    if collisions:
+        listed = '; '.join(
+            f'{key} (students {", ".join(sorted(ids.split(","), key=int))})'
+            for key, ids in collisions[:MAX_REPORTED_COLLISIONS]
+        )
+        more = len(collisions) - MAX_REPORTED_COLLISIONS
+        summary += (
+            f'; {len(collisions)} address(es) shared by several students were left for manual '
+            f'review: {listed}' + (f' and {more} more' if more > 0 else '')
+        )
+    return summary
+
+
+def log_grade_students(connection):
+    """Make the grade change-log triggers also log the student of each changed grade."""
+    installed = dict(connection.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"
+    )).all())
+    if all(installed.get(name) == sql for name, sql in CHANGE_LOG_TRIGGERS.items()
+           if name.startswith('log_grades_')):
+        return None
+
+    install_change_log_triggers(connection, 'grades')
+    return 'grade change-log triggers now log the students of changed grades'
+
+
+def prune_change_log_automatically(connection):
+    """Install the change-log pruning trigger and trim the log to its retention."""
+    installed = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'prune_change_log'"
+    )).scalar()
+    if installed == change_log_pruning_trigger():
+        return None
+
+    install_change_log_pruning(connection)
+    result = connection.execute(text(
+        'DELETE FROM change_log WHERE id <= (SELECT max(id) FROM change_log) - :retention'
+    ), {'retention': CHANGE_LOG_RETENTION})
+    return f'change log limited to {CHANGE_LOG_RETENTION} entries; {result.rowcount} older one(s) deleted'
+
+
+def create_missing_tables(connection):
+    """Create the tables a database from an older version does not have yet."""
+    existing = set(inspect(connection).get_table_names())
+    missing = [table for table in db.metadata.sorted_tables if table.name not in existing]
+    if not missing:
+        return None
+
+    db.metadata.create_all(connection, tables=missing)
+    return f'created {", ".join(table.name for table in missing)}'
+
+
+#: Ordered ``(version, name, step)`` migrations. A database at version N has
+#: had every step up to N applied. Append new steps with the next number;
+#: never renumber or remove one. Steps are idempotent, so databases that
+#: predate versioning (version 0) can run them all.
+MIGRATIONS = [
+    (1, 'tables', create_missing_tables),
+    (2, 'subjects', migrate_subjects),
+    (3, 'terms', add_grade_terms),
+    (4, 'cascade', cascade_grade_deletes),
+    (5, 'change_log', add_change_log_triggers),
+    (6, 'trends', add_student_trends),
+    (7, 'grade_dates', add_grade_date_index),
+    (8, 'emails', normalize_emails),
+    (9, 'grade_students', log_grade_students),
+    (10, 'change_log_pruning', prune_change_log_automatically),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaVersionError(RuntimeError):
+    """The database schema does not match this version of the app."""
+
+
+def _read_version(connection):
+    """The stored schema version, 0 for an unversioned database, ``None`` if empty."""
+    tables = set(connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).scalars())
+    if schema_version.name not in tables:
+        return 0 if tables else None
+    return connection.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def _write_version(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def check_schema(engine, require_current=True):
+    """Make sure the database behind ``engine`` is at ``SCHEMA_VERSION``.
+
+    A current database costs one single-row read and no DDL. An empty one is
+    created from the models and stamped as current. Anything older (or newer)
+    raises ``SchemaVersionError`` unless ``require_current`` is false; older
+    databases are brought up to date with ``upgrade_schema`` (the
+    ``upgrade`` command).
+    """
+    with engine.connect() as connection:
+        version = _read_version(connection)
+    if version == SCHEMA_VERSION:
+        return
+
+    if version is None:
+        with immediate_transaction(), engine.begin() as connection:
+            # Another process may have created the schema while we waited.
+            if _read_version(connection) is None:
+                db.metadata.create_all(connection)
+                _write_version(connection, SCHEMA_VERSION)
+            return
+    if not require_current:
+        return
+    if version > SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f'The database schema is at version {version}, newer than this version of the app '
+            f'supports ({SCHEMA_VERSION}).'
+        )
+    raise SchemaVersionError(
+        f'The database schema is at version {version} but this version of the app needs '
+        f'{SCHEMA_VERSION}. Run the "upgrade" command first.'
+    )
+
+
+def pending_migrations(engine):
+    """The ``(version, name, step)`` migrations the database has not had yet."""
+    with engine.connect() as connection:
+        version = _read_version(connection) or 0
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def upgrade_schema(engine):
+    """Apply the pending migrations, each in its own transaction.
+
+    Each step and its version bump commit together, so an interrupted
+    upgrade resumes from the last completed step. Steps that rebuild large
+    tables do so with set-based ``INSERT ... SELECT`` statements; foreign
+    keys are switched off for the connection while they run (as SQLite
+    requires for table rebuilds), checked before each commit, and the page
+    cache is enlarged. Returns ``(version, name, summary)`` for each
+    applied step, with ``summary`` ``None`` when it found nothing to do.
+    """
+    applied = []
+    with engine.connect() as connection:
+        version = _read_version(connection)
+        connection.rollback()
+        if version is not None and version > SCHEMA_VERSION:
+            raise SchemaVersionError(
+                f'The database schema is at version {version}, newer than this version of the app '
+                f'supports ({SCHEMA_VERSION}).'
+            )
+        raw = connection.connection.driver_connection
+        raw.execute('PRAGMA foreign_keys = OFF')
+        raw.execute(f'PRAGMA cache_size = {-MIGRATION_CACHE_KIB}')
+        try:
+            for step_version, name, step in MIGRATIONS:
+                if version is not None and step_version <= version:
+                    continue
+                with immediate_transaction(), connection.begin():
+                    summary = step(connection)
+                    violations = connection.exec_driver_sql('PRAGMA foreign_key_check').all()
+                    if violations:
+                        raise SchemaVersionError(
+                            f'Migration {step_version} ({name}) left {len(violations)} row(s) '
+                            f'referencing missing rows in {violations[0][2]}.'
+                        )
+                    _write_version(connection, step_version)
+                applied.append((step_version, name, summary))
+        finally:
+            raw.execute('PRAGMA foreign_keys = ON')
+            raw.execute('PRAGMA cache_size = -2000')
+    return applied
@@ -0,0 +1,90 @@
+"""Serve the app with Gunicorn: preloaded, multi-process and multi-threaded.
+
+The master process creates the app once (checking the schema and importing
+every module), then forks the workers, which share those pages copy-on-write.
+No database connection may cross the fork: the master closes its pools
+before forking and every worker replaces the pools it inherited in
+``post_fork``, so each process opens its own SQLite connections.
+
+Sending ``HUP`` to the master starts fresh workers and lets the old ones
+finish their requests within ``graceful_timeout`` before exiting; ``TERM``
+stops the server the same way. Because the app is preloaded, code changes
+need a full restart (or a ``USR2`` binary upgrade) rather than ``HUP``.
+
+Workers are always ``gthread`` workers, even with one thread. A ``sync``
+worker only reports to the master between requests, so a live rankings
+stream (which stays open for ``LIVE_RANKINGS_STREAM_SECONDS``) would get it
+killed after ``timeout`` seconds; a ``gthread`` worker reports from its main
+loop while its threads serve requests. Each open stream still holds one of
+the worker's threads, so ``threads`` must cover the rankings pages expected
+to be open per worker plus the other requests.
+"""
+import os
+from app.models import db
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+def dispose_engines(app, close=True):
+    """Drop every pooled connection of ``app``.
+
+    In a forked worker pass ``close=False``: the inherited connections belong
+    to the parent and must be abandoned, not closed.
+    """
+    with app.app_context():
+        engines = list(db.engines.values()) + list(app.extensions.get('shard_engines', {}).values())
+    for engine in engines:
+        engine.dispose(close=close)
+
+
+if BaseApplication is not None:
+    class GradesServer(BaseApplication):
+        """A Gunicorn application serving an app created by ``app_factory``."""
+
+        def __init__(self, app_factory, options):
+            self.app_factory = app_factory
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+            self.cfg.set('preload_app', True)
+            self.cfg.set('post_fork', _post_fork)
+
+        def load(self):
+            app = self.app_factory()
+            dispose_engines(app)
+            return app
+
+
+def _post_fork(server, worker):
+    dispose_engines(worker.app.wsgi(), close=False)
+
+
+def serve(app_factory, bind='127.0.0.1:8000', workers=None, threads=1, timeout=30,
+          graceful_timeout=30, max_requests=0, pidfile=None, accesslog=None):
+    """Run ``app_factory()`` under Gunicorn until the server is stopped.
+
+    ``workers`` defaults to ``2 * CPUs + 1``, each serving requests from a
+    pool of ``threads`` threads. ``max_requests`` recycles a worker after
+    that many requests (with up to 10% jitter), ``0`` never.
+    """
+    if BaseApplication is None:
+        raise RuntimeError('Serving requires gunicorn (pip install gunicorn), which does not run on Windows.')
+    options = {
+        'bind': bind,
+        'workers': workers or 2 * (os.cpu_count() or 1) + 1,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'pidfile': pidfile,
+        'accesslog': accesslog,
+    }
+    GradesServer(app_factory, options).run()
@@ -1,126 +1,1538 @@
 import csv
+import heapq
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import chain, groupby
+from datetime import date, datetime, time, timedelta
 from io import StringIO
-from app.models import db, Student, Grade
-from sqlalchemy import func
+from flask import current_app, has_app_context
+from app.models import (
+    db, Student, Grade, Subject, Term, TREND_EPOCH, normalize_email, normalize_subject_name, student_trends,
+    subject_key
+)
+from sqlalchemy import and_, case, delete, event, func, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, raiseload, selectinload
+from app.shards import current_shard, run_on_shards
+from app.retry import end_read_transaction, retry_on_lock
+from app.signals import notify_grades_changed
+from app.snapshot import changes_since, data_version
+
+
+StudentSummary = namedtuple('StudentSummary', ['id', 'name', 'email'])
+
+#: How a query loads a relationship, chosen per call site: ``lazy`` issues one
+#: SELECT when the attribute is first used (one per object: N+1 in a loop),
+#: ``selectin`` one extra ``SELECT ... IN`` for every object loaded (best for
+#: lists), ``joined`` a LEFT JOIN in the same query (best for a single object)
+#: and ``raise`` makes any access an error, for code that must not touch it.
+#: ``lazy`` is the mapping's default, so it also raises under ``RAISE_ON_LAZY_LOAD``.
+GRADE_LOADING = {
+    'lazy': None,
+    'selectin': selectinload,
+    'joined': joinedload,
+    'raise': raiseload,
+}
+
+
+def _loading(relationship, strategy):
+    """The query options that load ``relationship`` with ``strategy``."""
+    if strategy not in GRADE_LOADING:
+        raise ValueError(f'Unknown loading strategy "{strategy}". Choose from {", ".join(GRADE_LOADING)}.')
+    loader = GRADE_LOADING[strategy]
+    return [] if loader is None else [loader(relationship)]
+
+# Stay well under SQLite's historical limit of 999 host parameters per statement.
+MAX_IN_CHUNK = 900
+
+
+def _chunks(ids, size):
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _chunk_selectors(model, ids, created_before, chunk_size):
+    """Yield ``SELECT id`` statements that each pick one chunk of matching rows."""
+    filters = []
+    if created_before is not None:
+        filters.append(model.created_at < created_before)
+    if ids is not None:
+        for chunk in _chunks(ids, chunk_size):
+            yield select(model.id).where(model.id.in_(chunk), *filters)
+    else:
+        # Rows are deleted as we go, so the first chunk is always the next one.
+        while True:
+            yield select(model.id).where(*filters).order_by(model.id).limit(chunk_size)
+
+
+def _count_matching(model, ids=None, created_before=None):
+    """Count the rows a bulk delete with the same filters would remove."""
+    if ids is None:
+        return db.session.scalar(
+            select(func.count(model.id)).where(model.created_at < created_before)
+        )
+    return sum(
+        db.session.scalar(select(func.count()).select_from(selector.subquery()))
+        for selector in _chunk_selectors(model, ids, created_before, MAX_IN_CHUNK)
+    )
+
+
+def _bulk_delete(model, ids=None, created_before=None, chunk_size=500, count_dependents=None):
+    """Delete the rows of ``model`` matching the filters with set-based DELETEs.
+    
+    Each chunk is one ``DELETE ... WHERE id IN (...)`` in its own transaction,
+    retried on lock errors, so locks are held briefly and a failure only rolls
+    back the current chunk.
+    ``count_dependents(selector)`` may count rows that the chunk's delete will
+    cascade to; it runs in the same transaction just before the delete.
+    Returns ``(deleted, dependents)``.
+    """
+    if ids is None and created_before is None:
+        raise ValueError('A bulk delete needs an ID list or a created-before date.')
+    chunk_size = max(1, min(chunk_size, MAX_IN_CHUNK))
+    
+    deleted = dependents = 0
+    for selector in _chunk_selectors(model, ids, created_before, chunk_size):
+        chunk_deleted, chunk_dependents = _delete_chunk(model, selector, count_dependents)
+        if chunk_deleted == 0 and ids is None:
+            break
+        deleted += chunk_deleted
+        dependents += chunk_dependents
+    return deleted, dependents
+
+
+@retry_on_lock
+def _delete_chunk(model, selector, count_dependents=None):
+    """Delete the rows of ``model`` picked by ``selector`` and commit.
+    
+    Returns ``(deleted, dependents)`` for the chunk.
+    """
+    try:
+        dependents = count_dependents(selector) if count_dependents else 0
+        result = db.session.execute(
+            delete(model).where(model.id.in_(selector)),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount, dependents
+
+
+@retry_on_lock
+def _execute_chunk(stmt, rows):
+    """Execute ``stmt`` once per row of ``rows`` and commit."""
+    try:
+        db.session.execute(stmt, rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _term_tables(term):
+    """Return the (grades, students, subjects) tables holding ``term``'s grades."""
+    if term is not None and term.is_archived:
+        from app.archive import archived_grades, archived_students, archived_subjects
+        return archived_grades, archived_students, archived_subjects
+    return Grade.__table__, Student.__table__, Subject.__table__
+
+
+def _execute_for_term(term, stmt):
+    """Run ``stmt`` against the database that stores ``term``'s grades."""
+    if term is not None and term.is_archived:
+        from app.archive import archive_connection
+        with archive_connection(term.archive_path) as connection:
+            return connection.execute(stmt).all()
+    return db.session.execute(stmt).all()
+
+
+def _stream_for_term(term, stmt):
+    """Like ``_execute_for_term``, but yield rows as the cursor produces them."""
+    if term is not None and term.is_archived:
+        from app.archive import archive_connection
+        with archive_connection(term.archive_path) as connection:
+            yield from connection.execute(stmt)
+        return
+    yield from db.session.execute(stmt)
+
+
+def _snapshot_for(term):
+    """The columnar snapshot, if enabled and it holds ``term``'s grades."""
+    config = current_app.config
+    if not (config.get('ANALYTICS_SNAPSHOT') or config.get('SNAPSHOT_FILE')):
+        return None
+    if term is not None and term.is_archived:
+        return None
+    from app.snapshot import get_snapshot
+    return get_snapshot()
+
+
+def _lookup_fields(fields, allowed, default):
+    """Validate a sparse fieldset; ``None`` selects ``default``. ``id`` is always included."""
+    if fields is None:
+        return tuple(default)
+    fields = [field.strip() for field in fields if field and field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f'Unknown field(s): {", ".join(unknown)}. Choose from {", ".join(allowed)}.')
+    return tuple(dict.fromkeys(['id', *fields]))
+
+
+class StudentCache:
+    """Bounded LRU cache of ``StudentSummary`` records by student id.
+    
+    Records are immutable tuples, so one cached record can be handed to any
+    number of threads. Writers call ``invalidate`` after they commit. A miss
+    only stores what it read if nothing was invalidated while it was reading
+    (``generation`` is unchanged), so a read that raced an update cannot put
+    the old record back.
+    
+    The cache remembers the data version (see ``app.snapshot``) it is
+    current with. Readers pass it the database's version through ``sync``,
+    which drops the students logged since then, so edits by other processes
+    are seen on the next lookup; if the log no longer reaches back that far,
+    everything is dropped.
+    """
+    
+    def __init__(self, max_size):
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self.max_size = max_size
+        self.version = None
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+    
+    def __len__(self):
+        return len(self._records)
+    
+    def get(self, student_id):
+        with self._lock:
+            record = self._records.get(student_id)
+            if record is not None:
+                self._records.move_to_end(student_id)
+                self.hits += 1
+                return record
+            self.misses += 1
+            return None
+    
+    def sync(self, version, changed):
+        """Move to data ``version``, dropping the ``changed`` student ids (all if ``None``).
+        
+        A version the cache already reached is ignored.
+        """
+        with self._lock:
+            if self.version is not None and version <= self.version:
+                return
+            self.version = version
+            if changed is None:
+                self._records.clear()
+            elif not changed:
+                return
+            for student_id in changed or ():
+                self._records.pop(student_id, None)
+            # Like ``invalidate``: a read from before this version must not be stored.
+            self.generation += 1
+    
+    def put(self, record, generation):
+        """Store ``record`` unless an invalidation happened since ``generation`` was read."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._records[record.id] = record
+            self._records.move_to_end(record.id)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, student_ids=None):
+        """Drop ``student_ids`` (every record if ``None``)."""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            if student_ids is None:
+                self._records.clear()
+            else:
+                for student_id in student_ids:
+                    self._records.pop(student_id, None)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._records),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+class DuplicateEmailError(ValueError):
+    """Another student already has this email address (compared normalized)."""
+
+
+def _is_duplicate_email(error):
+    return 'students.email' in str(error.orig)
+
+
+class StudentNotFoundError(LookupError):
+    """The student a grade was written for does not exist (any more)."""
+
+
+def _in_request_order(ids, found):
+    """``found`` (a dict by id) as a list in the order of ``ids``, plus the missing ids."""
+    ids = list(dict.fromkeys(ids))
+    return [found[i] for i in ids if i in found], [i for i in ids if i not in found]
 
 
 class StudentService:
     @staticmethod
-    def get_all_students():
-        return Student.query.order_by(Student.name).all()
+    def get_all_students(grades='lazy'):
+        """All students by name, loading ``Student.grades`` with ``grades`` (see ``GRADE_LOADING``)."""
+        return Student.query.options(*_loading(Student.grades, grades)).order_by(Student.name).all()
     
     @staticmethod
-    def get_student_by_id(student_id):
-        return Student.query.get(student_id)
+    def get_student_by_id(student_id, grades='lazy'):
+        return db.session.get(Student, student_id, options=_loading(Student.grades, grades))
     
     @staticmethod
+    def get_cache():
+        """The student record cache for the database the session is routed to."""
+        # Beginning the transaction checks the restore epoch first (see app.models).
+        db.session.connection()
+        caches = current_app.extensions.setdefault('student_caches', {})
+        shard = current_shard()
+        cache = caches.get(shard)
+        if cache is None:
+            cache = caches.setdefault(shard, StudentCache(current_app.config['STUDENT_CACHE_SIZE']))
+        return cache
+    
+    @staticmethod
+    def _sync_cache(cache):
+        """Bring ``cache`` up to the data version of the session's transaction."""
+        connection = db.session.connection()
+        version = data_version(connection)
+        if cache.version is not None and version <= cache.version:
+            return
+        changes = changes_since(connection, cache.version, version) if cache.version is not None else None
+        cache.sync(version, None if changes is None else {
+            row_id for table, row_id in changes if table == 'students'
+        })
+    
+    @staticmethod
+    def get_student_record(student_id):
+        """The ``StudentSummary`` of a student, or ``None``, read through the cache.
+        
+        For pages and commands that only show a student's name and email.
+        """
+        # A transaction that is already open may read from an older snapshot
+        # than the generation below, so only cache what a fresh one read.
+        fresh = not db.session().in_transaction()
+        cache = StudentService.get_cache()
+        StudentService._sync_cache(cache)
+        record = cache.get(student_id)
+        if record is not None:
+            return record
+        
+        generation = cache.generation
+        row = db.session.execute(
+            select(Student.id, Student.name, Student.email).where(Student.id == student_id)
+        ).first()
+        if row is None:
+            return None
+        record = StudentSummary(*row)
+        if fresh:
+            cache.put(record, generation)
+        return record
+    
+    #: Fields ``lookup_students`` can return: ``avg`` and ``count`` aggregate
+    #: the student's grades and ``grades`` lists them.
+    LOOKUP_FIELDS = ('id', 'name', 'email', 'avg', 'count', 'grades')
+    DEFAULT_LOOKUP_FIELDS = ('id', 'name', 'email')
+    
+    @staticmethod
+    def lookup_students(student_ids, fields=None):
+        """Read the chosen ``fields`` of many students at once.
+        
+        Each chunk of at most ``MAX_IN_CHUNK`` IDs is resolved with one
+        ``IN`` query selecting only the columns the fields need; the grades
+        are joined only for ``avg``/``count`` and read (one more query per
+        chunk) only for ``grades``. Returns ``(records, missing_ids)`` with
+        the records as dicts in the order the IDs were given.
+        """
+        fields = _lookup_fields(fields, StudentService.LOOKUP_FIELDS, StudentService.DEFAULT_LOOKUP_FIELDS)
+        columns = [Student.id] + [getattr(Student, field) for field in ('name', 'email') if field in fields]
+        aggregates = 'avg' in fields or 'count' in fields
+        if aggregates:
+            columns += [func.avg(Grade.score).label('avg'), func.count(Grade.id).label('count')]
+        
+        found = {}
+        for chunk in _chunks(student_ids, MAX_IN_CHUNK):
+            stmt = select(*columns).where(Student.id.in_(chunk))
+            if aggregates:
+                stmt = stmt.outerjoin(Grade, Grade.student_id == Student.id).group_by(Student.id)
+            for row in db.session.execute(stmt):
+                mapping = row._mapping
+                found[row.id] = {field: mapping[field] for field in fields if field != 'grades'}
+            if 'grades' in fields:
+                for record in found.values():
+                    record.setdefault('grades', [])
+                grades = db.session.execute(
+                    select(Grade.id, Grade.student_id, Grade.subject_id, Grade.score, Grade.created_at)
+                    .where(Grade.student_id.in_(chunk))
+                    .order_by(Grade.student_id, Grade.created_at, Grade.id)
+                )
+                for grade in grades:
+                    found[grade.student_id]['grades'].append({
+                        'id': grade.id,
+                        'subject': SubjectService.get_name(grade.subject_id),
+                        'score': grade.score,
+                        'created_at': grade.created_at.isoformat() if grade.created_at else None
+                    })
+        return _in_request_order(student_ids, found)
+    
+    @staticmethod
+    @retry_on_lock
     def create_student(name, email):
+        """Insert a student; raises ``DuplicateEmailError`` if the email is taken.
+        
+        The unique index on the normalized email decides, so there is no
+        separate lookup before the insert.
+        """
         student = Student(name=name, email=email)
         db.session.add(student)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if _is_duplicate_email(e):
+                raise DuplicateEmailError(f'Email "{normalize_email(email)}" is already registered.') from None
+            raise
         return student
     
     @staticmethod
+    @retry_on_lock
     def update_student(student_id, name, email):
         student = Student.query.get(student_id)
         if student:
             student.name = name
             student.email = email
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                if _is_duplicate_email(e):
+                    raise DuplicateEmailError(f'Email "{normalize_email(email)}" is already registered.') from None
+                raise
+            StudentService.get_cache().invalidate({student_id})
         return student
     
     @staticmethod
+    @retry_on_lock
     def delete_student(student_id):
         student = Student.query.get(student_id)
         if student:
             db.session.delete(student)
             db.session.commit()
+            StudentService.get_cache().invalidate({student_id})
+            notify_grades_changed({student_id})
             return True
         return False
     
     @staticmethod
-    def get_rankings():
-        students = Student.query.all()
+    def count_students(student_ids=None, created_before=None):
+        return _count_matching(Student, student_ids, created_before)
+    
+    @staticmethod
+    def bulk_delete_students(student_ids=None, created_before=None, chunk_size=500):
+        """Delete many students at once; their grades go via ON DELETE CASCADE.
+        
+        Returns a dict with the number of students and grades deleted.
+        """
+        def count_grades(selector):
+            return db.session.scalar(
+                select(func.count(Grade.id)).where(Grade.student_id.in_(selector))
+            )
+        
+        try:
+            students, grades = _bulk_delete(
+                Student, student_ids, created_before, chunk_size, count_dependents=count_grades
+            )
+        finally:
+            # Chunks commit one by one, so some may be gone even after an error.
+            StudentService.get_cache().invalidate(student_ids if created_before is None else None)
+        if grades:
+            notify_grades_changed(student_ids if created_before is None else None)
+        return {'students': students, 'grades': grades}
+    
+    @staticmethod
+    def get_rankings(term=None, student_ids=None, subject=None, min_grades=1, limit=None):
+        """Students ordered by average grade, limited to ``term`` if given.
+        
+        ``subject`` ranks by the grades of that subject only, ``min_grades``
+        leaves out students with fewer grades and ``limit`` returns only the
+        top rows, with the ``LIMIT`` applied by SQLite rather than in Python.
+        With ``student_ids`` only those students are aggregated, which is how
+        the leaderboard refreshes the entries a grade change touched.
+        """
+        snapshot = _snapshot_for(term) if student_ids is None else None
+        if snapshot is not None:
+            subject_id = None
+            if subject is not None:
+                subject_id = SubjectService.find_id(subject)
+                if subject_id is None:
+                    return []
+            return [
+                {
+                    'student': StudentSummary(student_id, *snapshot.students[student_id]),
+                    'average': average,
+                    'count': count
+                }
+                for student_id, average, count in snapshot.rankings(
+                    term.id if term else None, subject_id, min_grades, limit
+                )
+            ]
+        
+        grades, students, _ = _term_tables(term)
+        average = func.avg(grades.c.score).label('average')
+        count = func.count(grades.c.id).label('count')
+        stmt = select(
+            students.c.id,
+            students.c.name,
+            students.c.email,
+            average,
+            count
+        ).join_from(grades, students, grades.c.student_id == students.c.id)
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        if subject is not None:
+            subject_id = SubjectService.find_id(subject)
+            if subject_id is None:
+                return []
+            stmt = stmt.where(grades.c.subject_id == subject_id)
+        having = average > 0
+        if min_grades > 1:
+            having = and_(having, count >= min_grades)
+        stmt = stmt.group_by(students.c.id).having(having).order_by(average.desc(), students.c.id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        
+        if student_ids is None:
+            rows = _execute_for_term(term, stmt)
+        else:
+            rows = []
+            for chunk in _chunks(sorted(student_ids), MAX_IN_CHUNK):
+                rows.extend(_execute_for_term(term, stmt.where(grades.c.student_id.in_(chunk))))
+        
         rankings = []
-        for student in students:
-            avg = student.average_grade()
-            if avg > 0:
-                rankings.append({
-                    'student': student,
-                    'average': avg
-                })
-        rankings.sort(key=lambda x: x['average'], reverse=True)
+        for row in rows:
+            rankings.append({
+                'student': StudentSummary(row.id, row.name, row.email),
+                'average': row.average,
+                'count': row.count
+            })
         return rankings
 
 
+class RosterService:
+    """Reconcile the students table with a full roster from the registrar.
+    
+    Existing students are indexed by normalized email with one query, the
+    roster is streamed against that index, and the resulting inserts and
+    updates are written as chunked ``INSERT ... ON CONFLICT(email) DO UPDATE``
+    batches. Students missing from the roster are only deleted on request.
+    """
+    
+    @staticmethod
+    def read_roster(f):
+        """Yield ``(line_number, name, email)`` from a CSV with name and email columns."""
+        reader = csv.DictReader(f)
+        fields = {(field or '').strip().lower(): field for field in reader.fieldnames or []}
+        if 'name' not in fields or 'email' not in fields:
+            raise ValueError('Roster must have "name" and "email" columns.')
+        for row in reader:
+            yield reader.line_num, (row[fields['name']] or '').strip(), (row[fields['email']] or '').strip()
+    
+    @staticmethod
+    def diff(roster_rows, delete_missing=False):
+        """Compare roster rows with the database without changing anything.
+        
+        Returns a dict with ``inserts`` and ``updates`` (lists of dicts with
+        name and email), ``deletes`` (students not on the roster, only when
+        ``delete_missing``), the ``unchanged`` count and ``invalid`` rows.
+        """
+        existing = {}
+        for student_id, name, email in db.session.execute(
+            select(Student.id, Student.name, Student.email)
+        ):
+            existing.setdefault(normalize_email(email), (student_id, name, email))
+        
+        inserts = {}
+        updates = {}
+        seen = set()
+        unchanged = 0
+        invalid = []
+        for line, name, email in roster_rows:
+            key = normalize_email(email)
+            if not name or '@' not in key:
+                invalid.append({'line': line, 'name': name, 'email': email,
+                                'reason': 'missing name or email'})
+                continue
+            if key in seen:
+                invalid.append({'line': line, 'name': name, 'email': email,
+                                'reason': 'duplicate email'})
+                continue
+            seen.add(key)
+            
+            current = existing.get(key)
+            if current is None:
+                inserts[key] = {'name': name, 'email': key}
+            elif current[1] != name:
+                updates[key] = {'id': current[0], 'name': name, 'email': current[2], 'old_name': current[1]}
+            else:
+                unchanged += 1
+        
+        deletes = []
+        if delete_missing:
+            deletes = [
+                {'id': student_id, 'name': name, 'email': email}
+                for key, (student_id, name, email) in existing.items() if key not in seen
+            ]
+        
+        return {
+            'inserts': list(inserts.values()),
+            'updates': list(updates.values()),
+            'deletes': deletes,
+            'unchanged': unchanged,
+            'invalid': invalid
+        }
+    
+    @staticmethod
+    def apply(diff, chunk_size=500):
+        """Write a diff from ``diff()``.
+        
+        Each chunk commits on its own and is retried on lock errors.
+        """
+        stmt = sqlite_insert(Student)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Student.email],
+            set_={'name': stmt.excluded.name}
+        )
+        now = datetime.utcnow()
+        rows = [
+            {'name': row['name'], 'email': row['email'], 'created_at': now}
+            for row in diff['inserts'] + diff['updates']
+        ]
+        try:
+            for start in range(0, len(rows), chunk_size):
+                _execute_chunk(stmt, rows[start:start + chunk_size])
+        finally:
+            StudentService.get_cache().invalidate([row['id'] for row in diff['updates']])
+        
+        counts = {'inserted': len(diff['inserts']), 'updated': len(diff['updates']), 'deleted': 0, 'grades': 0}
+        if diff['deletes']:
+            deleted = StudentService.bulk_delete_students(
+                [row['id'] for row in diff['deletes']], chunk_size=chunk_size
+            )
+            counts['deleted'] = deleted['students']
+            counts['grades'] = deleted['grades']
+        return counts
+
+
+class SubjectCache:
+    """In-process interning table mapping subject keys to ids and ids to names.
+    
+    Subjects are only ever added, so entries stay valid for the lifetime of the
+    database. Ids created inside a transaction that is later rolled back are
+    evicted by the session listener below.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._names = {}
+    
+    def get_id(self, key):
+        return self._ids.get(key)
+    
+    def get_name(self, subject_id):
+        return self._names.get(subject_id)
+    
+    def add(self, subject_id, name, key):
+        with self._lock:
+            self._ids[key] = subject_id
+            self._names[subject_id] = name
+    
+    def discard(self, key):
+        with self._lock:
+            subject_id = self._ids.pop(key, None)
+            self._names.pop(subject_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+
+
+class SubjectService:
+    @staticmethod
+    def get_cache():
+        """The interning cache for the database the session is routed to."""
+        # Beginning the transaction checks the restore epoch first (see app.models).
+        db.session.connection()
+        caches = current_app.extensions.setdefault('subject_caches', {})
+        shard = current_shard()
+        cache = caches.get(shard)
+        if cache is None:
+            cache = caches.setdefault(shard, SubjectCache())
+        return cache
+    
+    @staticmethod
+    def get_all_subjects():
+        return Subject.query.order_by(Subject.name).all()
+    
+    @staticmethod
+    def resolve_id(name):
+        """Return the id of the subject called ``name``, creating it if needed."""
+        name = normalize_subject_name(name or '')
+        if not name:
+            raise ValueError('Subject name cannot be empty.')
+        key = subject_key(name)
+        cache = SubjectService.get_cache()
+        subject_id = cache.get_id(key)
+        if subject_id is not None:
+            return subject_id
+        
+        with db.session.no_autoflush:
+            subject = Subject.query.filter_by(key=key).first()
+        if subject is None:
+            subject = Subject(name=name, key=key)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(subject)
+            except IntegrityError:
+                # Another writer interned the same subject first.
+                subject = Subject.query.filter_by(key=key).one()
+            else:
+                db.session.info.setdefault('new_subject_keys', set()).add(key)
+        
+        cache.add(subject.id, subject.name, key)
+        return subject.id
+    
+    @staticmethod
+    def find_id(name):
+        """Return the id of an existing subject, or ``None``; never creates one."""
+        key = subject_key(name or '')
+        cache = SubjectService.get_cache()
+        subject_id = cache.get_id(key)
+        if subject_id is None:
+            subject = Subject.query.filter_by(key=key).first()
+            if subject is None:
+                return None
+            cache.add(subject.id, subject.name, key)
+            subject_id = subject.id
+        return subject_id
+    
+    @staticmethod
+    def get_name(subject_id):
+        cache = SubjectService.get_cache()
+        name = cache.get_name(subject_id)
+        if name is None:
+            subject = db.session.get(Subject, subject_id)
+            if subject is None:
+                return None
+            cache.add(subject.id, subject.name, subject.key)
+            name = subject.name
+        return name
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_new_subject_keys(session):
+    session.info.pop('new_subject_keys', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _evict_rolled_back_subjects(session):
+    keys = session.info.pop('new_subject_keys', None)
+    if keys and has_app_context():
+        # Not get_cache(), which would begin a new transaction.
+        cache = current_app.extensions.get('subject_caches', {}).get(current_shard())
+        for key in keys if cache is not None else ():
+            cache.discard(key)
+
+
 class GradeService:
     @staticmethod
     def get_grades_by_student(student_id):
         return Grade.query.filter_by(student_id=student_id).order_by(Grade.created_at.desc()).all()
     
     @staticmethod
-    def create_grade(student_id, subject, score):
-        grade = Grade(student_id=student_id, subject=subject, score=score)
+    def create_grade(student_id, subject, score, term=None):
+        """Record a grade in ``term``, or in the current term if not given."""
+        if term is None:
+            term = TermService.get_current_term()
+        if term is not None and term.is_archived:
+            raise ValueError(f'Term "{term.name}" is archived.')
+        term_id = term.id if term else None
+        try:
+            if current_app.config.get('GRADE_GROUP_COMMIT'):
+                return GradeService._create_grade_grouped(student_id, subject, score, term_id)
+            return GradeService._insert_grade(student_id, subject, score, term_id)
+        except IntegrityError:
+            db.session.rollback()
+            # The student may have been deleted by another process after the
+            # caller looked it up (possibly in the student cache).
+            if db.session.execute(select(Student.id).where(Student.id == student_id)).first() is None:
+                StudentService.get_cache().invalidate({student_id})
+                raise StudentNotFoundError(f'Student with ID {student_id} not found.') from None
+            raise
+    
+    @staticmethod
+    @retry_on_lock
+    def _insert_grade(student_id, subject, score, term_id):
+        grade = Grade(student_id=student_id, subject=subject, score=score, term_id=term_id)
         db.session.add(grade)
         db.session.commit()
+        notify_grades_changed({student_id})
         return grade
     
     @staticmethod
+    def _create_grade_grouped(student_id, subject, score, term_id):
+        """Insert through the group-commit writer and wait for the outcome."""
+        from app.group_commit import get_group_writer
+        
+        timeout = current_app.config['GRADE_GROUP_COMMIT_TIMEOUT']
+        # End our read transaction so it cannot hold up the writer's commit.
+        end_read_transaction()
+        future = get_group_writer().submit(student_id, subject, score, term_id, timeout=timeout)
+        return db.session.get(Grade, future.result(timeout=timeout))
+    
+    @staticmethod
+    @retry_on_lock
     def update_grade(grade_id, subject, score):
         grade = Grade.query.get(grade_id)
         if grade:
             grade.subject = subject
             grade.score = score
             db.session.commit()
+            notify_grades_changed({grade.student_id})
         return grade
     
     @staticmethod
+    @retry_on_lock
     def delete_grade(grade_id):
         grade = Grade.query.get(grade_id)
         if grade:
+            student_id = grade.student_id
             db.session.delete(grade)
             db.session.commit()
+            notify_grades_changed({student_id})
             return True
         return False
     
     @staticmethod
-    def get_grade_by_id(grade_id):
-        return Grade.query.get(grade_id)
+    def get_all_grades(student='lazy'):
+        """All grades, loading ``Grade.student`` with ``student`` (see ``GRADE_LOADING``)."""
+        return Grade.query.options(*_loading(Grade.student, student)).order_by(Grade.id).all()
+    
+    @staticmethod
+    def get_grade_by_id(grade_id, student='lazy'):
+        return db.session.get(Grade, grade_id, options=_loading(Grade.student, student))
+    
+    #: Fields ``lookup_grades`` can return; ``student`` and ``term`` are names.
+    LOOKUP_FIELDS = ('id', 'student_id', 'student', 'subject', 'score', 'term', 'created_at')
+    DEFAULT_LOOKUP_FIELDS = ('id', 'student_id', 'subject', 'score', 'created_at')
+    
+    @staticmethod
+    def lookup_grades(grade_ids, fields=None):
+        """Read the chosen ``fields`` of many grades at once.
+        
+        Like ``StudentService.lookup_students``: one ``IN`` query per chunk
+        of IDs, joining students or terms only when their names are asked
+        for. Returns ``(records, missing_ids)``.
+        """
+        fields = _lookup_fields(fields, GradeService.LOOKUP_FIELDS, GradeService.DEFAULT_LOOKUP_FIELDS)
+        columns = {
+            'id': Grade.id,
+            'student_id': Grade.student_id,
+            'student': Student.name.label('student'),
+            'subject': Grade.subject_id.label('subject'),
+            'score': Grade.score,
+            'term': Term.name.label('term'),
+            'created_at': Grade.created_at
+        }
+        base = select(*(columns[field] for field in fields))
+        if 'student' in fields:
+            base = base.join(Student, Student.id == Grade.student_id)
+        if 'term' in fields:
+            base = base.outerjoin(Term, Term.id == Grade.term_id)
+        
+        found = {}
+        for chunk in _chunks(grade_ids, MAX_IN_CHUNK):
+            for row in db.session.execute(base.where(Grade.id.in_(chunk))):
+                record = dict(row._mapping)
+                if 'subject' in record:
+                    record['subject'] = SubjectService.get_name(record['subject'])
+                if record.get('created_at') is not None:
+                    record['created_at'] = record['created_at'].isoformat()
+                found[record['id']] = record
+        return _in_request_order(grade_ids, found)
+    
+    @staticmethod
+    def count_grades(grade_ids=None, created_before=None):
+        return _count_matching(Grade, grade_ids, created_before)
+    
+    @staticmethod
+    def bulk_delete_grades(grade_ids=None, created_before=None, chunk_size=500):
+        """Delete many grades at once. Returns the number deleted."""
+        deleted, _ = _bulk_delete(Grade, grade_ids, created_before, chunk_size)
+        if deleted:
+            notify_grades_changed()
+        return deleted
+    
+    @staticmethod
+    def get_subject_stats(term=None):
+        """Per-subject count, average, minimum and maximum score."""
+        snapshot = _snapshot_for(term)
+        if snapshot is not None:
+            return [
+                {'subject': name, 'count': count, 'average': average, 'min': minimum, 'max': maximum}
+                for name, count, average, minimum, maximum in snapshot.subject_stats(term.id if term else None)
+            ]
+        
+        grades, _, subjects = _term_tables(term)
+        stmt = select(
+            subjects.c.name,
+            func.count(grades.c.id),
+            func.avg(grades.c.score),
+            func.min(grades.c.score),
+            func.max(grades.c.score)
+        ).join_from(grades, subjects, grades.c.subject_id == subjects.c.id)
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        stmt = stmt.group_by(grades.c.subject_id)
+        
+        stats = []
+        for name, count, average, minimum, maximum in _execute_for_term(term, stmt):
+            stats.append({
+                'subject': name,
+                'count': count,
+                'average': average,
+                'min': minimum,
+                'max': maximum
+            })
+        stats.sort(key=lambda x: x['subject'].casefold())
+        return stats
+
+
+class CurveService:
+    """Adjust every grade of a subject with one set-based ``UPDATE``.
+    
+    Methods: ``add`` shifts scores by ``value``, ``multiply`` scales them by
+    ``value`` and ``mean`` scales them so the current mean becomes ``value``.
+    Results are clamped to the 0-100 range accepted by ``GradeForm``.
+    """
+    METHODS = ('add', 'multiply', 'mean')
+    MIN_SCORE = 0.0
+    MAX_SCORE = 100.0
+    
+    @staticmethod
+    def _filters(subject_id, start=None, end=None):
+        filters = [Grade.subject_id == subject_id]
+        if start is not None:
+            filters.append(Grade.created_at >= datetime.combine(start, time.min))
+        if end is not None:
+            filters.append(Grade.created_at < datetime.combine(end + timedelta(days=1), time.min))
+        return filters
+    
+    @staticmethod
+    def _raw_score(method, value, current_mean):
+        if method == 'add':
+            return Grade.score + value
+        if method == 'multiply':
+            return Grade.score * value
+        if not current_mean:
+            raise ValueError('Cannot rescale grades whose mean is zero.')
+        return Grade.score * (value / current_mean)
+    
+    @staticmethod
+    def _clamped(raw):
+        return func.min(CurveService.MAX_SCORE, func.max(CurveService.MIN_SCORE, raw))
+    
+    @staticmethod
+    def curve(subject, method, value, start=None, end=None, dry_run=False):
+        """Preview or apply a curve.
+        
+        Returns a dict with the number of grades matched, the mean/min/max
+        before and after, and how many results were clamped. The preview is
+        computed with aggregates only; with ``dry_run=False`` the grades are
+        then updated by a single ``UPDATE`` statement. Only applying takes the
+        write lock, so a preview never blocks (or waits for) other writers.
+        """
+        if dry_run:
+            return CurveService._curve(subject, method, value, start, end, apply=False)
+        return CurveService._apply_curve(subject, method, value, start, end)
+    
+    @staticmethod
+    @retry_on_lock
+    def _apply_curve(subject, method, value, start, end):
+        return CurveService._curve(subject, method, value, start, end, apply=True)
+    
+    @staticmethod
+    def _curve(subject, method, value, start, end, apply):
+        if method not in CurveService.METHODS:
+            raise ValueError(f'Unknown curve method "{method}".')
+        if method == 'multiply' and value < 0:
+            raise ValueError('The multiplier must not be negative.')
+        if method == 'mean' and not CurveService.MIN_SCORE <= value <= CurveService.MAX_SCORE:
+            raise ValueError('The target mean must be between 0 and 100.')
+        
+        subject_id = SubjectService.find_id(subject)
+        if subject_id is None:
+            raise ValueError(f'Subject "{subject}" not found.')
+        filters = CurveService._filters(subject_id, start, end)
+        
+        current_mean = None
+        if method == 'mean':
+            current_mean = db.session.scalar(select(func.avg(Grade.score)).where(*filters))
+        raw = CurveService._raw_score(method, value, current_mean)
+        new_score = CurveService._clamped(raw)
+        
+        row = db.session.execute(select(
+            func.count(Grade.id),
+            func.avg(Grade.score),
+            func.min(Grade.score),
+            func.max(Grade.score),
+            func.avg(new_score),
+            func.min(new_score),
+            func.max(new_score),
+            func.coalesce(func.sum(case(
+                (or_(raw < CurveService.MIN_SCORE, raw > CurveService.MAX_SCORE), 1), else_=0
+            )), 0)
+        ).where(*filters)).one()
+        
+        preview = {
+            'subject': SubjectService.get_name(subject_id),
+            'count': row[0],
+            'before': {'mean': row[1], 'min': row[2], 'max': row[3]},
+            'after': {'mean': row[4], 'min': row[5], 'max': row[6]},
+            'clamped': row[7],
+            'applied': False
+        }
+        if not apply or preview['count'] == 0:
+            return preview
+        
+        try:
+            db.session.execute(
+                update(Grade).where(*filters).values(score=new_score),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        notify_grades_changed()
+        preview['applied'] = True
+        return preview
+
+
+class TermService:
+    @staticmethod
+    def get_all_terms():
+        return Term.query.order_by(Term.start_date).all()
+    
+    @staticmethod
+    def get_term_by_name(name):
+        return Term.query.filter_by(name=name).first()
+    
+    @staticmethod
+    @retry_on_lock
+    def create_term(name, start_date, end_date):
+        if end_date < start_date:
+            raise ValueError('Term end date must not be before its start date.')
+        term = Term(name=name, start_date=start_date, end_date=end_date)
+        db.session.add(term)
+        db.session.commit()
+        return term
+    
+    @staticmethod
+    def get_current_term(today=None):
+        """The term whose date range contains ``today``, if any."""
+        today = today or date.today()
+        return Term.query.filter(
+            Term.start_date <= today,
+            Term.end_date >= today
+        ).order_by(Term.start_date.desc()).first()
+    
+    @staticmethod
+    def resolve_term(name=None):
+        """Map a user-supplied term name to a ``Term``.
+        
+        No name selects the current term; ``"all"`` (or no current term)
+        selects every grade and returns ``None``.
+        """
+        if not name:
+            return TermService.get_current_term()
+        if name == 'all':
+            return None
+        term = TermService.get_term_by_name(name)
+        if term is None:
+            raise ValueError(f'Term "{name}" not found.')
+        return term
 
 
 class ExportService:
+    STUDENT_HEADERS = ['ID', 'Name', 'Email', 'Average Grade', 'Number of Grades']
+    GRADE_HEADERS = ['Grade ID', 'Student Name', 'Subject', 'Score', 'Date']
+    PIVOT_AGGREGATES = ('latest', 'mean', 'max')
+    
     @staticmethod
-    def export_students_to_csv():
+    def get_student_rows(term=None):
+        """Student export rows ordered by name."""
+        snapshot = _snapshot_for(term)
+        if snapshot is not None:
+            return [
+                (student_id, name, email, round(average, 2), count)
+                for student_id, name, email, average, count in snapshot.student_rows(term.id if term else None)
+            ]
+        
+        grades, students, _ = _term_tables(term)
+        join_on = grades.c.student_id == students.c.id
+        if term is not None:
+            join_on = and_(join_on, grades.c.term_id == term.id)
+        stmt = select(
+            students.c.id,
+            students.c.name,
+            students.c.email,
+            func.coalesce(func.avg(grades.c.score), 0.0),
+            func.count(grades.c.id)
+        ).select_from(students).outerjoin(grades, join_on).group_by(
+            students.c.id
+        ).order_by(students.c.name, students.c.id)
+        
+        return [
+            (student_id, name, email, round(average, 2), count)
+            for student_id, name, email, average, count in _execute_for_term(term, stmt)
+        ]
+    
+    @staticmethod
+    def get_grade_rows(term=None):
+        """Grade export rows ordered by student name, then date."""
+        snapshot = _snapshot_for(term)
+        if snapshot is not None:
+            return [
+                (grade_id, student_name, subject, score, created_at.strftime('%Y-%m-%d %H:%M:%S'))
+                for grade_id, student_name, subject, score, created_at in snapshot.grade_rows(term.id if term else None)
+            ]
+        
+        grades, students, subjects = _term_tables(term)
+        stmt = select(
+            grades.c.id,
+            students.c.name,
+            subjects.c.name,
+            grades.c.score,
+            grades.c.created_at
+        ).join_from(
+            grades, students, grades.c.student_id == students.c.id
+        ).join(
+            subjects, grades.c.subject_id == subjects.c.id
+        ).order_by(students.c.name, grades.c.created_at)
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        
+        return [
+            (grade_id, student_name, subject, score, created_at.strftime('%Y-%m-%d %H:%M:%S'))
+            for grade_id, student_name, subject, score, created_at in _execute_for_term(term, stmt)
+        ]
+    
+    @staticmethod
+    def _to_csv(headers, rows):
         output = StringIO()
         writer = csv.writer(output)
-        writer.writerow(['ID', 'Name', 'Email', 'Average Grade', 'Number of Grades'])
-        
-        students = Student.query.all()
-        for student in students:
-            writer.writerow([
-                student.id,
-                student.name,
-                student.email,
-                round(student.average_grade(), 2),
-                len(student.grades)
-            ])
-        
+        writer.writerow(headers)
+        writer.writerows(rows)
         return output.getvalue()
     
     @staticmethod
-    def export_grades_to_csv():
+    def export_students_to_csv(term=None):
+        return ExportService._to_csv(ExportService.STUDENT_HEADERS, ExportService.get_student_rows(term))
+    
+    @staticmethod
+    def export_grades_to_csv(term=None):
+        return ExportService._to_csv(ExportService.GRADE_HEADERS, ExportService.get_grade_rows(term))
+    
+    @staticmethod
+    def pivot(term=None, aggregate='latest'):
+        """A student × subject matrix of ``aggregate`` scores.
+
+        Returns ``(headers, rows)``: ``ID``, ``Name``, ``Email`` and one column
+        per subject that has grades, then a lazy iterator with one row per
+        student with grades, ordered by name. Cells without grades are blank.
+        The aggregation is grouped in SQL (or over the columnar snapshot) and
+        only existing student/subject pairs are read, so the matrix is never
+        materialized.
+        """
+        if aggregate not in ExportService.PIVOT_AGGREGATES:
+            raise ValueError(
+                f'Unknown aggregate "{aggregate}" (choose from {", ".join(ExportService.PIVOT_AGGREGATES)}).'
+            )
+        
+        snapshot = _snapshot_for(term)
+        if snapshot is not None:
+            cells = snapshot.pivot_cells(aggregate, term.id if term else None)
+            by_student = {}
+            for (student_id, subject_id), value in cells.items():
+                by_student.setdefault(student_id, []).append((subject_id, value))
+            subjects = sorted(
+                {subject_id for _, subject_id in cells},
+                key=lambda subject_id: snapshot.subjects.get(subject_id, '').casefold()
+            )
+            triples = (
+                (student_id, name, email, subject_id, value)
+                for student_id, (name, email) in sorted(
+                    snapshot.students.items(), key=lambda item: (item[1][0], item[0])
+                )
+                for subject_id, value in by_student.get(student_id, ())
+            )
+            names = [snapshot.subjects.get(subject_id, '') for subject_id in subjects]
+        else:
+            grades, students, subject_table = _term_tables(term)
+            filters = [grades.c.term_id == term.id] if term is not None else []
+            present = select(grades.c.subject_id).where(*filters).distinct()
+            subject_rows = _execute_for_term(term, select(
+                subject_table.c.id, subject_table.c.name
+            ).where(subject_table.c.id.in_(present)))
+            subject_rows.sort(key=lambda row: row[1].casefold())
+            subjects = [subject_id for subject_id, _ in subject_rows]
+            names = [name for _, name in subject_rows]
+            
+            if aggregate == 'latest':
+                ranked = select(
+                    grades.c.student_id,
+                    grades.c.subject_id,
+                    grades.c.score.label('value'),
+                    func.row_number().over(
+                        partition_by=(grades.c.student_id, grades.c.subject_id),
+                        order_by=(grades.c.created_at.desc(), grades.c.id.desc())
+                    ).label('position')
+                ).where(*filters).subquery()
+                cells = select(ranked.c.student_id, ranked.c.subject_id, ranked.c.value).where(
+                    ranked.c.position == 1
+                ).subquery()
+            else:
+                value = func.avg(grades.c.score) if aggregate == 'mean' else func.max(grades.c.score)
+                cells = select(grades.c.student_id, grades.c.subject_id, value.label('value')).where(
+                    *filters
+                ).group_by(grades.c.student_id, grades.c.subject_id).subquery()
+            triples = _stream_for_term(term, select(
+                students.c.id, students.c.name, students.c.email, cells.c.subject_id, cells.c.value
+            ).join_from(cells, students, cells.c.student_id == students.c.id).order_by(
+                students.c.name, students.c.id
+            ))
+        
+        headers = ['ID', 'Name', 'Email'] + names
+        columns = {subject_id: index for index, subject_id in enumerate(subjects, 3)}
+        
+        def rows():
+            for (student_id, name, email), student_cells in groupby(triples, key=lambda row: row[:3]):
+                row = [student_id, name, email] + [''] * len(columns)
+                for *_, subject_id, value in student_cells:
+                    row[columns[subject_id]] = round(value, 2)
+                yield row
+        
+        return headers, rows()
+    
+    @staticmethod
+    def iter_csv(headers, rows, batch_size=500):
+        """Yield CSV text in chunks of ``batch_size`` rows, for streaming responses."""
         output = StringIO()
         writer = csv.writer(output)
-        writer.writerow(['Grade ID', 'Student Name', 'Subject', 'Score', 'Date'])
-        
-        grades = Grade.query.join(Student).order_by(Student.name, Grade.created_at).all()
-        for grade in grades:
-            writer.writerow([
-                grade.id,
-                grade.student.name,
-                grade.subject,
-                grade.score,
-                grade.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            ])
+        writer.writerow(headers)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % batch_size == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+        yield output.getvalue()
+
+
+GradeTrend = namedtuple('GradeTrend', ['running_average', 'moving_average', 'slope'])
+
+
+class TrendService:
+    #: Grades in the moving average.
+    WINDOW = 5
+    #: Slopes are reported in points per this many days.
+    SLOPE_DAYS = 30
+    #: No slope is reported until the grades' dates spread at least this many
+    #: days (standard deviation); a line through grades given minutes apart
+    #: says nothing about a trend.
+    MIN_SPREAD_DAYS = 1.0
+    AT_RISK_AVERAGE = 60.0
+    AT_RISK_SLOPE = -5.0
+    AT_RISK_MIN_GRADES = 3
+    
+    @staticmethod
+    def slope(n, sum_x, sum_y, sum_xx, sum_xy):
+        """Least-squares slope in points per ``SLOPE_DAYS``, or ``None``."""
+        if n < 2:
+            return None
+        variance = sum_xx / n - (sum_x / n) ** 2
+        if variance < TrendService.MIN_SPREAD_DAYS ** 2:
+            return None
+        return (sum_xy / n - sum_x * sum_y / n ** 2) / variance * TrendService.SLOPE_DAYS
+    
+    @staticmethod
+    def get_grade_trends(student_id, term=None, window=None):
+        """``{grade_id: GradeTrend}`` for a student's grades, in date order.
         
-        return output.getvalue()
+        Each grade gets the running average of the grades up to it, the
+        moving average of the last ``window`` grades and the slope of all
+        grades so far, computed in one query with SQL window functions.
+        """
+        window = window or TrendService.WINDOW
+        grades, _, _ = _term_tables(term)
+        x = func.julianday(grades.c.created_at) - TREND_EPOCH
+        order = (grades.c.created_at, grades.c.id)
+        so_far = {'order_by': order, 'rows': (None, 0)}
+        stmt = select(
+            grades.c.id,
+            func.count().over(**so_far),
+            func.sum(x).over(**so_far),
+            func.sum(grades.c.score).over(**so_far),
+            func.sum(x * x).over(**so_far),
+            func.sum(x * grades.c.score).over(**so_far),
+            func.avg(grades.c.score).over(order_by=order, rows=(-(window - 1), 0))
+        ).where(grades.c.student_id == student_id)
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        
+        return {
+            grade_id: GradeTrend(sum_y / n, moving, TrendService.slope(n, sum_x, sum_y, sum_xx, sum_xy))
+            for grade_id, n, sum_x, sum_y, sum_xx, sum_xy, moving in _execute_for_term(term, stmt)
+        }
+    
+    @staticmethod
+    def _sums(term=None, student_id=None):
+        """``(student_id, n, sum_x, sum_y, sum_xx, sum_xy)`` per student.
+        
+        Read from the trigger-maintained ``student_trends`` table; archived
+        terms have no maintained sums and are aggregated from their grades.
+        """
+        if term is not None and term.is_archived:
+            grades, _, _ = _term_tables(term)
+            x = func.julianday(grades.c.created_at) - TREND_EPOCH
+            stmt = select(
+                grades.c.student_id, func.count(), func.sum(x), func.sum(grades.c.score),
+                func.sum(x * x), func.sum(x * grades.c.score)
+            ).where(grades.c.term_id == term.id).group_by(grades.c.student_id)
+            if student_id is not None:
+                stmt = stmt.where(grades.c.student_id == student_id)
+            return _execute_for_term(term, stmt)
+        
+        t = student_trends.c
+        stmt = select(
+            t.student_id, func.sum(t.n), func.sum(t.sum_x), func.sum(t.sum_y),
+            func.sum(t.sum_xx), func.sum(t.sum_xy)
+        ).group_by(t.student_id)
+        if term is not None:
+            stmt = stmt.where(t.term_key == term.id)
+        if student_id is not None:
+            stmt = stmt.where(t.student_id == student_id)
+        return db.session.execute(stmt).all()
+    
+    @staticmethod
+    def get_student_trend(student_id, term=None):
+        """``{'average', 'count', 'slope'}`` of a student, or ``None`` without grades."""
+        for _, n, sum_x, sum_y, sum_xx, sum_xy in TrendService._sums(term, student_id):
+            return {
+                'average': sum_y / n,
+                'count': n,
+                'slope': TrendService.slope(n, sum_x, sum_y, sum_xx, sum_xy)
+            }
+        return None
+    
+    @staticmethod
+    def get_at_risk(term=None, max_average=None, max_slope=None, min_grades=None):
+        """Students averaging below ``max_average`` or trending down faster than ``max_slope``.
+        
+        Works from the per-student sums in one pass over ``student_trends``,
+        whatever the number of grades. Students with fewer than
+        ``min_grades`` grades are left out. Returns dicts with ``student``,
+        ``average``, ``count``, ``slope`` and ``reasons``, lowest average first.
+        """
+        max_average = TrendService.AT_RISK_AVERAGE if max_average is None else max_average
+        max_slope = TrendService.AT_RISK_SLOPE if max_slope is None else max_slope
+        min_grades = TrendService.AT_RISK_MIN_GRADES if min_grades is None else min_grades
+        
+        flagged = {}
+        for student_id, n, sum_x, sum_y, sum_xx, sum_xy in TrendService._sums(term):
+            if n < min_grades:
+                continue
+            average = sum_y / n
+            slope = TrendService.slope(n, sum_x, sum_y, sum_xx, sum_xy)
+            reasons = []
+            if average < max_average:
+                reasons.append(f'average below {max_average:g}')
+            if slope is not None and slope < max_slope:
+                reasons.append(f'falling {-slope:.1f} points per {TrendService.SLOPE_DAYS} days')
+            if reasons:
+                flagged[student_id] = {'average': average, 'count': n, 'slope': slope, 'reasons': reasons}
+        
+        students = {}
+        for chunk in _chunks(flagged, MAX_IN_CHUNK):
+            for row in db.session.execute(
+                select(Student.id, Student.name, Student.email).where(Student.id.in_(chunk))
+            ):
+                students[row.id] = StudentSummary(*row)
+        report = [
+            dict(item, student=students[student_id])
+            for student_id, item in flagged.items() if student_id in students
+        ]
+        report.sort(key=lambda item: (item['average'], item['student'].id))
+        return report
+
+
+class ReportCardService:
+    @staticmethod
+    def count_students(term=None):
+        """Number of students with grades in ``term``."""
+        grades, _, _ = _term_tables(term)
+        stmt = select(func.count(func.distinct(grades.c.student_id)))
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        return _execute_for_term(term, stmt)[0][0]
+    
+    @staticmethod
+    def iter_report_cards(term=None):
+        """Yield a report card context per student with grades, by student id.
+        
+        Every grade is read by a single query ordered by student, so each card
+        is complete as soon as the next student's rows begin. Cards are plain
+        dicts, so they can be handed to other processes.
+        """
+        grades, students, subjects = _term_tables(term)
+        stmt = select(
+            students.c.id,
+            students.c.name,
+            students.c.email,
+            subjects.c.name,
+            grades.c.score,
+            grades.c.created_at
+        ).join_from(
+            grades, students, grades.c.student_id == students.c.id
+        ).join(
+            subjects, grades.c.subject_id == subjects.c.id
+        ).order_by(students.c.id, grades.c.created_at, grades.c.id)
+        if term is not None:
+            stmt = stmt.where(grades.c.term_id == term.id)
+        
+        for (student_id, name, email), rows in groupby(_stream_for_term(term, stmt), key=lambda row: row[:3]):
+            card_grades = [
+                {'subject': subject, 'score': score, 'date': created_at}
+                for *_, subject, score, created_at in rows
+            ]
+            by_subject = {}
+            for grade in card_grades:
+                by_subject.setdefault(grade['subject'], []).append(grade['score'])
+            yield {
+                'student': {'id': student_id, 'name': name, 'email': email},
+                'term': term.name if term is not None else None,
+                'grades': card_grades,
+                'subjects': [
+                    {'name': subject, 'count': len(scores), 'average': sum(scores) / len(scores)}
+                    for subject, scores in sorted(by_subject.items(), key=lambda item: item[0].casefold())
+                ],
+                'average': sum(grade['score'] for grade in card_grades) / len(card_grades),
+            }
+
+
+class DistrictService:
+    """Read-only reports federated across every configured school shard.
+    
+    Each shard returns its rows already sorted, so the district-wide order is
+    produced by ``heapq.merge`` in O(n log k) for k schools instead of
+    concatenating and re-sorting everything.
+    """
+    
+    @staticmethod
+    def _run(func, term_name):
+        def on_shard():
+            return func(TermService.resolve_term(term_name))
+        return run_on_shards(on_shard)
+    
+    @staticmethod
+    def get_rankings(term_name=None, subject=None, min_grades=1, limit=None):
+        per_shard = DistrictService._run(
+            lambda term: StudentService.get_rankings(
+                term=term, subject=subject, min_grades=min_grades, limit=limit
+            ),
+            term_name
+        )
+        streams = [
+            [dict(item, school=school) for item in rankings]
+            for school, rankings in per_shard.items()
+        ]
+        if limit is not None:
+            # Each school sent at most its own top ``limit``; keep the best of those.
+            return heapq.nlargest(limit, chain.from_iterable(streams), key=lambda x: x['average'])
+        return list(heapq.merge(*streams, key=lambda x: -x['average']))
+    
+    @staticmethod
+    def get_subject_stats(term_name=None):
+        per_shard = DistrictService._run(
+            lambda term: GradeService.get_subject_stats(term=term), term_name
+        )
+        
+        def subject_order(item):
+            return item['subject'].casefold()
+        
+        stats = []
+        merged = heapq.merge(*per_shard.values(), key=subject_order)
+        for _, group in groupby(merged, key=subject_order):
+            group = list(group)
+            count = sum(item['count'] for item in group)
+            stats.append({
+                'subject': group[0]['subject'],
+                'count': count,
+                'average': sum(item['average'] * item['count'] for item in group) / count,
+                'min': min(item['min'] for item in group),
+                'max': max(item['max'] for item in group)
+            })
+        return stats
+    
+    @staticmethod
+    def _export(headers, get_rows, sort_key, term_name):
+        per_shard = DistrictService._run(get_rows, term_name)
+        streams = [
+            [(school,) + row for row in rows]
+            for school, rows in per_shard.items()
+        ]
+        return ExportService._to_csv(['School'] + headers, heapq.merge(*streams, key=sort_key))
+    
+    @staticmethod
+    def export_students_to_csv(term_name=None):
+        return DistrictService._export(
+            ExportService.STUDENT_HEADERS,
+            ExportService.get_student_rows,
+            lambda row: (row[2], row[1]),
+            term_name
+        )
+    
+    @staticmethod
+    def export_grades_to_csv(term_name=None):
+        return DistrictService._export(
+            ExportService.GRADE_HEADERS,
+            ExportService.get_grade_rows,
+            lambda row: (row[2], row[5]),
+            term_name
+        )
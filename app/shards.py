@@ -0,0 +1,84 @@
+"""One SQLite file per school, with routing and parallel fan-out.
+
+A shard registry maps school names to database files. Each school gets its own
+engine; ``g.shard`` selects which one ``db.session`` talks to for the current
+request or CLI call. District-wide reads run the same service call on every
+shard in its own thread and app context, and the sorted per-shard results are
+combined with a k-way merge.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+
+def load_shard_registry(path):
+    """Read a JSON object mapping school names to database files.
+
+    Relative database paths are resolved against the registry's directory.
+    """
+    with open(path) as f:
+        registry = json.load(f)
+    if not isinstance(registry, dict) or not registry:
+        raise ValueError(f'Shard registry "{path}" must be a non-empty JSON object.')
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return {
+        str(name): os.path.join(base_dir, db_path)
+        for name, db_path in registry.items()
+    }
+
+
+def create_shard_engines(shards, busy_timeout=5):
+    return {
+        name: create_engine(f'sqlite:///{db_path}', connect_args={'timeout': busy_timeout})
+        for name, db_path in shards.items()
+    }
+
+
+def get_shard_engines():
+    return current_app.extensions.get('shard_engines') or {}
+
+
+def get_shard_names():
+    return list(current_app.config.get('SHARDS') or {})
+
+
+def current_shard():
+    """The school the current app context is routed to, if any."""
+    if has_app_context():
+        return g.get('shard')
+    return None
+
+
+class ShardRoutingSession(Session):
+    """Session that sends every query to the shard selected by ``g.shard``."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = current_shard() if bind is None else None
+        if shard is not None:
+            return get_shard_engines()[shard]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def run_on_shards(func, shards=None, max_workers=None):
+    """Call ``func()`` once per shard in parallel and return ``{shard: result}``.
+
+    Every call runs in its own thread with a fresh app context routed to that
+    shard, so each gets its own session and connection. SQLite releases the
+    GIL while it executes a query, so the shards are scanned concurrently.
+    """
+    app = current_app._get_current_object()
+    names = list(shards or get_shard_names())
+    if not names:
+        raise ValueError('No shards are configured.')
+
+    def run(name):
+        with app.app_context():
+            g.shard = name
+            return func()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(names)) as pool:
+        return dict(zip(names, pool.map(run, names)))
@@ -0,0 +1,27 @@
+"""Signals sent after grade data has been committed.
+
+Anything derived from grades (rankings, leaderboards, live views) subscribes
+to ``grades_changed`` and invalidates or refreshes itself, instead of every
+writer having to know about every cache.
+"""
+from blinker import Namespace
+from flask import current_app
+from app.shards import current_shard
+
+_signals = Namespace()
+
+#: Sent with ``student_ids`` (a frozenset of affected students, or ``None``
+#: when any student may be affected) and ``shard`` (the routed school, if any).
+grades_changed = _signals.signal('grades-changed')
+
+#: Sent with ``shard`` once the leaderboards have applied a ``grades_changed``,
+#: so views derived from them read the new order.
+rankings_changed = _signals.signal('rankings-changed')
+
+
+def notify_grades_changed(student_ids=None):
+    grades_changed.send(
+        current_app._get_current_object(),
+        student_ids=None if student_ids is None else frozenset(student_ids),
+        shard=current_shard()
+    )
@@ -0,0 +1,614 @@
+"""Read-only columnar snapshot of the grades table for analytics.
+
+Rankings, statistics and exports only need five numbers per grade. Loading
+them as ORM objects costs an object, an identity-map entry and a dict per
+row; the snapshot keeps them instead in typed ``array`` columns (8 bytes per
+value) plus small id-to-name tables for students and subjects. It is built
+by streaming raw cursor rows and then kept current from the change log: when
+the data version moves, only the grades and students logged since the
+snapshot's version are re-read.
+
+A published snapshot is never changed, because request threads reduce over
+its arrays (NumPy views them without copying) after they got it. A refresh
+copies the columns, applies the changes to the copy and publishes that in
+its place; threads still holding the old one finish on it undisturbed.
+Building and refreshing happen outside any process-wide lock, so no thread
+waits for another's database reads; the newest snapshot wins.
+
+When NumPy is installed the aggregations run vectorized over the same
+buffers without copying them; otherwise they are plain loops over the arrays.
+
+A snapshot can also be written to a binary file (``snapshot build``) that
+other processes map read-only: the columns are used in place through
+``memoryview`` casts, so loading costs no parsing and every worker shares the
+same page-cache pages. A mapped snapshot is used only while its data version
+matches the database; once stale it is copied into memory and refreshed.
+"""
+import heapq
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import text
+from app.models import db
+from app.shards import current_shard
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1)
+# Student id of a deleted row, until the next compaction.
+DELETED = -1
+# Changed ids are re-read in chunks below SQLite's host-parameter limit.
+CHUNK = 900
+
+
+def to_micros(value):
+    """Microseconds since the epoch for a datetime or SQLite timestamp string."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def data_version(connection):
+    """The id of the newest change-log entry, or 0 for an empty log."""
+    return connection.execute(text('SELECT coalesce(max(id), 0) FROM change_log')).scalar()
+
+
+def changes_since(connection, version, latest):
+    """``(table_name, row_id)`` pairs logged after ``version`` up to ``latest``.
+
+    Returns ``None`` when the log no longer reaches back to ``version`` (it
+    was pruned, or the data version went backwards), in which case whatever
+    was built at ``version`` has to be rebuilt from scratch.
+    """
+    if latest < version:
+        return None
+    if latest == version:
+        return []
+    oldest = connection.execute(text(
+        'SELECT min(id) FROM change_log WHERE id > :version'
+    ), {'version': version}).scalar()
+    if oldest is None or oldest != version + 1:
+        return None
+    return connection.execute(text(
+        'SELECT DISTINCT table_name, row_id FROM change_log WHERE id > :version AND id <= :latest'
+    ), {'version': version, 'latest': latest}).all()
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK):
+        yield ids[start:start + CHUNK]
+
+
+class GradeSnapshot:
+    """Parallel arrays of every grade, ordered by grade id."""
+
+    COLUMNS = ('ids', 'student_ids', 'subject_ids', 'term_ids', 'scores', 'created')
+    # Grades without a term are stored under term 0; real term ids start at 1.
+    GRADE_QUERY = (
+        'SELECT id, student_id, subject_id, coalesce(term_id, 0), score, created_at FROM grades'
+    )
+
+    def __init__(self):
+        self.version = 0
+        self.ids = array('q')
+        self.student_ids = array('q')
+        self.subject_ids = array('q')
+        self.term_ids = array('q')
+        self.scores = array('d')
+        self.created = array('q')
+        self.students = {}
+        self.subjects = {}
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.ids) - self.deleted
+
+    @property
+    def nbytes(self):
+        """Bytes held by the grade columns."""
+        return sum(column.itemsize * len(column) for column in self._columns())
+
+    def _columns(self):
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    @classmethod
+    def build(cls, connection):
+        snapshot = cls()
+        snapshot.version = data_version(connection)
+        append = snapshot._append
+        for row in connection.exec_driver_sql(f'{cls.GRADE_QUERY} ORDER BY id'):
+            append(row)
+        snapshot._load_students(connection)
+        snapshot._load_subjects(connection)
+        return snapshot
+
+    def _append(self, row):
+        grade_id, student_id, subject_id, term_id, score, created_at = row
+        self.ids.append(grade_id)
+        self.student_ids.append(student_id)
+        self.subject_ids.append(subject_id)
+        self.term_ids.append(term_id)
+        self.scores.append(score)
+        self.created.append(to_micros(created_at))
+
+    def _load_students(self, connection, student_ids=None):
+        if student_ids is None:
+            rows = connection.exec_driver_sql('SELECT id, name, email FROM students')
+            self.students = {student_id: (name, email) for student_id, name, email in rows}
+            return
+        for chunk in _chunks(student_ids):
+            found = set()
+            rows = connection.exec_driver_sql(
+                f'SELECT id, name, email FROM students WHERE id IN ({",".join("?" * len(chunk))})',
+                tuple(chunk)
+            )
+            for student_id, name, email in rows:
+                self.students[student_id] = (name, email)
+                found.add(student_id)
+            for student_id in set(chunk) - found:
+                self.students.pop(student_id, None)
+
+    def _load_subjects(self, connection):
+        self.subjects = dict(connection.exec_driver_sql('SELECT id, name FROM subjects').all())
+
+    def _position(self, grade_id):
+        position = bisect_left(self.ids, grade_id)
+        if position < len(self.ids) and self.ids[position] == grade_id:
+            return position
+        return None
+
+    def _set(self, position, row):
+        grade_id, student_id, subject_id, term_id, score, created_at = row
+        if self.student_ids[position] == DELETED:
+            self.deleted -= 1
+        self.student_ids[position] = student_id
+        self.subject_ids[position] = subject_id
+        self.term_ids[position] = term_id
+        self.scores[position] = score
+        self.created[position] = to_micros(created_at)
+
+    def _insert(self, row):
+        grade_id = row[0]
+        if not self.ids or grade_id > self.ids[-1]:
+            self._append(row)
+            return
+        # SQLite reuses the largest id after it is deleted, so a new grade
+        # can land before the end; keep the columns sorted by id.
+        position = bisect_left(self.ids, grade_id)
+        values = (grade_id, row[1], row[2], row[3], row[4], to_micros(row[5]))
+        for column, value in zip(self._columns(), values):
+            column.insert(position, value)
+
+    def _delete(self, position):
+        if self.student_ids[position] != DELETED:
+            self.student_ids[position] = DELETED
+            self.deleted += 1
+
+    def compact(self):
+        """Drop deleted rows from the columns."""
+        if not self.deleted:
+            return
+        keep = [i for i, student_id in enumerate(self.student_ids) if student_id != DELETED]
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in keep)))
+        self.deleted = 0
+
+    def copy(self):
+        """An unpublished copy that ``refresh`` can change."""
+        snapshot = GradeSnapshot()
+        snapshot.version = self.version
+        for name in self.COLUMNS:
+            setattr(snapshot, name, getattr(self, name)[:])
+        snapshot.students = dict(self.students)
+        snapshot.subjects = dict(self.subjects)
+        snapshot.deleted = self.deleted
+        return snapshot
+
+    def refresh(self, connection):
+        """This snapshot brought up to the current data version.
+
+        Returns ``self`` if nothing changed, otherwise a new snapshot with the
+        changes logged since this one's version; this one is left as it is.
+        Returns ``None`` when the log no longer reaches back that far (it was
+        pruned), in which case the caller has to rebuild from scratch.
+        """
+        version = data_version(connection)
+        if version == self.version:
+            return self
+        changes = changes_since(connection, self.version, version)
+        if changes is None:
+            return None
+        snapshot = self.copy()
+        snapshot._apply(connection, changes, version)
+        return snapshot
+
+    def _apply(self, connection, changes, version):
+        grade_ids = {row_id for table_name, row_id in changes if table_name == 'grades'}
+        student_ids = {row_id for table_name, row_id in changes if table_name == 'students'}
+
+        for chunk in _chunks(grade_ids):
+            current = {
+                row[0]: row for row in connection.exec_driver_sql(
+                    f'{self.GRADE_QUERY} WHERE id IN ({",".join("?" * len(chunk))})', tuple(chunk)
+                )
+            }
+            for grade_id in chunk:
+                position = self._position(grade_id)
+                row = current.get(grade_id)
+                if row is None:
+                    if position is not None:
+                        self._delete(position)
+                elif position is None:
+                    self._insert(row)
+                else:
+                    self._set(position, row)
+
+        if student_ids:
+            self._load_students(connection, student_ids)
+        if grade_ids:
+            self._load_subjects(connection)
+        if self.deleted > len(self.ids) // 4:
+            self.compact()
+        self.version = version
+
+    def _live_rows(self, term_id=None, subject_id=None):
+        """Indexes of the rows that are not deleted and match the filters."""
+        for i, (student_id, subject, term) in enumerate(
+                zip(self.student_ids, self.subject_ids, self.term_ids)):
+            if student_id == DELETED:
+                continue
+            if term_id is not None and term != term_id:
+                continue
+            if subject_id is not None and subject != subject_id:
+                continue
+            yield i
+
+    def _mask(self, term_id=None, subject_id=None):
+        mask = numpy.frombuffer(self.student_ids, dtype=numpy.int64) != DELETED
+        if term_id is not None:
+            mask &= numpy.frombuffer(self.term_ids, dtype=numpy.int64) == term_id
+        if subject_id is not None:
+            mask &= numpy.frombuffer(self.subject_ids, dtype=numpy.int64) == subject_id
+        return mask
+
+    def _group(self, key_column, term_id=None, subject_id=None):
+        """``{key: [count, total, minimum, maximum]}`` over the matching rows."""
+        if numpy is not None and len(self.ids):
+            mask = self._mask(term_id, subject_id)
+            keys = numpy.frombuffer(getattr(self, key_column), dtype=numpy.int64)[mask]
+            scores = numpy.frombuffer(self.scores, dtype=numpy.float64)[mask]
+            if not len(keys):
+                return {}
+            unique, inverse = numpy.unique(keys, return_inverse=True)
+            counts = numpy.bincount(inverse)
+            totals = numpy.bincount(inverse, weights=scores)
+            minimums = numpy.full(len(unique), numpy.inf)
+            maximums = numpy.full(len(unique), -numpy.inf)
+            numpy.minimum.at(minimums, inverse, scores)
+            numpy.maximum.at(maximums, inverse, scores)
+            return {
+                int(key): [int(count), float(total), float(low), float(high)]
+                for key, count, total, low, high in zip(unique, counts, totals, minimums, maximums)
+            }
+
+        keys = getattr(self, key_column)
+        scores = self.scores
+        groups = {}
+        for i in self._live_rows(term_id, subject_id):
+            score = scores[i]
+            group = groups.get(keys[i])
+            if group is None:
+                groups[keys[i]] = [1, score, score, score]
+            else:
+                group[0] += 1
+                group[1] += score
+                if score < group[2]:
+                    group[2] = score
+                if score > group[3]:
+                    group[3] = score
+        return groups
+
+    def rankings(self, term_id=None, subject_id=None, min_grades=1, limit=None):
+        """``(student_id, average, count)`` ordered by average, then id."""
+        ranked = []
+        for student_id, (count, total, _, _) in self._group('student_ids', term_id, subject_id).items():
+            average = total / count
+            if average > 0 and count >= min_grades and student_id in self.students:
+                ranked.append((student_id, average, count))
+
+        def order(item):
+            return (-item[1], item[0])
+
+        if limit is not None:
+            return heapq.nsmallest(limit, ranked, key=order)
+        return sorted(ranked, key=order)
+
+    def subject_stats(self, term_id=None):
+        """``(name, count, average, minimum, maximum)`` per subject, by name."""
+        stats = [
+            (self.subjects.get(subject_id, ''), count, total / count, low, high)
+            for subject_id, (count, total, low, high) in self._group('subject_ids', term_id).items()
+        ]
+        stats.sort(key=lambda row: row[0].casefold())
+        return stats
+
+    def student_rows(self, term_id=None):
+        """``(id, name, email, average, count)`` for every student, by name."""
+        groups = self._group('student_ids', term_id)
+        rows = []
+        for student_id, (name, email) in self.students.items():
+            count, total = groups.get(student_id, (0, 0.0))[:2]
+            rows.append((student_id, name, email, total / count if count else 0.0, count))
+        rows.sort(key=lambda row: (row[1], row[0]))
+        return rows
+
+    def pivot_cells(self, aggregate, term_id=None):
+        """``{(student_id, subject_id): value}`` for every pair that has grades.
+
+        ``aggregate`` is ``'latest'`` (the most recent score), ``'mean'`` or
+        ``'max'``. Only pairs with grades are returned, so the result grows
+        with the grades, not with students times subjects.
+        """
+        if numpy is not None and len(self.ids):
+            mask = self._mask(term_id)
+            students = numpy.frombuffer(self.student_ids, dtype=numpy.int64)[mask]
+            subjects = numpy.frombuffer(self.subject_ids, dtype=numpy.int64)[mask]
+            scores = numpy.frombuffer(self.scores, dtype=numpy.float64)[mask]
+            if not len(students):
+                return {}
+            if aggregate == 'latest':
+                # Sort each pair's grades by date, then id, so the last one is the latest.
+                created = numpy.frombuffer(self.created, dtype=numpy.int64)[mask]
+                ids = numpy.frombuffer(self.ids, dtype=numpy.int64)[mask]
+                order = numpy.lexsort((ids, created, subjects, students))
+            else:
+                order = numpy.lexsort((subjects, students))
+            students, subjects, scores = students[order], subjects[order], scores[order]
+            starts = numpy.flatnonzero(numpy.r_[
+                True, (students[1:] != students[:-1]) | (subjects[1:] != subjects[:-1])
+            ])
+            if aggregate == 'latest':
+                values = scores[numpy.r_[starts[1:], len(scores)] - 1]
+            elif aggregate == 'max':
+                values = numpy.maximum.reduceat(scores, starts)
+            else:
+                values = numpy.add.reduceat(scores, starts) / numpy.diff(numpy.r_[starts, len(scores)])
+            return {
+                (int(student_id), int(subject_id)): float(value)
+                for student_id, subject_id, value in zip(students[starts], subjects[starts], values)
+            }
+
+        cells = {}
+        for i in self._live_rows(term_id):
+            key = (self.student_ids[i], self.subject_ids[i])
+            score = self.scores[i]
+            cell = cells.get(key)
+            if aggregate == 'latest':
+                recency = (self.created[i], self.ids[i])
+                if cell is None or recency > cell[0]:
+                    cells[key] = (recency, score)
+            elif aggregate == 'max':
+                if cell is None or score > cell:
+                    cells[key] = score
+            elif cell is None:
+                cells[key] = [1, score]
+            else:
+                cell[0] += 1
+                cell[1] += score
+        if aggregate == 'latest':
+            return {key: score for key, (_, score) in cells.items()}
+        if aggregate == 'mean':
+            return {key: total / count for key, (count, total) in cells.items()}
+        return cells
+
+    def grade_rows(self, term_id=None):
+        """``(id, student name, subject, score, created_at)`` by student name, then date."""
+        rows = []
+        for i in self._live_rows(term_id):
+            student = self.students.get(self.student_ids[i])
+            if student is None:
+                continue
+            rows.append((self.ids[i], student[0], self.subjects.get(self.subject_ids[i], ''),
+                         self.scores[i], self.created[i]))
+        rows.sort(key=lambda row: (row[1], row[4]))
+        return [row[:4] + (from_micros(row[4]),) for row in rows]
+
+
+# File layout: a header, a table of sections, then the sections themselves,
+# each starting on an 8-byte boundary. Integers are little-endian int64,
+# scores are float64, and strings are UTF-8 heaps indexed by offset columns
+# with one more entry than there are strings.
+MAGIC = b'GRADESNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIqqqq')
+SECTION = struct.Struct('<16sqq')
+
+GRADE_SECTIONS = [(name, 'd' if name == 'scores' else 'q') for name in GradeSnapshot.COLUMNS]
+NAME_SECTIONS = [
+    ('student_keys', 'q'), ('student_names', 'q'), ('student_emails', 'q'), ('student_text', 'B'),
+    ('subject_keys', 'q'), ('subject_names', 'q'), ('subject_text', 'B'),
+]
+
+
+def _string_heap(groups):
+    """Pack lists of strings into one UTF-8 heap and one offset column per list."""
+    heap = bytearray()
+    offset_columns = []
+    for strings in groups:
+        offsets = array('q', [len(heap)])
+        for value in strings:
+            heap += value.encode('utf-8')
+            offsets.append(len(heap))
+        offset_columns.append(offsets)
+    return offset_columns, heap
+
+
+def _strings(heap, offsets):
+    return [
+        str(heap[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)
+    ]
+
+
+def write_snapshot_file(snapshot, path):
+    """Write ``snapshot`` to ``path`` atomically. Returns the file size."""
+    snapshot.compact()
+    student_keys = array('q', snapshot.students)
+    (names, emails), student_text = _string_heap([
+        [name for name, _ in snapshot.students.values()],
+        [email for _, email in snapshot.students.values()],
+    ])
+    subject_keys = array('q', snapshot.subjects)
+    (subject_names,), subject_text = _string_heap([list(snapshot.subjects.values())])
+
+    sections = [(name, getattr(snapshot, name)) for name, _ in GRADE_SECTIONS] + [
+        ('student_keys', student_keys), ('student_names', names), ('student_emails', emails),
+        ('student_text', student_text), ('subject_keys', subject_keys),
+        ('subject_names', subject_names), ('subject_text', subject_text),
+    ]
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, data in sections:
+        offset += -offset % 8
+        length = len(memoryview(data).cast('B'))
+        table.append((name, offset, length))
+        offset += length
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), snapshot.version,
+                            len(snapshot.ids), len(student_keys), len(subject_keys)))
+        for name, section_offset, length in table:
+            f.write(SECTION.pack(name.encode('ascii'), section_offset, length))
+        for (name, data), (_, section_offset, _) in zip(sections, table):
+            f.write(b'\0' * (section_offset - f.tell()))
+            f.write(memoryview(data).cast('B'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return offset
+
+
+def read_snapshot_header(path):
+    """``(data_version, grades, students, subjects)`` from a snapshot file."""
+    with open(path, 'rb') as f:
+        magic, fmt, _, version, grades, students, subjects = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or fmt != FORMAT_VERSION:
+        raise ValueError(f'"{path}" is not a version {FORMAT_VERSION} grades snapshot.')
+    return version, grades, students, subjects
+
+
+class MappedSnapshot(GradeSnapshot):
+    """A snapshot file mapped read-only, with columns viewed in place."""
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, count, version, _, _, _ = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            mapped.close()
+            raise ValueError(f'"{path}" is not a version {FORMAT_VERSION} grades snapshot.')
+
+        buffer = memoryview(mapped)
+        views = {}
+        for i in range(count):
+            name, offset, length = SECTION.unpack_from(mapped, HEADER.size + i * SECTION.size)
+            views[name.rstrip(b'\0').decode('ascii')] = buffer[offset:offset + length]
+
+        snapshot = cls()
+        snapshot.path = path
+        snapshot.version = version
+        snapshot._mapped = mapped
+        for name, typecode in GRADE_SECTIONS:
+            setattr(snapshot, name, views[name].cast(typecode))
+        student_text = views['student_text']
+        snapshot.students = dict(zip(
+            views['student_keys'].cast('q'),
+            zip(_strings(student_text, views['student_names'].cast('q')),
+                _strings(student_text, views['student_emails'].cast('q')))
+        ))
+        snapshot.subjects = dict(zip(
+            views['subject_keys'].cast('q'),
+            _strings(views['subject_text'], views['subject_names'].cast('q'))
+        ))
+        return snapshot
+
+    def copy(self):
+        """Copy the mapped columns into arrays, so a refresh can apply changes."""
+        snapshot = GradeSnapshot()
+        snapshot.version = self.version
+        for name, typecode in GRADE_SECTIONS:
+            column = array(typecode)
+            column.frombytes(getattr(self, name).cast('B'))
+            setattr(snapshot, name, column)
+        snapshot.students = dict(self.students)
+        snapshot.subjects = dict(self.subjects)
+        return snapshot
+
+
+def default_snapshot_path():
+    """``students.db`` snapshots to ``students-snapshot.bin`` next to it."""
+    database = db.session.get_bind().url.database
+    if not database or database == ':memory:':
+        raise ValueError('A snapshot path is required for in-memory databases.')
+    return f'{os.path.splitext(database)[0]}-snapshot.bin'
+
+
+def prune_change_log(connection, through_version):
+    """Delete change-log entries up to ``through_version``.
+
+    The newest entry is always kept so the data version never goes back.
+    Snapshots older than the pruned range rebuild from scratch on refresh.
+    """
+    return connection.execute(text(
+        'DELETE FROM change_log WHERE id <= :version AND id < (SELECT max(id) FROM change_log)'
+    ), {'version': through_version}).rowcount
+
+
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """The routed school's snapshot, brought up to the current data version.
+
+    For the default database, a ``SNAPSHOT_FILE`` that is current is mapped
+    and used as is; a stale one seeds an in-memory copy that is refreshed
+    from the change log. The result reflects the session's transaction and
+    is never changed afterwards.
+    """
+    app = current_app._get_current_object()
+    snapshots = app.extensions.setdefault('grade_snapshots', {})
+    shard = current_shard()
+    path = app.config.get('SNAPSHOT_FILE') if shard is None else None
+    connection = db.session.connection()
+    published = snapshots.get(shard)
+    snapshot = published
+    if snapshot is None and path and os.path.exists(path):
+        snapshot = MappedSnapshot.open(path)
+    if snapshot is not None:
+        snapshot = snapshot.refresh(connection)
+    if snapshot is None:
+        snapshot = GradeSnapshot.build(connection)
+    if snapshot is not published:
+        with _snapshot_lock:
+            current = snapshots.get(shard)
+            if current is None or current.version < snapshot.version:
+                snapshots[shard] = snapshot
+    return snapshot
@@ -1,27 +1,129 @@
 import click
+import csv
 import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tabulate import tabulate
 from app import create_app
-from app.models import db, Student, Grade
-from app.services import StudentService, GradeService, ExportService
+from app.models import db
+from app.services import StudentService, GradeService, ExportService, TermService, DistrictService, CurveService, TrendService
+from app.schema import SchemaVersionError
+from app.shards import load_shard_registry
 
 
-def get_app(db_path=None):
+def get_app(db_path=None, shards=None):
     """Create and configure app with optional custom database path."""
-    app = create_app('default', db_path=db_path)
+    try:
+        app = create_app('default', db_path=db_path, shards=shards)
+    except SchemaVersionError as e:
+        click.echo(f'Error: {str(e)}', err=True)
+        sys.exit(1)
     return app
 
 
+def get_district_app(ctx):
+    """Create an app with every school in the shard registry bound."""
+    shards = ctx.obj.get('shards')
+    if not shards:
+        click.echo('Error: --all-schools requires a shard registry (--shards or SHARDS_FILE).', err=True)
+        sys.exit(1)
+    default_db = ctx.obj.get('db') or next(iter(shards.values()))
+    return get_app(default_db, shards=shards)
+
+
+def resolve_term_or_exit(term_name):
+    """Resolve a --term option, exiting with an error for unknown terms."""
+    try:
+        return TermService.resolve_term(term_name)
+    except ValueError as e:
+        click.echo(f'Error: {str(e)}', err=True)
+        sys.exit(1)
+
+
+def parse_id_options(ids, ids_file):
+    """Collect IDs from a comma-separated --ids value and/or an --ids-file.
+    
+    Returns ``None`` when neither option was given.
+    """
+    if ids is None and ids_file is None:
+        return None
+    
+    tokens = []
+    if ids:
+        tokens.extend(ids.split(','))
+    if ids_file:
+        with open(ids_file) as f:
+            for line in f:
+                tokens.extend(line.replace(',', ' ').split())
+    
+    try:
+        return [int(token) for token in tokens if token.strip()]
+    except ValueError as e:
+        click.echo(f'Error: Invalid ID: {str(e)}', err=True)
+        sys.exit(1)
+
+
+bulk_filter_options = [
+    click.option('--ids', help='Comma-separated IDs'),
+    click.option('--ids-file', type=click.Path(exists=True, dir_okay=False),
+                 help='File with IDs separated by commas, spaces or newlines'),
+    click.option('--created-before', type=click.DateTime(formats=['%Y-%m-%d']),
+                 help='Only rows created before this date (YYYY-MM-DD)'),
+    click.option('--chunk-size', type=click.IntRange(min=1), default=500, show_default=True,
+                 help='Rows deleted per transaction'),
+    click.option('--confirm', is_flag=True, help='Skip confirmation prompt'),
+]
+
+
+def bulk_filter(func):
+    for option in reversed(bulk_filter_options):
+        func = option(func)
+    return func
+
+
+term_option = click.option(
+    '--term', 'term_name',
+    help='Term name, or "all" (default: the current term)'
+)
+
+
+all_schools_option = click.option(
+    '--all-schools', is_flag=True,
+    help='Combine the results of every school in the shard registry'
+)
+
+snapshot_option = click.option(
+    '--snapshot', 'snapshot_file', type=click.Path(exists=True, dir_okay=False),
+    help='Read grades from this snapshot file while it is current (see "snapshot build")'
+)
+
+
+def use_snapshot_file(app, snapshot_file):
+    if snapshot_file:
+        app.config['SNAPSHOT_FILE'] = os.path.abspath(snapshot_file)
+
+
 @click.group()
 @click.option('--db', type=click.Path(), help='Path to SQLite database file')
+@click.option('--shards', 'shards_file', type=click.Path(exists=True, dir_okay=False),
+              envvar='SHARDS_FILE', help='JSON registry mapping school names to database files')
+@click.option('--school', help='Run the command against this school from the shard registry')
 @click.pass_context
-def cli(ctx, db):
+def cli(ctx, db, shards_file, school):
     """Student Management System CLI"""
     if ctx.obj is None:
         ctx.obj = {}
     ctx.obj['db'] = db
+    ctx.obj['shards'] = load_shard_registry(shards_file) if shards_file else None
+    
+    if school:
+        if not ctx.obj['shards'] or school not in ctx.obj['shards']:
+            click.echo(f'Error: School "{school}" is not in the shard registry.', err=True)
+            sys.exit(1)
+        ctx.obj['db'] = ctx.obj['shards'][school]
 
 
 @cli.command()
@@ -41,12 +143,6 @@ def add_student(ctx, name, email):
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
         try:
-            # Check if email already exists
-            existing = Student.query.filter_by(email=email).first()
-            if existing:
-                click.echo(f'Error: Email "{email}" is already registered.', err=True)
-                sys.exit(1)
-            
             student = StudentService.create_student(name, email)
             click.echo(f'✓ Student created successfully!')
             click.echo(f'  Name: {student.name}')
@@ -76,13 +172,6 @@ def edit_student(ctx, student_id, name, email):
         new_email = email if email else student.email
         
         try:
-            # Check if new email is already in use by another student
-            if new_email != student.email:
-                existing = Student.query.filter_by(email=new_email).first()
-                if existing:
-                    click.echo(f'Error: Email "{new_email}" is already registered.', err=True)
-                    sys.exit(1)
-            
             updated = StudentService.update_student(student_id, new_name, new_email)
             click.echo(f'✓ Student updated successfully!')
             click.echo(f'  ID: {updated.id}')
@@ -101,7 +190,7 @@ def delete_student(ctx, student_id, confirm):
     """Delete a student and all their grades."""
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
-        student = StudentService.get_student_by_id(student_id)
+        student = StudentService.get_student_by_id(student_id, grades='joined')
         if not student:
             click.echo(f'Error: Student with ID {student_id} not found.', err=True)
             sys.exit(1)
@@ -126,6 +215,162 @@ def delete_student(ctx, student_id, confirm):
             sys.exit(1)
 
 
+@cli.command()
+@bulk_filter
+@click.pass_context
+def bulk_delete_students(ctx, ids, ids_file, created_before, chunk_size, confirm):
+    """Delete many students and all their grades."""
+    student_ids = parse_id_options(ids, ids_file)
+    if student_ids is None and created_before is None:
+        click.echo('Error: Provide --ids, --ids-file or --created-before.', err=True)
+        sys.exit(1)
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        matched = StudentService.count_students(student_ids, created_before)
+        if matched == 0:
+            click.echo('No matching students found.')
+            sys.exit(0)
+        
+        if not confirm and not click.confirm(f'Delete {matched} student(s) and all their grades?'):
+            click.echo('Deletion cancelled.')
+            sys.exit(0)
+        
+        try:
+            counts = StudentService.bulk_delete_students(student_ids, created_before, chunk_size)
+            click.echo(f'✓ Students deleted successfully!')
+            click.echo(f'  Students: {counts["students"]}')
+            click.echo(f'  Grades: {counts["grades"]}')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
+@cli.command()
+@click.argument('roster', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--delete-missing', is_flag=True, help='Delete students who are not on the roster')
+@click.option('--dry-run', is_flag=True, help='Only report the changes')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=500, show_default=True,
+              help='Rows written per transaction')
+@click.option('--show', type=click.IntRange(min=0), default=20, show_default=True,
+              help='Number of changes of each kind to list')
+@click.option('--confirm', is_flag=True, help='Skip confirmation prompt')
+@click.pass_context
+def sync_roster(ctx, roster, delete_missing, dry_run, chunk_size, show, confirm):
+    """Reconcile students with a roster CSV (columns: name, email)."""
+    from app.services import RosterService
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        try:
+            diff = RosterService.diff(RosterService.read_roster(roster), delete_missing=delete_missing)
+        except (ValueError, csv.Error) as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        click.echo(f'\nRoster diff: {len(diff["inserts"])} to add, {len(diff["updates"])} to update, '
+                   f'{len(diff["deletes"])} to delete, {diff["unchanged"]} unchanged, '
+                   f'{len(diff["invalid"])} invalid')
+        sections = [
+            ('Add', diff['inserts'], lambda row: [row['name'], row['email']]),
+            ('Update', diff['updates'], lambda row: [f'{row["old_name"]} -> {row["name"]}', row['email']]),
+            ('Delete', diff['deletes'], lambda row: [row['name'], row['email']]),
+            ('Invalid', diff['invalid'], lambda row: [f'line {row["line"]}: {row["reason"]}', row['email']]),
+        ]
+        for title, rows, describe in sections:
+            if rows and show:
+                table_data = [[title] + describe(row) for row in rows[:show]]
+                click.echo(tabulate(table_data, headers=['Change', 'Name', 'Email'], tablefmt='grid'))
+                if len(rows) > show:
+                    click.echo(f'  ... and {len(rows) - show} more')
+        
+        changes = len(diff['inserts']) + len(diff['updates']) + len(diff['deletes'])
+        if dry_run:
+            click.echo('Dry run: no changes were made.')
+            return
+        if changes == 0:
+            click.echo('Students are already in sync with the roster.')
+            return
+        if not confirm and not click.confirm(f'Apply {changes} change(s)?'):
+            click.echo('Sync cancelled.')
+            sys.exit(0)
+        
+        try:
+            counts = RosterService.apply(diff, chunk_size=chunk_size)
+            click.echo(f'✓ Roster synced successfully!')
+            click.echo(f'  Added: {counts["inserted"]}')
+            click.echo(f'  Updated: {counts["updated"]}')
+            click.echo(f'  Deleted: {counts["deleted"]} ({counts["grades"]} grade(s))')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
+def import_options(func):
+    """The pipeline tuning options shared by the import commands."""
+    for option in reversed([
+        click.option('--workers', type=click.IntRange(min=1), default=os.cpu_count() or 1,
+                     show_default='CPU count', help='Validation processes'),
+        click.option('--chunk-size', type=click.IntRange(min=1), default=1000, show_default=True,
+                     help='Rows validated and inserted at a time'),
+        click.option('--queue-size', type=click.IntRange(min=1), default=4, show_default=True,
+                     help='Chunks buffered between stages'),
+        click.option('--show', type=click.IntRange(min=0), default=20, show_default=True,
+                     help='Number of invalid rows to list'),
+    ]):
+        func = option(func)
+    return func
+
+
+def run_import(ctx, importer, f, workers, chunk_size, queue_size, show, label):
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        try:
+            result = importer(f, workers=workers, chunk_size=chunk_size, queue_size=queue_size)
+        except (ValueError, csv.Error) as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+    
+    invalid = result['invalid_rows']
+    if invalid and show:
+        table_data = [[row['line'], row['value'], row['reason']] for row in invalid[:show]]
+        click.echo(tabulate(table_data, headers=['Line', 'Value', 'Problem'], tablefmt='grid'))
+        if result['invalid'] > min(show, len(invalid)):
+            click.echo(f'  ... and {result["invalid"] - min(show, len(invalid))} more')
+    
+    table_data = [
+        [name.capitalize(), stage['rows'], f'{stage["seconds"]:.2f}', f'{stage["rate"]:.0f}']
+        for name, stage in result['stages'].items()
+    ]
+    click.echo(tabulate(table_data, headers=['Stage', 'Rows', 'Busy (s)', 'Rows/s'], tablefmt='grid'))
+    click.echo(f'✓ {label} imported successfully!')
+    click.echo(f'  Inserted: {result["written"]}')
+    if 'duplicates' in result:
+        click.echo(f'  Duplicates skipped: {result["duplicates"]}')
+    click.echo(f'  Invalid: {result["invalid"]}')
+    click.echo(f'  Time: {result["seconds"]:.2f}s')
+
+
+@cli.command()
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@import_options
+@click.pass_context
+def import_students(ctx, csv_file, workers, chunk_size, queue_size, show):
+    """Import students from a CSV (columns: name, email), skipping registered emails."""
+    from app.importer import import_students as run
+    run_import(ctx, run, csv_file, workers, chunk_size, queue_size, show, 'Students')
+
+
+@cli.command()
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@import_options
+@click.pass_context
+def import_grades(ctx, csv_file, workers, chunk_size, queue_size, show):
+    """Import grades from a CSV (columns: student_id or email, subject, score, optional term)."""
+    from app.importer import import_grades as run
+    run_import(ctx, run, csv_file, workers, chunk_size, queue_size, show, 'Grades')
+
+
 @cli.command()
 @click.option('--student-id', type=int, help='Filter by student ID (optional)')
 @click.pass_context
@@ -134,12 +379,12 @@ def list_students(ctx, student_id):
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
         if student_id:
-            students = [StudentService.get_student_by_id(student_id)]
+            students = [StudentService.get_student_by_id(student_id, grades='joined')]
             if not students[0]:
                 click.echo(f'Error: Student with ID {student_id} not found.', err=True)
                 sys.exit(1)
         else:
-            students = StudentService.get_all_students()
+            students = StudentService.get_all_students(grades='selectin')
         
         if not students:
             click.echo('No students found.')
@@ -162,12 +407,88 @@ def list_students(ctx, student_id):
         click.echo()
 
 
+lookup_options = [
+    click.option('--ids', help='Comma-separated IDs'),
+    click.option('--ids-file', type=click.Path(exists=True, dir_okay=False),
+                 help='File with IDs separated by commas, spaces or newlines'),
+    click.option('--fields', help='Comma-separated fields to show (id is always included)'),
+    click.option('--json', 'as_json', is_flag=True, help='Print JSON instead of a table'),
+]
+
+
+def lookup_command(func):
+    for option in reversed(lookup_options):
+        func = option(func)
+    return func
+
+
+def show_lookup(lookup, ids, ids_file, fields, as_json, label):
+    """Run a batch ``lookup`` and print its records and the IDs not found."""
+    import json
+    
+    id_list = parse_id_options(ids, ids_file)
+    if not id_list:
+        click.echo('Error: Give IDs with --ids or --ids-file.', err=True)
+        sys.exit(1)
+    try:
+        records, missing = lookup(id_list, fields.split(',') if fields else None)
+    except ValueError as e:
+        click.echo(f'Error: {str(e)}', err=True)
+        sys.exit(1)
+    
+    if as_json:
+        click.echo(json.dumps({label: records, 'missing': missing}, indent=2))
+        return
+    if records:
+        headers = list(records[0])
+        table_data = [
+            [
+                '; '.join(f"{grade['subject']} {grade['score']}" for grade in value)
+                if name == 'grades' else value
+                for name, value in record.items()
+            ]
+            for record in records
+        ]
+        click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+    if missing:
+        click.echo(f'Not found: {", ".join(str(i) for i in missing)}', err=True)
+    click.echo()
+
+
+@cli.command()
+@lookup_command
+@click.pass_context
+def lookup_students(ctx, ids, ids_file, fields, as_json):
+    """Look up many students by ID, showing only the chosen fields.
+    
+    Fields: id, name, email, avg, count, grades (default: id, name, email).
+    """
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        show_lookup(StudentService.lookup_students, ids, ids_file, fields, as_json, 'students')
+
+
+@cli.command()
+@lookup_command
+@click.pass_context
+def lookup_grades(ctx, ids, ids_file, fields, as_json):
+    """Look up many grades by ID, showing only the chosen fields.
+    
+    Fields: id, student_id, student, subject, score, term, created_at
+    (default: id, student_id, subject, score, created_at).
+    """
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        show_lookup(GradeService.lookup_grades, ids, ids_file, fields, as_json, 'grades')
+
+
 @cli.command()
 @click.option('--student-id', type=int, required=True, help='Student ID')
 @click.option('--subject', prompt=True, help='Subject name')
 @click.option('--score', type=float, prompt=True, help='Grade score (0-100)')
+@click.option('--term', 'term_name', help='Term name (default: the current term)')
 @click.pass_context
-def add_grade(ctx, student_id, subject, score):
+def add_grade(ctx, student_id, subject, score, term_name):
     """Add a grade for a student."""
     if not subject or not subject.strip():
         click.echo('Error: Subject name cannot be empty.', err=True)
@@ -179,17 +500,21 @@ def add_grade(ctx, student_id, subject, score):
     
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
-        student = StudentService.get_student_by_id(student_id)
+        student = StudentService.get_student_record(student_id)
         if not student:
             click.echo(f'Error: Student with ID {student_id} not found.', err=True)
             sys.exit(1)
         
+        term = resolve_term_or_exit(term_name) if term_name else None
+        
         try:
-            grade = GradeService.create_grade(student_id, subject, score)
+            grade = GradeService.create_grade(student_id, subject, score, term=term)
             click.echo(f'✓ Grade added successfully!')
             click.echo(f'  Student: {student.name}')
             click.echo(f'  Subject: {grade.subject}')
             click.echo(f'  Score: {grade.score}')
+            if grade.term is not None:
+                click.echo(f'  Term: {grade.term.name}')
         except Exception as e:
             click.echo(f'Error: {str(e)}', err=True)
             sys.exit(1)
@@ -208,18 +533,20 @@ def edit_grade(ctx, grade_id, subject, score):
     
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
-        grade = GradeService.get_grade_by_id(grade_id)
+        grade = GradeService.get_grade_by_id(grade_id, student='joined')
         if not grade:
             click.echo(f'Error: Grade with ID {grade_id} not found.', err=True)
             sys.exit(1)
         
+        # Read before the update commits and expires the grade.
+        student_name = grade.student.name
         new_subject = subject if subject else grade.subject
         new_score = score if score is not None else grade.score
         
         try:
             updated = GradeService.update_grade(grade_id, new_subject, new_score)
             click.echo(f'✓ Grade updated successfully!')
-            click.echo(f'  Student: {updated.student.name}')
+            click.echo(f'  Student: {student_name}')
             click.echo(f'  Subject: {updated.subject}')
             click.echo(f'  Score: {updated.score}')
         except Exception as e:
@@ -235,7 +562,7 @@ def delete_grade(ctx, grade_id, confirm):
     """Delete a grade."""
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
-        grade = GradeService.get_grade_by_id(grade_id)
+        grade = GradeService.get_grade_by_id(grade_id, student='joined')
         if not grade:
             click.echo(f'Error: Grade with ID {grade_id} not found.', err=True)
             sys.exit(1)
@@ -254,6 +581,94 @@ def delete_grade(ctx, grade_id, confirm):
             sys.exit(1)
 
 
+@cli.command()
+@bulk_filter
+@click.pass_context
+def bulk_delete_grades(ctx, ids, ids_file, created_before, chunk_size, confirm):
+    """Delete many grades."""
+    grade_ids = parse_id_options(ids, ids_file)
+    if grade_ids is None and created_before is None:
+        click.echo('Error: Provide --ids, --ids-file or --created-before.', err=True)
+        sys.exit(1)
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        matched = GradeService.count_grades(grade_ids, created_before)
+        if matched == 0:
+            click.echo('No matching grades found.')
+            sys.exit(0)
+        
+        if not confirm and not click.confirm(f'Delete {matched} grade(s)?'):
+            click.echo('Deletion cancelled.')
+            sys.exit(0)
+        
+        try:
+            deleted = GradeService.bulk_delete_grades(grade_ids, created_before, chunk_size)
+            click.echo(f'✓ Grades deleted successfully!')
+            click.echo(f'  Grades: {deleted}')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
+def format_score(value):
+    return '-' if value is None else f'{value:.2f}'
+
+
+@cli.command()
+@click.option('--subject', required=True, help='Subject to curve')
+@click.option('--method', type=click.Choice(CurveService.METHODS), required=True,
+              help='add: shift by VALUE, multiply: scale by VALUE, mean: rescale to mean VALUE')
+@click.option('--value', type=float, required=True, help='Amount, factor or target mean')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only grades recorded on or after this date')
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only grades recorded on or before this date')
+@click.option('--dry-run', is_flag=True, help='Show the effect without changing any grade')
+@click.option('--confirm', is_flag=True, help='Skip confirmation prompt')
+@click.pass_context
+def curve(ctx, subject, method, value, start, end, dry_run, confirm):
+    """Apply a curve to every grade of a subject."""
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        start = start.date() if start else None
+        end = end.date() if end else None
+        try:
+            preview = CurveService.curve(subject, method, value, start, end, dry_run=True)
+        except ValueError as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        if preview['count'] == 0:
+            click.echo('No matching grades found.')
+            sys.exit(0)
+        
+        table_data = [
+            ['Before', format_score(preview['before']['mean']),
+             format_score(preview['before']['min']), format_score(preview['before']['max'])],
+            ['After', format_score(preview['after']['mean']),
+             format_score(preview['after']['min']), format_score(preview['after']['max'])],
+        ]
+        click.echo(f'\nCurve for {preview["subject"]}: {preview["count"]} grade(s), '
+                   f'{preview["clamped"]} clamped to 0-100')
+        click.echo(tabulate(table_data, headers=['', 'Mean', 'Min', 'Max'], tablefmt='grid'))
+        
+        if dry_run:
+            click.echo('Dry run: no grades were changed.')
+            return
+        
+        if not confirm and not click.confirm(f'Apply this curve to {preview["count"]} grade(s)?'):
+            click.echo('Curve cancelled.')
+            sys.exit(0)
+        
+        try:
+            result = CurveService.curve(subject, method, value, start, end)
+            click.echo(f'✓ Curve applied to {result["count"]} grade(s)!')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
 @cli.command()
 @click.option('--student-id', type=int, help='Filter by student ID (optional)')
 @click.pass_context
@@ -262,14 +677,14 @@ def list_grades(ctx, student_id):
     app = get_app(ctx.obj.get('db'))
     with app.app_context():
         if student_id:
-            student = StudentService.get_student_by_id(student_id)
+            student = StudentService.get_student_by_id(student_id, grades='joined')
             if not student:
                 click.echo(f'Error: Student with ID {student_id} not found.', err=True)
                 sys.exit(1)
-            grades = GradeService.get_grades_by_student(student_id)
+            grades = student.grades
             click.echo(f'\nGrades for {student.name}:')
         else:
-            grades = Grade.query.all()
+            grades = GradeService.get_all_grades(student='joined')
             if not grades:
                 click.echo('No grades found.')
                 sys.exit(0)
@@ -283,7 +698,7 @@ def list_grades(ctx, student_id):
         for grade in grades:
             table_data.append([
                 grade.id,
-                grade.student.name,
+                student.name if student_id else grade.student.name,
                 grade.subject,
                 grade.score,
                 grade.created_at.strftime('%Y-%m-%d %H:%M:%S')
@@ -295,23 +710,45 @@ def list_grades(ctx, student_id):
 
 
 @cli.command()
+@term_option
+@click.option('--subject', help='Rank by the grades of this subject only')
+@click.option('--min-grades', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Leave out students with fewer grades')
+@click.option('--limit', type=click.IntRange(min=1), help='Show only the top N students')
+@all_schools_option
+@snapshot_option
 @click.pass_context
-def rankings(ctx):
+def rankings(ctx, term_name, subject, min_grades, limit, all_schools, snapshot_file):
     """Display student rankings by average grade."""
-    app = get_app(ctx.obj.get('db'))
+    app = get_district_app(ctx) if all_schools else get_app(ctx.obj.get('db'))
+    use_snapshot_file(app, snapshot_file)
+    filters = {'subject': subject, 'min_grades': min_grades, 'limit': limit}
     with app.app_context():
-        rankings = StudentService.get_rankings()
+        if all_schools:
+            term = None
+            try:
+                rankings = DistrictService.get_rankings(term_name, **filters)
+            except ValueError as e:
+                click.echo(f'Error: {str(e)}', err=True)
+                sys.exit(1)
+        else:
+            term = resolve_term_or_exit(term_name)
+            rankings = StudentService.get_rankings(term=term, **filters)
         if not rankings:
             click.echo('No rankings available.')
             sys.exit(0)
         
         click.echo('\nStudent Rankings (sorted by average grade):')
+        if term is not None:
+            click.echo(f'Term: {term.name}')
+        if subject:
+            click.echo(f'Subject: {subject}')
         
         table_data = []
         for idx, item in enumerate(rankings, 1):
             student = item['student']
             avg = item['average']
-            grade_count = len(student.grades)
+            grade_count = item['count']
             
             # Add medals for top 3
             medal = ''
@@ -324,28 +761,705 @@ def rankings(ctx):
             
             rank_str = f'{medal} #{idx}'.strip()
             
-            table_data.append([
+            row = [
                 rank_str,
                 student.name,
                 student.email,
                 f'{avg:.2f}',
                 grade_count
-            ])
+            ]
+            if all_schools:
+                row.insert(1, item['school'])
+            table_data.append(row)
         
         headers = ['Rank', 'Name', 'Email', 'Average', 'Grades']
+        if all_schools:
+            headers.insert(1, 'School')
         click.echo(tabulate(table_data, headers=headers, tablefmt='grid'))
         click.echo()
 
 
+@cli.command()
+@click.option('--student-id', type=int, required=True, help='Student ID')
+@term_option
+@click.pass_context
+def rank(ctx, student_id, term_name):
+    """Show a student's rank by average grade."""
+    from app.leaderboard import get_leaderboard
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        student = StudentService.get_student_record(student_id)
+        if not student:
+            click.echo(f'Error: Student with ID {student_id} not found.', err=True)
+            sys.exit(1)
+        
+        term = resolve_term_or_exit(term_name)
+        board = get_leaderboard(term)
+        ranked = board.rank_of(student_id)
+        scope = f' in {term.name}' if term is not None else ''
+        if ranked is None:
+            click.echo(f'{student.name} has no ranked grades{scope}.')
+            return
+        
+        click.echo(f'{student.name} is ranked #{ranked.rank} of {len(board)}{scope}')
+        click.echo(f'  Average: {ranked.average:.2f} over {ranked.count} grade(s)')
+
+
+@cli.command()
+@term_option
+@click.option('--max-average', type=float, default=TrendService.AT_RISK_AVERAGE, show_default=True,
+              help='Flag students averaging below this')
+@click.option('--max-slope', type=float, default=TrendService.AT_RISK_SLOPE, show_default=True,
+              help=f'Flag students whose trend falls below this many points per {TrendService.SLOPE_DAYS} days')
+@click.option('--min-grades', type=click.IntRange(min=1), default=TrendService.AT_RISK_MIN_GRADES,
+              show_default=True, help='Leave out students with fewer grades')
+@click.pass_context
+def at_risk(ctx, term_name, max_average, max_slope, min_grades):
+    """List students with a low average or a falling grade trend."""
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        term = resolve_term_or_exit(term_name)
+        report = TrendService.get_at_risk(term=term, max_average=max_average, max_slope=max_slope,
+                                          min_grades=min_grades)
+        if not report:
+            click.echo('No students at risk.')
+            sys.exit(0)
+        
+        table_data = []
+        for item in report:
+            table_data.append([
+                item['student'].id,
+                item['student'].name,
+                f"{item['average']:.2f}",
+                f"{item['slope']:+.1f}" if item['slope'] is not None else '-',
+                item['count'],
+                ', '.join(item['reasons'])
+            ])
+        
+        headers = ['ID', 'Name', 'Average', f'Trend/{TrendService.SLOPE_DAYS}d', 'Grades', 'Reasons']
+        click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+        click.echo()
+
+
+@cli.command()
+@term_option
+@all_schools_option
+@snapshot_option
+@click.pass_context
+def stats(ctx, term_name, all_schools, snapshot_file):
+    """Display per-subject grade statistics."""
+    app = get_district_app(ctx) if all_schools else get_app(ctx.obj.get('db'))
+    use_snapshot_file(app, snapshot_file)
+    with app.app_context():
+        if all_schools:
+            try:
+                stats = DistrictService.get_subject_stats(term_name)
+            except ValueError as e:
+                click.echo(f'Error: {str(e)}', err=True)
+                sys.exit(1)
+        else:
+            term = resolve_term_or_exit(term_name)
+            stats = GradeService.get_subject_stats(term=term)
+        if not stats:
+            click.echo('No grades found.')
+            sys.exit(0)
+        
+        table_data = []
+        for item in stats:
+            table_data.append([
+                item['subject'],
+                item['count'],
+                f"{item['average']:.2f}",
+                item['min'],
+                item['max']
+            ])
+        
+        headers = ['Subject', 'Grades', 'Average', 'Min', 'Max']
+        click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+        click.echo()
+
+
+def _benchmark_grade_writes(db_path, group_commit, rows, threads):
+    """Insert ``rows`` grades from ``threads`` threads into a fresh database."""
+    from app.retry import retry_stats
+    
+    app = get_app(db_path)
+    app.config['GRADE_GROUP_COMMIT'] = group_commit
+    with app.app_context():
+        student_id = StudentService.create_student('Benchmark Student', 'benchmark@example.com').id
+    
+    latencies = []
+    errors = []
+    
+    def worker(count):
+        with app.app_context():
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    GradeService.create_grade(student_id, 'Benchmark', 50.0)
+                except Exception as e:
+                    errors.append(e)
+                latencies.append(time.perf_counter() - started)
+    
+    counts = [rows // threads + (1 if i < rows % threads else 0) for i in range(threads)]
+    retry_stats.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, counts))
+    elapsed = time.perf_counter() - started
+    
+    result = {
+        'elapsed': elapsed,
+        'errors': len(errors),
+        'retries': retry_stats.totals()['retries'],
+        'latencies': sorted(latencies),
+        'batches': None,
+        'mean_batch_size': None
+    }
+    writer = app.extensions.get('group_commit')
+    if writer is not None:
+        writer.stop()
+        metrics = writer.metrics.snapshot()
+        result['batches'] = metrics['batches']
+        result['mean_batch_size'] = metrics['mean_batch_size']
+    return result
+
+
+@cli.command()
+@click.option('--rows', type=click.IntRange(min=1), default=2000, show_default=True,
+              help='Grades to insert per mode')
+@click.option('--threads', type=click.IntRange(min=1), default=16, show_default=True,
+              help='Concurrent writers')
+def benchmark_grades(rows, threads):
+    """Compare per-row commits with group commit for concurrent grade inserts.
+    
+    Each mode writes into its own temporary database; --db is not touched.
+    """
+    def percentile(values, q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+    
+    table_data = []
+    for label, group_commit in (('per-row commit', False), ('group commit', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = _benchmark_grade_writes(
+                os.path.join(tmp, 'benchmark.db'), group_commit, rows, threads
+            )
+        latencies = result['latencies']
+        written = rows - result['errors']
+        table_data.append([
+            label,
+            f'{written / result["elapsed"]:.0f}',
+            f'{percentile(latencies, 0.50):.1f}',
+            f'{percentile(latencies, 0.95):.1f}',
+            f'{percentile(latencies, 0.99):.1f}',
+            result['batches'] if result['batches'] is not None else written,
+            f'{result["mean_batch_size"]:.1f}' if result['mean_batch_size'] is not None else '1.0',
+            result['retries'],
+            result['errors']
+        ])
+    
+    headers = ['Mode', 'Written/s', 'p50 ms', 'p95 ms', 'p99 ms', 'Commits', 'Rows/commit', 'Retries', 'Errors']
+    click.echo(f'\n{rows} grade inserts from {threads} thread(s):')
+    click.echo(tabulate(table_data, headers=headers, tablefmt='grid'))
+
+
+@cli.command()
+@click.option('--bind', default='127.0.0.1:8000', show_default=True, envvar='SERVE_BIND',
+              help='Address to listen on (HOST:PORT or unix:PATH)')
+@click.option('--workers', type=click.IntRange(min=1), envvar='SERVE_WORKERS',
+              help='Worker processes (default: 2 x CPUs + 1)')
+@click.option('--threads', type=click.IntRange(min=1), default=1, show_default=True, envvar='SERVE_THREADS',
+              help='Request threads per worker; each open live rankings page holds one')
+@click.option('--timeout', type=click.IntRange(min=1), default=30, show_default=True,
+              help='Seconds before a silent worker is killed and replaced')
+@click.option('--graceful-timeout', type=click.IntRange(min=1), default=30, show_default=True,
+              help='Seconds workers get to finish their requests on restart or shutdown')
+@click.option('--max-requests', type=click.IntRange(min=0), default=0, show_default=True,
+              help='Recycle a worker after this many requests (0: never)')
+@click.option('--pid', 'pidfile', type=click.Path(dir_okay=False), help='Write the master PID to this file')
+@click.option('--access-log', type=click.Path(dir_okay=False), help='Access log file, or "-" for stderr')
+@click.pass_context
+def serve(ctx, bind, workers, threads, timeout, graceful_timeout, max_requests, pidfile, access_log):
+    """Run the web app under Gunicorn with preloaded worker processes."""
+    from app.server import serve as run_server
+    
+    config_name = os.environ.get('FLASK_ENV', 'production')
+    
+    def app_factory():
+        try:
+            return create_app(config_name, db_path=ctx.obj.get('db'), shards=ctx.obj.get('shards'))
+        except SchemaVersionError as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+    
+    try:
+        run_server(app_factory, bind=bind, workers=workers, threads=threads, timeout=timeout,
+                   graceful_timeout=graceful_timeout, max_requests=max_requests, pidfile=pidfile,
+                   accesslog=access_log)
+    except RuntimeError as e:
+        click.echo(f'Error: {str(e)}', err=True)
+        sys.exit(1)
+
+
+def parse_counts(ctx, param, value):
+    try:
+        counts = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        counts = []
+    if not counts or min(counts) < 1:
+        raise click.BadParameter('expected comma-separated positive numbers, e.g. 1,2,4')
+    return counts
+
+
+@cli.command()
+@click.option('--workers', 'worker_counts', default='1,2,4', show_default=True, callback=parse_counts,
+              help='Comma-separated worker counts to compare')
+@click.option('--threads', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Request threads per worker')
+@click.option('--concurrency', type=click.IntRange(min=1), default=16, show_default=True,
+              help='Concurrent client connections')
+@click.option('--duration', type=click.FloatRange(min=0.1), default=5.0, show_default=True,
+              help='Seconds of load per worker count')
+@click.option('--students', type=click.IntRange(min=1), default=200, show_default=True,
+              help='Students in the seeded database (10 grades each)')
+def benchmark_serve(worker_counts, threads, concurrency, duration, students):
+    """Measure requests per second of "serve" for several worker counts."""
+    from app.loadtest import READ_MIX, free_port, run_loadtest, seed_database, start_server, stop_server
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'benchmark.db')
+        click.echo(f'Seeding {students} students...')
+        student_ids = seed_database(db_path, students=students)
+        
+        table_data = []
+        baseline = None
+        for workers in worker_counts:
+            port = free_port()
+            try:
+                process = start_server(db_path, port, workers, threads)
+            except RuntimeError as e:
+                click.echo(f'Error: {str(e)}', err=True)
+                sys.exit(1)
+            try:
+                totals = run_loadtest(f'http://127.0.0.1:{port}', student_ids, READ_MIX,
+                                      concurrency, duration)['totals']
+            finally:
+                stop_server(process)
+            rate = totals['throughput']
+            baseline = baseline or rate
+            table_data.append([workers, threads, totals['requests'], f'{rate:.1f}', totals['errors'],
+                               f'{rate / baseline:.2f}x' if baseline else '-'])
+    
+    headers = ['Workers', 'Threads', 'Requests', 'Req/s', 'Errors', 'Speedup']
+    click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+    click.echo()
+
+
+def parse_mix(ctx, param, value):
+    from app.loadtest import DEFAULT_MIX, ROUTES
+    
+    if value is None:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ROUTES:
+            raise click.BadParameter(f'unknown operation "{name}" (choose from {", ".join(ROUTES)})')
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise click.BadParameter(f'weight of "{name}" must be a number') from None
+    if not any(weight > 0 for weight in mix.values()):
+        raise click.BadParameter('at least one operation needs a positive weight')
+    return mix
+
+
+def format_change(ratio, lower_is_better=False):
+    if ratio is None:
+        return '-'
+    better = ratio < 0 if lower_is_better else ratio > 0
+    return f'{ratio:+.1%}' + (' ✓' if better and abs(ratio) >= 0.05 else '')
+
+
+@cli.command()
+@click.option('--workers', type=click.IntRange(min=1), default=2, show_default=True,
+              help='Server worker processes')
+@click.option('--threads', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Request threads per worker')
+@click.option('--concurrency', type=click.IntRange(min=1), default=16, show_default=True,
+              help='Concurrent simulated users')
+@click.option('--duration', type=click.FloatRange(min=0.1), default=10.0, show_default=True,
+              help='Seconds of load')
+@click.option('--students', type=click.IntRange(min=1), default=200, show_default=True,
+              help='Students in the seeded database (10 grades each)')
+@click.option('--mix', callback=parse_mix,
+              help='Operation weights, e.g. "students=5,rankings=2,add_grade=1" (default: a mix of all)')
+@click.option('--seed', type=int, default=0, show_default=True, help='Random seed for data and choices')
+@click.option('--output', type=click.Path(dir_okay=False), help='Save the results to this JSON file')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False),
+              help='Show the change against results saved earlier')
+def loadtest(workers, threads, concurrency, duration, students, mix, seed, output, compare):
+    """Load-test the web app on a seeded database and report latency per route."""
+    import json
+    from app.loadtest import compare_results, free_port, run_loadtest, seed_database, start_server, stop_server
+    
+    previous = None
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'loadtest.db')
+        click.echo(f'Seeding {students} students...')
+        student_ids = seed_database(db_path, students=students, seed=seed)
+        port = free_port()
+        try:
+            process = start_server(db_path, port, workers, threads)
+        except RuntimeError as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        click.echo(f'Running {concurrency} users for {duration:g}s against {workers} worker(s) x {threads} thread(s)...')
+        try:
+            results = run_loadtest(f'http://127.0.0.1:{port}', student_ids, mix, concurrency, duration, seed=seed)
+        finally:
+            stop_server(process)
+    results['config'].update(workers=workers, threads=threads, students=students, seed=seed)
+    
+    changes = {}
+    if previous is not None:
+        try:
+            changes = compare_results(results, previous)
+        except (KeyError, ValueError) as e:
+            click.echo(f'Error: cannot compare with {compare}: {str(e)}', err=True)
+            sys.exit(1)
+    
+    table_data = []
+    rows = list(results['routes'].items()) + [('total', results['totals'])]
+    for route, stats in rows:
+        row = [route, stats['requests'], stats['errors'], f"{stats['throughput']:.1f}",
+               f"{stats['p50_ms']:.1f}", f"{stats['p95_ms']:.1f}", f"{stats['p99_ms']:.1f}"]
+        if previous is not None:
+            throughput_change, p95_change = changes.get(route, (None, None))
+            row += [format_change(throughput_change), format_change(p95_change, lower_is_better=True)]
+        table_data.append(row)
+    
+    headers = ['Route', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms']
+    if previous is not None:
+        headers += ['Req/s change', 'p95 change']
+    click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+    
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo(f'Results saved to {output}')
+    click.echo()
+
+
+@cli.command()
+@click.option('--dry-run', is_flag=True, help='Only list the pending migrations')
+@click.pass_context
+def upgrade(ctx, dry_run):
+    """Bring the database schema up to the current version."""
+    from app.schema import SCHEMA_VERSION, pending_migrations, upgrade_schema
+    
+    app = create_app('default', db_path=ctx.obj.get('db'), require_current_schema=False)
+    with app.app_context():
+        try:
+            pending = pending_migrations(db.engine)
+            if not pending:
+                click.echo(f'Database schema is already up to date (version {SCHEMA_VERSION}).')
+                return
+            if dry_run:
+                click.echo(f'{len(pending)} pending migration(s):')
+                for version, name, _ in pending:
+                    click.echo(f'  #{version} {name}')
+                return
+            applied = upgrade_schema(db.engine)
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        click.echo(f'✓ Database upgraded successfully to version {SCHEMA_VERSION}!')
+        for version, name, summary in applied:
+            click.echo(f'  #{version} {name}: {summary or "nothing to do"}')
+
+
+# Kept for scripts written before schema versioning.
+cli.add_command(upgrade, 'migrate')
+
+
+@cli.command()
+@click.option('--dir', 'backup_dir', type=click.Path(file_okay=False),
+              help='Backup directory (default: BACKUP_DIR or <db>-backups)')
+@click.option('--compress', is_flag=True, help='Gzip the backup')
+@click.option('--no-verify', is_flag=True, help='Skip the integrity check of the backup')
+@click.option('--keep', type=click.IntRange(min=0), help='Backups to keep, 0 for all (default: BACKUP_KEEP)')
+@click.option('--pages', type=click.IntRange(min=1), help='Pages copied per step (default: BACKUP_PAGES_PER_STEP)')
+@click.option('--sleep', type=click.FloatRange(min=0), help='Seconds to pause between steps (default: BACKUP_STEP_SLEEP)')
+@click.pass_context
+def backup(ctx, backup_dir, compress, no_verify, keep, pages, sleep):
+    """Back up the database while it stays in use."""
+    from app.backup import backup_database
+    
+    app = create_app('default', db_path=ctx.obj.get('db'), require_current_schema=False)
+    with app.app_context():
+        keep = app.config['BACKUP_KEEP'] if keep is None else keep
+        try:
+            result = backup_database(backup_dir, compress=compress, verify=not no_verify, keep=keep,
+                                     pages=pages, sleep=sleep)
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+    
+    click.echo('✓ Database backed up successfully!')
+    click.echo(f'  File: {result["path"]}')
+    click.echo(f'  Size: {result["size"] / 1024:.1f} KiB ({result["pages"]} pages)')
+    if result['version'] is not None:
+        click.echo(f'  Integrity: ok (schema version {result["version"]})')
+    for path in result['pruned']:
+        click.echo(f'  Deleted old backup: {os.path.basename(path)}')
+
+
+@cli.command()
+@click.option('--dir', 'backup_dir', type=click.Path(file_okay=False),
+              help='Backup directory (default: BACKUP_DIR or <db>-backups)')
+@click.pass_context
+def list_backups(ctx, backup_dir):
+    """List the backups of the database, newest first."""
+    from app.backup import default_backup_dir, list_backups as find_backups
+    
+    app = create_app('default', db_path=ctx.obj.get('db'), require_current_schema=False)
+    with app.app_context():
+        try:
+            backup_dir = os.path.abspath(backup_dir or default_backup_dir())
+            backups = find_backups(backup_dir)
+        except ValueError as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+    
+    if not backups:
+        click.echo(f'No backups found in {backup_dir}.')
+        return
+    table_data = [
+        [os.path.basename(b['path']), b['created_at'].strftime('%Y-%m-%d %H:%M:%S UTC'),
+         f'{b["size"] / 1024:.1f} KiB', 'yes' if b['compressed'] else 'no']
+        for b in backups
+    ]
+    click.echo('\n' + tabulate(table_data, headers=['File', 'Created', 'Size', 'Compressed'], tablefmt='grid'))
+    click.echo(f'\nDirectory: {backup_dir}')
+
+
+@cli.command()
+@click.argument('backup_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dir', 'backup_dir', type=click.Path(file_okay=False),
+              help='Where to back up the current database first (default: BACKUP_DIR or <db>-backups)')
+@click.option('--no-backup-first', is_flag=True, help='Do not back up the current database before replacing it')
+@click.option('--confirm', is_flag=True, help='Skip confirmation prompt')
+@click.pass_context
+def restore(ctx, backup_file, backup_dir, no_backup_first, confirm):
+    """Replace the database with a backup after checking the backup."""
+    from app.backup import restore_database
+    from app.schema import SCHEMA_VERSION
+    
+    app = create_app('default', db_path=ctx.obj.get('db'), require_current_schema=False)
+    with app.app_context():
+        if not confirm and not click.confirm(f'Replace the database with "{backup_file}"?'):
+            click.echo('Restore cancelled.')
+            sys.exit(0)
+        
+        try:
+            result = restore_database(backup_file, backup_current=not no_backup_first, backup_dir=backup_dir)
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+    
+    click.echo('✓ Database restored successfully!')
+    click.echo(f'  From: {os.path.abspath(backup_file)}')
+    if result['previous']:
+        click.echo(f'  Previous database backed up to: {result["previous"]}')
+    if result['version'] < SCHEMA_VERSION:
+        click.echo(f'  Schema version {result["version"]} is older than {SCHEMA_VERSION}: run the "upgrade" command.')
+
+
+@cli.group()
+def snapshot():
+    """Build and inspect memory-mapped analytics snapshot files."""
+
+
+@snapshot.command('build')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Snapshot file (default: <db>-snapshot.bin)')
+@click.option('--prune', is_flag=True,
+              help='Delete the change-log entries the snapshot already covers')
+@click.pass_context
+def build_snapshot(ctx, output, prune):
+    """Write every grade and student to a snapshot file."""
+    from app.snapshot import GradeSnapshot, default_snapshot_path, prune_change_log, write_snapshot_file
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        try:
+            path = os.path.abspath(output or default_snapshot_path())
+            connection = db.session.connection()
+            grades = GradeSnapshot.build(connection)
+            size = write_snapshot_file(grades, path)
+            pruned = prune_change_log(connection, grades.version) if prune else 0
+            db.session.commit()
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        click.echo('✓ Snapshot built successfully!')
+        click.echo(f'  File: {path}')
+        click.echo(f'  Data version: {grades.version}')
+        click.echo(f'  Grades: {len(grades)}')
+        click.echo(f'  Students: {len(grades.students)}')
+        click.echo(f'  Size: {size / 1024:.1f} KiB')
+        if prune:
+            click.echo(f'  Change-log entries pruned: {pruned}')
+
+
+@snapshot.command('info')
+@click.option('--file', 'path', type=click.Path(dir_okay=False),
+              help='Snapshot file (default: <db>-snapshot.bin)')
+@click.pass_context
+def snapshot_info(ctx, path):
+    """Show a snapshot file's contents and whether it is current."""
+    from app.snapshot import data_version, default_snapshot_path, read_snapshot_header
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        try:
+            path = os.path.abspath(path or default_snapshot_path())
+            if not os.path.exists(path):
+                click.echo(f'Error: Snapshot file "{path}" not found.', err=True)
+                sys.exit(1)
+            version, grades, students, subjects = read_snapshot_header(path)
+            current = data_version(db.session.connection())
+        except ValueError as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        table_data = [
+            ['File', path],
+            ['Size', f'{os.path.getsize(path) / 1024:.1f} KiB'],
+            ['Grades', grades],
+            ['Students', students],
+            ['Subjects', subjects],
+            ['Snapshot version', version],
+            ['Database version', current],
+            ['Status', 'current' if version == current else 'stale'],
+        ]
+        click.echo('\n' + tabulate(table_data, tablefmt='grid'))
+        click.echo()
+
+
+@cli.command()
+@click.option('--name', prompt=True, help='Term name, e.g. "2025-fall"')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), prompt=True, help='First day (YYYY-MM-DD)')
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']), prompt=True, help='Last day (YYYY-MM-DD)')
+@click.pass_context
+def add_term(ctx, name, start, end):
+    """Add an academic term."""
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        if TermService.get_term_by_name(name):
+            click.echo(f'Error: Term "{name}" already exists.', err=True)
+            sys.exit(1)
+        
+        try:
+            term = TermService.create_term(name, start.date(), end.date())
+            click.echo(f'✓ Term created successfully!')
+            click.echo(f'  Name: {term.name}')
+            click.echo(f'  Dates: {term.start_date} to {term.end_date}')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
+@cli.command()
+@click.pass_context
+def list_terms(ctx):
+    """List academic terms."""
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        terms = TermService.get_all_terms()
+        if not terms:
+            click.echo('No terms found.')
+            sys.exit(0)
+        
+        current = TermService.get_current_term()
+        table_data = []
+        for term in terms:
+            if term.is_archived:
+                status = f'archived ({term.archive_path})'
+            elif current is not None and term.id == current.id:
+                status = 'current'
+            elif term.is_closed():
+                status = 'closed'
+            else:
+                status = 'upcoming'
+            table_data.append([term.name, term.start_date, term.end_date, status])
+        
+        headers = ['Term', 'Start', 'End', 'Status']
+        click.echo('\n' + tabulate(table_data, headers=headers, tablefmt='grid'))
+        click.echo()
+
+
+@cli.command()
+@click.option('--term', 'term_name', required=True, help='Name of the closed term to archive')
+@click.option('--archive', 'archive_path', type=click.Path(dir_okay=False),
+              help='Archive database file (default: <db>-archive.db)')
+@click.option('--vacuum', is_flag=True, help='Reclaim free space in the main database afterwards')
+@click.option('--force', is_flag=True, help='Archive even if the term has not ended yet')
+@click.pass_context
+def archive_term(ctx, term_name, archive_path, vacuum, force):
+    """Move a closed term's grades into a separate archive database."""
+    from app.archive import archive_term as move_term_to_archive, default_archive_path
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        term = TermService.get_term_by_name(term_name)
+        if not term:
+            click.echo(f'Error: Term "{term_name}" not found.', err=True)
+            sys.exit(1)
+        if term.is_archived:
+            click.echo(f'Error: Term "{term_name}" is already archived in {term.archive_path}.', err=True)
+            sys.exit(1)
+        if not term.is_closed() and not force:
+            click.echo(f'Error: Term "{term_name}" has not ended yet (use --force to archive anyway).', err=True)
+            sys.exit(1)
+        
+        try:
+            path = os.path.abspath(archive_path or default_archive_path())
+            moved = move_term_to_archive(term, path, vacuum=vacuum)
+            click.echo(f'✓ Term archived successfully!')
+            click.echo(f'  Archive: {path}')
+            click.echo(f'  Grades moved: {moved}')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
 @cli.command()
 @click.option('--output', default='students.csv', help='Output CSV filename')
+@term_option
+@all_schools_option
+@snapshot_option
 @click.pass_context
-def export_students(ctx, output):
+def export_students(ctx, output, term_name, all_schools, snapshot_file):
     """Export students data to CSV file."""
-    app = get_app(ctx.obj.get('db'))
+    app = get_district_app(ctx) if all_schools else get_app(ctx.obj.get('db'))
+    use_snapshot_file(app, snapshot_file)
     with app.app_context():
+        term = None if all_schools else resolve_term_or_exit(term_name)
         try:
-            csv_data = ExportService.export_students_to_csv()
+            if all_schools:
+                csv_data = DistrictService.export_students_to_csv(term_name)
+            else:
+                csv_data = ExportService.export_students_to_csv(term=term)
             with open(output, 'w') as f:
                 f.write(csv_data)
             
@@ -361,13 +1475,21 @@ def export_students(ctx, output):
 
 @cli.command()
 @click.option('--output', default='grades.csv', help='Output CSV filename')
+@term_option
+@all_schools_option
+@snapshot_option
 @click.pass_context
-def export_grades(ctx, output):
+def export_grades(ctx, output, term_name, all_schools, snapshot_file):
     """Export grades data to CSV file."""
-    app = get_app(ctx.obj.get('db'))
+    app = get_district_app(ctx) if all_schools else get_app(ctx.obj.get('db'))
+    use_snapshot_file(app, snapshot_file)
     with app.app_context():
+        term = None if all_schools else resolve_term_or_exit(term_name)
         try:
-            csv_data = ExportService.export_grades_to_csv()
+            if all_schools:
+                csv_data = DistrictService.export_grades_to_csv(term_name)
+            else:
+                csv_data = ExportService.export_grades_to_csv(term=term)
             with open(output, 'w') as f:
                 f.write(csv_data)
             
@@ -381,5 +1503,77 @@ def export_grades(ctx, output):
             sys.exit(1)
 
 
+@cli.command()
+@click.option('--output', default='pivot.csv', help='Output CSV filename')
+@term_option
+@click.option('--aggregate', type=click.Choice(ExportService.PIVOT_AGGREGATES), default='latest',
+              show_default=True, help='Score shown for a student with several grades in a subject')
+@snapshot_option
+@click.pass_context
+def export_pivot(ctx, output, term_name, aggregate, snapshot_file):
+    """Export a student × subject grade matrix to CSV file."""
+    app = get_app(ctx.obj.get('db'))
+    use_snapshot_file(app, snapshot_file)
+    with app.app_context():
+        term = resolve_term_or_exit(term_name)
+        try:
+            headers, rows = ExportService.pivot(term=term, aggregate=aggregate)
+            student_count = 0
+            with open(output, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                for row in rows:
+                    writer.writerow(row)
+                    student_count += 1
+            
+            click.echo(f'✓ Grade matrix exported successfully!')
+            click.echo(f'  File: {output}')
+            click.echo(f'  Students: {student_count}')
+            click.echo(f'  Subjects: {len(headers) - 3}')
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+
+
+@cli.command()
+@click.option('--output-dir', default='report_cards', show_default=True,
+              type=click.Path(file_okay=False), help='Directory to write the report cards to')
+@term_option
+@click.option('--workers', type=click.IntRange(min=1), default=os.cpu_count() or 1,
+              show_default='CPU count', help='Rendering processes')
+@click.option('--batch-size', type=click.IntRange(min=1), default=50, show_default=True,
+              help='Report cards sent to a worker at a time')
+@click.option('--force', is_flag=True, help='Re-render cards that already exist instead of resuming')
+@click.pass_context
+def render_report_cards(ctx, output_dir, term_name, workers, batch_size, force):
+    """Render an HTML report card for every student with grades."""
+    from app.report_cards import render_report_cards as render_cards
+    from app.services import ReportCardService
+    
+    app = get_app(ctx.obj.get('db'))
+    with app.app_context():
+        term = resolve_term_or_exit(term_name)
+        total = ReportCardService.count_students(term=term)
+        if not total:
+            click.echo('No grades found.')
+            sys.exit(0)
+        
+        try:
+            with click.progressbar(length=total, label='Rendering report cards') as bar:
+                stats = render_cards(term, output_dir, workers=workers, batch_size=batch_size,
+                                     resume=not force, progress=bar.update)
+        except Exception as e:
+            click.echo(f'Error: {str(e)}', err=True)
+            sys.exit(1)
+        
+        seconds = stats['seconds']
+        click.echo(f'✓ Report cards rendered successfully!')
+        click.echo(f'  Directory: {os.path.abspath(output_dir)}')
+        click.echo(f'  Rendered: {stats["rendered"]}')
+        if stats['skipped']:
+            click.echo(f'  Skipped (already rendered): {stats["skipped"]}')
+        click.echo(f'  Time: {seconds:.2f}s ({stats["rendered"] / seconds if seconds else 0:.1f} cards/s)')
+
+
 if __name__ == '__main__':
     cli(obj={})
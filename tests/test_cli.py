@@ -4,9 +4,17 @@ import tempfile
 from click.testing import CliRunner
 from cli.commands import cli
 from app import create_app
+from app.config import Config
 from app.models import db, Student, Grade
 
 
+@pytest.fixture(autouse=True)
+def raise_on_lazy_load(monkeypatch):
+    """Fail commands that lazy-load a relationship, as the web tests do."""
+    monkeypatch.setattr(Config, 'RAISE_ON_LAZY_LOAD', True)
+    monkeypatch.setenv('RAISE_ON_LAZY_LOAD', '1')
+
+
 @pytest.fixture
 def temp_db():
     """Create a temporary database for CLI testing."""
@@ -356,6 +364,7 @@ class TestEditGrade:
         ])
         assert result.exit_code == 0
         assert 'Grade updated successfully' in result.output
+        assert 'Student: John Doe' in result.output
         assert '95' in result.output
     
     def test_edit_grade_not_found(self, cli_runner, temp_db):
@@ -584,6 +593,92 @@ class TestRankings:
         assert 'Alice Smith' in result.output
         assert 'Bob Johnson' in result.output
         # Alice should be ranked higher (average 92.5 vs 85)
+    
+    def test_rankings_filters(self, cli_runner, temp_db):
+        """Test subject, minimum grade count and limit options."""
+        for name, email in [('Alice Smith', 'alice@example.com'),
+                            ('Bob Johnson', 'bob@example.com'),
+                            ('Charlie Brown', 'charlie@example.com')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-student',
+                '--name', name,
+                '--email', email
+            ])
+        for student_id, subject, score in [('1', 'Math', '70'), ('1', 'English', '100'),
+                                           ('2', 'Math', '90'), ('3', 'Math', '80'),
+                                           ('3', 'English', '60')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', student_id,
+                '--subject', subject,
+                '--score', score
+            ])
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--subject', 'math',
+            '--limit', '2'
+        ])
+        assert result.exit_code == 0
+        assert 'Subject: math' in result.output
+        assert 'Bob Johnson' in result.output
+        assert 'Charlie Brown' in result.output
+        assert 'Alice Smith' not in result.output
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--min-grades', '2'
+        ])
+        assert 'Alice Smith' in result.output
+        assert 'Bob Johnson' not in result.output
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--subject', 'Art'
+        ])
+        assert 'No rankings available' in result.output
+    
+    def test_rank_student(self, cli_runner, temp_db):
+        """Test looking up one student's rank."""
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-student',
+                '--name', name,
+                '--email', email
+            ])
+        for student_id, score in [('1', '80'), ('2', '90')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', student_id,
+                '--subject', 'Math',
+                '--score', score
+            ])
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rank',
+            '--student-id', '1'
+        ])
+        assert result.exit_code == 0
+        assert 'Alice Smith is ranked #2 of 2' in result.output
+        assert 'Average: 80.00 over 1 grade(s)' in result.output
+    
+    def test_rank_student_not_found(self, cli_runner, temp_db):
+        """Test rank lookup for a missing student."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rank',
+            '--student-id', '999'
+        ])
+        assert result.exit_code == 1
+        assert 'not found' in result.output
 
 
 class TestExportStudents:
@@ -691,6 +786,32 @@ class TestExportGrades:
         os.remove('test_grades.csv')
 
 
+class TestExportPivot:
+    def test_export_pivot_success(self, cli_runner, temp_db, tmp_path):
+        """Test exporting the student × subject matrix."""
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', 'John Doe', '--email', 'john@example.com'])
+        for subject, score in [('Math', '80'), ('Math', '90'), ('Art', '70')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade', '--student-id', '1', '--subject', subject, '--score', score
+            ])
+        
+        output = tmp_path / 'pivot.csv'
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'export-pivot',
+            '--output', str(output),
+            '--aggregate', 'mean'
+        ])
+        assert result.exit_code == 0
+        assert 'Students: 1' in result.output
+        assert 'Subjects: 2' in result.output
+        assert output.read_text().splitlines() == [
+            'ID,Name,Email,Art,Math',
+            '1,John Doe,john@example.com,70.0,85.0'
+        ]
+
+
 class TestDatabaseFlag:
     def test_cli_with_custom_db_path(self, cli_runner):
         """Test CLI with custom database path."""
@@ -729,3 +850,1389 @@ class TestExitCodes:
             '--email', 'test@example.com'
         ])
         assert result.exit_code == 1
+
+
+class TestStats:
+    def test_stats_empty(self, cli_runner, temp_db):
+        """Test stats with no grades."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'stats'
+        ])
+        assert result.exit_code == 0
+        assert 'No grades found' in result.output
+    
+    def test_stats_groups_subject_variants(self, cli_runner, temp_db):
+        """Test that differently cased subject names share one bucket."""
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-student',
+            '--name', 'John Doe',
+            '--email', 'john@example.com'
+        ])
+        for subject, score in [('Math', '80'), ('  math ', '90'), ('English', '70')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', '1',
+                '--subject', subject,
+                '--score', score
+            ])
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'stats'
+        ])
+        assert result.exit_code == 0
+        assert result.output.count('Math') == 1
+        assert 'math' not in result.output
+        assert '85' in result.output
+        assert 'English' in result.output
+
+
+class TestMigrate:
+    def _create_legacy_db(self, path):
+        import sqlite3
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE students (
+                id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL,
+                email VARCHAR(120) NOT NULL UNIQUE, created_at DATETIME
+            );
+            CREATE TABLE grades (
+                id INTEGER PRIMARY KEY,
+                student_id INTEGER NOT NULL REFERENCES students (id),
+                subject VARCHAR(100) NOT NULL, score FLOAT NOT NULL,
+                created_at DATETIME
+            );
+            INSERT INTO students VALUES (1, 'John Doe', 'john@example.com', '2024-01-01 00:00:00');
+            INSERT INTO grades VALUES (1, 1, 'Math', 80, '2024-01-02 00:00:00');
+            INSERT INTO grades VALUES (2, 1, 'math ', 90, '2024-01-03 00:00:00');
+            INSERT INTO grades VALUES (3, 1, 'History', 70, '2024-01-04 00:00:00');
+        ''')
+        conn.commit()
+        conn.close()
+    
+    def test_migrate_legacy_subjects(self, cli_runner, temp_db):
+        """Test converting free-text subjects into the lookup table."""
+        self._create_legacy_db(temp_db)
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'migrate'
+        ])
+        assert result.exit_code == 0
+        assert 'subjects: 3 grade row(s) converted' in result.output
+        assert 'change_log: change-log triggers installed on students' in result.output
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'list-grades'
+        ])
+        assert result.exit_code == 0
+        assert 'History' in result.output
+        assert 'math ' not in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            from app.models import Subject
+            assert Subject.query.count() == 2
+            assert Grade.query.filter_by(subject='Math').count() == 2
+    
+    def test_migrate_adds_delete_cascade(self, cli_runner, temp_db):
+        """Test rebuilding a grades table that lacks ON DELETE CASCADE."""
+        import sqlite3
+        conn = sqlite3.connect(temp_db)
+        conn.executescript('''
+            CREATE TABLE students (
+                id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL,
+                email VARCHAR(120) NOT NULL UNIQUE, created_at DATETIME
+            );
+            CREATE TABLE subjects (
+                id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL,
+                key VARCHAR(100) NOT NULL UNIQUE
+            );
+            CREATE TABLE grades (
+                id INTEGER PRIMARY KEY,
+                student_id INTEGER NOT NULL REFERENCES students (id),
+                subject_id INTEGER NOT NULL REFERENCES subjects (id),
+                term_id INTEGER, score FLOAT NOT NULL, created_at DATETIME
+            );
+            CREATE INDEX ix_grades_subject_id ON grades (subject_id);
+            INSERT INTO students VALUES (1, 'John Doe', 'john@example.com', '2024-01-01 00:00:00');
+            INSERT INTO subjects VALUES (1, 'Math', 'math');
+            INSERT INTO grades VALUES (1, 1, 1, NULL, 80, '2024-01-02 00:00:00');
+        ''')
+        conn.commit()
+        conn.close()
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'migrate'
+        ])
+        assert result.exit_code == 0
+        assert 'cascade: 1 grade row(s) rebuilt' in result.output
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--ids', '1',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Grades: 1' in result.output
+    
+    def test_migrate_up_to_date(self, cli_runner, temp_db):
+        """Test that migrating a current database is a no-op."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'migrate'
+        ])
+        assert result.exit_code == 0
+        assert 'already up to date' in result.output
+
+
+class TestUpgrade:
+    def test_new_database_is_stamped_current(self, temp_db):
+        """Test that a new database is created at the current version without DDL on reopen."""
+        from sqlalchemy import create_engine, event
+        from app.schema import SCHEMA_VERSION, check_schema
+        
+        create_app('default', db_path=temp_db)
+        engine = create_engine(f'sqlite:///{temp_db}')
+        statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        check_schema(engine)
+        assert statements and all(s.startswith(('SELECT', 'BEGIN')) for s in statements)
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql('SELECT version FROM schema_version').scalar() == SCHEMA_VERSION
+        engine.dispose()
+    
+    def test_outdated_database_requires_upgrade(self, cli_runner, temp_db):
+        """Test that commands refuse an outdated schema until it is upgraded."""
+        from sqlalchemy import inspect
+        from app.schema import SCHEMA_VERSION, SchemaVersionError
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            db.session.execute(db.text('DROP INDEX ix_grades_student_created'))
+            db.session.execute(db.text('UPDATE schema_version SET version = 5'))
+            db.session.commit()
+            db.engine.dispose()
+        with pytest.raises(SchemaVersionError):
+            create_app('default', db_path=temp_db)
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'list-students'])
+        assert result.exit_code == 1
+        assert 'Run the "upgrade" command first' in result.output
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'upgrade', '--dry-run'])
+        assert result.exit_code == 0
+        assert '#6 trends' in result.output
+        assert '#7 grade_dates' in result.output
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'upgrade'])
+        assert result.exit_code == 0
+        assert f'version {SCHEMA_VERSION}' in result.output
+        assert '#6 trends: nothing to do' in result.output
+        assert '#7 grade_dates: added ix_grades_student_created' in result.output
+        assert '#5' not in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            indexes = {index['name'] for index in inspect(db.engine).get_indexes('grades')}
+            assert 'ix_grades_student_created' in indexes
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'list-students'])
+        assert result.exit_code == 0
+    
+    def test_upgrade_normalizes_emails_and_reports_collisions(self, cli_runner, temp_db):
+        """Test that the email migration normalizes in bulk and leaves collisions for review."""
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            db.session.execute(db.text(
+                "INSERT INTO students (id, name, email) VALUES "
+                "(1, 'Ann', ' Ann@Example.com'), (2, 'Ann B', 'ann@example.com'), "
+                "(3, 'Cy', 'CY@example.com'), (4, 'Dee', 'Dee@Example.com'), (5, 'Dee 2', 'DEE@example.com')"
+            ))
+            db.session.execute(db.text('UPDATE schema_version SET version = 7'))
+            db.session.commit()
+            db.engine.dispose()
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'upgrade'])
+        assert result.exit_code == 0
+        assert '#8 emails: 2 email(s) normalized; 2 address(es) shared by several students' in result.output
+        assert 'ann@example.com (students 1, 2)' in result.output
+        assert 'dee@example.com (students 4, 5)' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            emails = dict(db.session.execute(db.text('SELECT id, email FROM students')).all())
+            assert emails == {
+                1: ' Ann@Example.com', 2: 'ann@example.com', 3: 'cy@example.com',
+                4: 'dee@example.com', 5: 'DEE@example.com'
+            }
+
+
+class TestTerms:
+    def _setup_terms(self, cli_runner, temp_db):
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-term',
+            '--name', '2023-fall',
+            '--start', '2023-09-01',
+            '--end', '2023-12-31'
+        ])
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-term',
+            '--name', '2024-spring',
+            '--start', '2024-01-01',
+            '--end', '2024-06-30'
+        ])
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-student',
+                '--name', name,
+                '--email', email
+            ])
+        for student_id, term, score in [('1', '2023-fall', '95'), ('2', '2023-fall', '60'),
+                                        ('1', '2024-spring', '50'), ('2', '2024-spring', '99')]:
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', student_id,
+                '--subject', 'Math',
+                '--score', score,
+                '--term', term
+            ])
+            assert result.exit_code == 0
+    
+    def test_add_and_list_terms(self, cli_runner, temp_db):
+        """Test creating and listing terms."""
+        self._setup_terms(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'list-terms'
+        ])
+        assert result.exit_code == 0
+        assert '2023-fall' in result.output
+        assert 'closed' in result.output
+    
+    def test_rankings_scoped_to_term(self, cli_runner, temp_db):
+        """Test that rankings only include the selected term's grades."""
+        self._setup_terms(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--term', '2023-fall'
+        ])
+        assert result.exit_code == 0
+        assert 'Term: 2023-fall' in result.output
+        assert result.output.index('Alice Smith') < result.output.index('Bob Johnson')
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--term', '2024-spring'
+        ])
+        assert result.output.index('Bob Johnson') < result.output.index('Alice Smith')
+    
+    def test_rankings_unknown_term(self, cli_runner, temp_db):
+        """Test selecting a term that does not exist."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings',
+            '--term', 'nope'
+        ])
+        assert result.exit_code == 1
+        assert 'not found' in result.output
+    
+    def test_archive_term(self, cli_runner, temp_db):
+        """Test moving a closed term to the archive and reading it back."""
+        self._setup_terms(cli_runner, temp_db)
+        archive_path = temp_db + '.archive'
+        try:
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'archive-term',
+                '--term', '2023-fall',
+                '--archive', archive_path,
+                '--vacuum'
+            ])
+            assert result.exit_code == 0
+            assert 'Grades moved: 2' in result.output
+            
+            app = create_app('default', db_path=temp_db)
+            with app.app_context():
+                assert Grade.query.count() == 2
+            
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'rankings',
+                '--term', '2023-fall'
+            ])
+            assert result.exit_code == 0
+            assert result.output.index('Alice Smith') < result.output.index('Bob Johnson')
+            assert '95' in result.output
+            
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'export-grades',
+                '--term', '2023-fall',
+                '--output', 'test_archived_grades.csv'
+            ])
+            assert result.exit_code == 0
+            assert 'Records: 2' in result.output
+            os.remove('test_archived_grades.csv')
+            
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', '1',
+                '--subject', 'Math',
+                '--score', '70',
+                '--term', '2023-fall'
+            ])
+            assert result.exit_code == 1
+            assert 'archived' in result.output
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+    
+    def test_archive_open_term_requires_force(self, cli_runner, temp_db):
+        """Test that a term which has not ended is not archived by default."""
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-term',
+            '--name', 'future',
+            '--start', '2020-01-01',
+            '--end', '2999-12-31'
+        ])
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'archive-term',
+            '--term', 'future',
+            '--archive', temp_db + '.archive'
+        ])
+        assert result.exit_code == 1
+        assert 'has not ended' in result.output
+
+
+class TestShards:
+    @pytest.fixture
+    def registry(self, tmp_path):
+        import json
+        path = tmp_path / 'schools.json'
+        path.write_text(json.dumps({'north': 'north.db', 'south': 'south.db'}))
+        return str(path)
+    
+    def _add(self, cli_runner, registry, school, name, email, scores):
+        result = cli_runner.invoke(cli, [
+            '--shards', registry, '--school', school,
+            'add-student', '--name', name, '--email', email
+        ])
+        assert result.exit_code == 0
+        student_id = result.output.strip().split('ID: ')[-1]
+        for subject, score in scores:
+            cli_runner.invoke(cli, [
+                '--shards', registry, '--school', school,
+                'add-grade', '--student-id', student_id,
+                '--subject', subject, '--score', score
+            ])
+    
+    def _populate(self, cli_runner, registry):
+        self._add(cli_runner, registry, 'north', 'Alice Smith', 'alice@example.com', [('Math', '90')])
+        self._add(cli_runner, registry, 'north', 'Carol White', 'carol@example.com', [('Math', '70')])
+        self._add(cli_runner, registry, 'south', 'Bob Johnson', 'bob@example.com', [('math', '80')])
+    
+    def test_school_routing(self, cli_runner, registry):
+        """Test that --school selects the shard's database."""
+        self._populate(cli_runner, registry)
+        result = cli_runner.invoke(cli, [
+            '--shards', registry, '--school', 'south',
+            'list-students'
+        ])
+        assert result.exit_code == 0
+        assert 'Bob Johnson' in result.output
+        assert 'Alice Smith' not in result.output
+    
+    def test_unknown_school(self, cli_runner, registry):
+        """Test selecting a school that is not registered."""
+        result = cli_runner.invoke(cli, [
+            '--shards', registry, '--school', 'east',
+            'list-students'
+        ])
+        assert result.exit_code == 1
+        assert 'not in the shard registry' in result.output
+    
+    def test_federated_rankings(self, cli_runner, registry):
+        """Test that rankings merge every school in order."""
+        self._populate(cli_runner, registry)
+        result = cli_runner.invoke(cli, [
+            '--shards', registry,
+            'rankings', '--all-schools'
+        ])
+        assert result.exit_code == 0
+        assert 'School' in result.output
+        output = result.output
+        assert output.index('Alice Smith') < output.index('Bob Johnson') < output.index('Carol White')
+        
+        result = cli_runner.invoke(cli, [
+            '--shards', registry,
+            'rankings', '--all-schools', '--limit', '2'
+        ])
+        assert 'Bob Johnson' in result.output
+        assert 'Carol White' not in result.output
+    
+    def test_federated_stats(self, cli_runner, registry):
+        """Test that subject statistics combine across schools."""
+        self._populate(cli_runner, registry)
+        result = cli_runner.invoke(cli, [
+            '--shards', registry,
+            'stats', '--all-schools'
+        ])
+        assert result.exit_code == 0
+        assert result.output.count('Math') == 1
+        assert '|        3 |' in result.output
+    
+    def test_federated_export(self, cli_runner, registry, tmp_path):
+        """Test that grade exports are merged by student name."""
+        self._populate(cli_runner, registry)
+        output = str(tmp_path / 'district.csv')
+        result = cli_runner.invoke(cli, [
+            '--shards', registry,
+            'export-grades', '--all-schools', '--output', output
+        ])
+        assert result.exit_code == 0
+        with open(output) as f:
+            lines = f.read().strip().split('\n')
+        assert lines[0].startswith('School,Grade ID')
+        assert [line.split(',')[0] for line in lines[1:]] == ['north', 'south', 'north']
+    
+    def test_all_schools_requires_registry(self, cli_runner, temp_db):
+        """Test --all-schools without a shard registry."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'rankings', '--all-schools'
+        ])
+        assert result.exit_code == 1
+        assert 'shard registry' in result.output
+
+
+class TestBulkDelete:
+    def _populate(self, cli_runner, temp_db, count=5):
+        for i in range(1, count + 1):
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-student',
+                '--name', f'Student {i}',
+                '--email', f'student{i}@example.com'
+            ])
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', str(i),
+                '--subject', 'Math',
+                '--score', '80'
+            ])
+    
+    def test_bulk_delete_students_by_ids(self, cli_runner, temp_db):
+        """Test deleting a list of students and cascading to their grades."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--ids', '1,2,3,999',
+            '--chunk-size', '2',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Students: 3' in result.output
+        assert 'Grades: 3' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert Student.query.count() == 2
+            assert Grade.query.count() == 2
+    
+    def test_bulk_delete_students_from_file(self, cli_runner, temp_db, tmp_path):
+        """Test reading student IDs from a file."""
+        self._populate(cli_runner, temp_db)
+        ids_file = tmp_path / 'ids.txt'
+        ids_file.write_text('4\n5\n')
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--ids-file', str(ids_file),
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Students: 2' in result.output
+    
+    def test_bulk_delete_students_created_before(self, cli_runner, temp_db):
+        """Test deleting every student created before a date."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--created-before', '2999-01-01',
+            '--chunk-size', '2',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Students: 5' in result.output
+        assert 'Grades: 5' in result.output
+    
+    def test_bulk_delete_requires_filter(self, cli_runner, temp_db):
+        """Test that a filter is required."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--confirm'
+        ])
+        assert result.exit_code == 1
+        assert 'Provide --ids' in result.output
+    
+    def test_bulk_delete_cancelled(self, cli_runner, temp_db):
+        """Test declining the confirmation prompt."""
+        self._populate(cli_runner, temp_db, count=1)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-students',
+            '--ids', '1'
+        ], input='n\n')
+        assert 'Delete 1 student(s)' in result.output
+        assert 'Deletion cancelled' in result.output
+    
+    def test_bulk_delete_grades(self, cli_runner, temp_db):
+        """Test deleting grades by ID."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'bulk-delete-grades',
+            '--ids', '1,2',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Grades: 2' in result.output
+
+
+class TestCurve:
+    def _populate(self, cli_runner, temp_db):
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-student',
+            '--name', 'John Doe',
+            '--email', 'john@example.com'
+        ])
+        for subject, score in [('Math', '60'), ('Math', '80'), ('Math', '98'), ('English', '50')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade',
+                '--student-id', '1',
+                '--subject', subject,
+                '--score', score
+            ])
+    
+    def _scores(self, temp_db, subject):
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            return sorted(g.score for g in Grade.query.filter_by(subject=subject).all())
+    
+    def test_curve_dry_run(self, cli_runner, temp_db):
+        """Test that a dry run previews without changing grades."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'curve',
+            '--subject', 'math',
+            '--method', 'add',
+            '--value', '5',
+            '--dry-run'
+        ])
+        assert result.exit_code == 0
+        assert '3 grade(s), 1 clamped' in result.output
+        assert 'Dry run' in result.output
+        assert self._scores(temp_db, 'Math') == [60, 80, 98]
+    
+    def test_curve_dry_run_does_not_take_write_lock(self, cli_runner, temp_db):
+        """Test that a preview runs while another connection holds the write lock."""
+        import sqlite3
+        
+        self._populate(cli_runner, temp_db)
+        writer = sqlite3.connect(temp_db, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            result = cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'curve', '--subject', 'Math', '--method', 'add', '--value', '5', '--dry-run'
+            ])
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+        assert result.exit_code == 0
+        assert '3 grade(s), 1 clamped' in result.output
+    
+    def test_curve_add_clamps(self, cli_runner, temp_db):
+        """Test an additive curve clamped to 100."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'curve',
+            '--subject', 'Math',
+            '--method', 'add',
+            '--value', '5',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Curve applied to 3 grade(s)' in result.output
+        assert self._scores(temp_db, 'Math') == [65, 85, 100]
+        assert self._scores(temp_db, 'English') == [50]
+    
+    def test_curve_target_mean(self, cli_runner, temp_db):
+        """Test rescaling to a target mean."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'curve',
+            '--subject', 'English',
+            '--method', 'mean',
+            '--value', '75',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert self._scores(temp_db, 'English') == [75]
+    
+    def test_curve_date_range(self, cli_runner, temp_db):
+        """Test that grades outside the date range are untouched."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'curve',
+            '--subject', 'Math',
+            '--method', 'multiply',
+            '--value', '2',
+            '--to', '2000-01-01',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'No matching grades found' in result.output
+    
+    def test_curve_unknown_subject(self, cli_runner, temp_db):
+        """Test curving a subject that does not exist."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'curve',
+            '--subject', 'Latin',
+            '--method', 'add',
+            '--value', '5'
+        ])
+        assert result.exit_code == 1
+        assert 'not found' in result.output
+
+
+class TestBenchmarkGrades:
+    def test_benchmark_grades(self, cli_runner, temp_db):
+        """Test both commit modes are reported without touching --db."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'benchmark-grades',
+            '--rows', '20',
+            '--threads', '2'
+        ])
+        assert result.exit_code == 0
+        assert 'per-row commit' in result.output
+        assert 'group commit' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert Grade.query.count() == 0
+
+
+class TestLockContention:
+    def test_concurrent_web_and_cli_writes(self, temp_db):
+        """Test concurrent web and CLI writers never surface a lock error."""
+        import subprocess
+        import sys
+        import threading
+        from app.retry import retry_stats
+        
+        app = create_app('testing', db_path=temp_db)
+        with app.app_context():
+            student = Student(name='Busy Student', email='busy@example.com')
+            db.session.add(student)
+            db.session.commit()
+            student_id = student.id
+        
+        web_threads, web_grades = 4, 25
+        cli_threads, cli_grades = 2, 3
+        errors = []
+        retry_stats.reset()
+        
+        def web_writer():
+            client = app.test_client()
+            for i in range(web_grades):
+                response = client.post(f'/grades/student/{student_id}/add', data={
+                    'student_id': student_id,
+                    'subject': 'Web',
+                    'score': 50 + i
+                }, follow_redirects=True)
+                if b'Grade added successfully!' not in response.data:
+                    errors.append(response.data)
+        
+        def cli_writer():
+            for i in range(cli_grades):
+                proc = subprocess.run([
+                    sys.executable, '-m', 'cli.commands',
+                    '--db', temp_db,
+                    'add-grade',
+                    '--student-id', str(student_id),
+                    '--subject', 'CLI',
+                    '--score', str(i)
+                ], capture_output=True, text=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+                if proc.returncode != 0:
+                    errors.append(proc.stderr)
+        
+        threads = [threading.Thread(target=web_writer) for _ in range(web_threads)]
+        threads += [threading.Thread(target=cli_writer) for _ in range(cli_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert errors == []
+        assert retry_stats.totals()['failures'] == 0
+        with app.app_context():
+            assert Grade.query.count() == web_threads * web_grades + cli_threads * cli_grades
+    
+    def test_import_grades_alongside_writer(self, temp_db, tmp_path, monkeypatch):
+        """Test an import completes while another thread keeps adding grades."""
+        import threading
+        from app.config import TestingConfig
+        from app.importer import import_grades
+        from app.retry import retry_stats
+        from app.services import GradeService
+        
+        # A short busy timeout makes the two writers collide on most chunks.
+        monkeypatch.setattr(TestingConfig, 'DB_BUSY_TIMEOUT', 0.01)
+        app = create_app('testing', db_path=temp_db)
+        app.config.update(DB_RETRY_ATTEMPTS=200, DB_RETRY_BASE_DELAY=0.005, DB_RETRY_MAX_DELAY=0.05)
+        with app.app_context():
+            student = Student(name='Busy Student', email='busy@example.com')
+            db.session.add(student)
+            db.session.commit()
+            student_id = student.id
+        
+        rows = 2000
+        path = tmp_path / 'grades.csv'
+        path.write_text('student_id,subject,score\n' + ''.join(
+            f'{student_id},Subject {n % 7},{n % 100}\n' for n in range(rows)
+        ))
+        done = threading.Event()
+        errors, written = [], []
+        retry_stats.reset()
+        
+        def writer():
+            with app.app_context():
+                try:
+                    while not done.is_set():
+                        GradeService.create_grade(student_id, 'Live', 50.0)
+                        written.append(1)
+                        db.session.remove()
+                except Exception as e:
+                    errors.append(e)
+        
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            with app.app_context(), open(path, newline='') as f:
+                result = import_grades(f, workers=1, chunk_size=50)
+        finally:
+            done.set()
+            thread.join()
+        
+        assert errors == []
+        assert result['written'] == rows
+        assert retry_stats.totals()['failures'] == 0
+        with app.app_context():
+            assert Grade.query.filter(Grade.subject != 'Live').count() == rows
+            assert Grade.query.filter_by(subject='Live').count() == len(written)
+
+
+class TestSyncRoster:
+    def _populate(self, cli_runner, temp_db):
+        for name, email in [('Alice Smith', 'alice@example.com'),
+                            ('Bob Johnson', 'Bob@Example.com'),
+                            ('Charlie Brown', 'charlie@example.com')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-student',
+                '--name', name,
+                '--email', email
+            ])
+    
+    def _roster(self, tmp_path):
+        path = tmp_path / 'roster.csv'
+        path.write_text(
+            'Name,Email\n'
+            'Alice Smith,alice@example.com\n'
+            'Robert Johnson, bob@example.com \n'
+            'Dana White,DANA@example.com\n'
+            ',nobody@example.com\n'
+        )
+        return str(path)
+    
+    def test_sync_roster_dry_run(self, cli_runner, temp_db, tmp_path):
+        """Test the diff report without applying it."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'sync-roster', self._roster(tmp_path),
+            '--delete-missing',
+            '--dry-run'
+        ])
+        assert result.exit_code == 0
+        assert '1 to add, 1 to update, 1 to delete, 1 unchanged, 1 invalid' in result.output
+        assert 'Bob Johnson -> Robert Johnson' in result.output
+        assert 'Dry run' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert Student.query.count() == 3
+    
+    def test_sync_roster_apply(self, cli_runner, temp_db, tmp_path):
+        """Test applying inserts, updates and deletes."""
+        self._populate(cli_runner, temp_db)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'sync-roster', self._roster(tmp_path),
+            '--delete-missing',
+            '--chunk-size', '1',
+            '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'Added: 1' in result.output
+        assert 'Updated: 1' in result.output
+        assert 'Deleted: 1' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            students = {s.email: s.name for s in Student.query.all()}
+            assert students == {
+                'alice@example.com': 'Alice Smith',
+                'bob@example.com': 'Robert Johnson',
+                'dana@example.com': 'Dana White'
+            }
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'sync-roster', self._roster(tmp_path),
+            '--confirm'
+        ])
+        assert 'already in sync' in result.output
+    
+    def test_sync_roster_missing_columns(self, cli_runner, temp_db, tmp_path):
+        """Test a roster without the required columns."""
+        path = tmp_path / 'bad.csv'
+        path.write_text('first,last\nA,B\n')
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'sync-roster', str(path)
+        ])
+        assert result.exit_code == 1
+        assert '"name" and "email"' in result.output
+
+
+class TestSnapshotFile:
+    def _populate(self, cli_runner, temp_db):
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', email])
+        for student_id, subject, score in [('1', 'Math', '95'), ('1', 'Art', '75'), ('2', 'Math', '85')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade', '--student-id', student_id, '--subject', subject, '--score', score
+            ])
+    
+    def test_snapshot_build_and_info(self, cli_runner, temp_db, tmp_path):
+        """Test building a snapshot file and detecting when it goes stale."""
+        self._populate(cli_runner, temp_db)
+        path = str(tmp_path / 'grades.bin')
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'snapshot', 'build', '--output', path])
+        assert result.exit_code == 0
+        assert 'Snapshot built successfully' in result.output
+        assert 'Grades: 3' in result.output
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'snapshot', 'info', '--file', path])
+        assert result.exit_code == 0
+        assert 'current' in result.output
+        
+        cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'add-grade', '--student-id', '2', '--subject', 'Art', '--score', '65'
+        ])
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'snapshot', 'info', '--file', path])
+        assert 'stale' in result.output
+    
+    def test_snapshot_info_missing_file(self, cli_runner, temp_db, tmp_path):
+        """Test inspecting a snapshot file that does not exist."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'snapshot', 'info', '--file', str(tmp_path / 'missing.bin')
+        ])
+        assert result.exit_code == 1
+        assert 'not found' in result.output
+    
+    def test_reports_from_snapshot_file(self, cli_runner, temp_db, tmp_path):
+        """Test that reports read from current and stale snapshot files match SQL."""
+        from app.snapshot import MappedSnapshot, get_snapshot
+        
+        self._populate(cli_runner, temp_db)
+        path = str(tmp_path / 'grades.bin')
+        cli_runner.invoke(cli, ['--db', temp_db, 'snapshot', 'build', '--output', path, '--prune'])
+        
+        for command in (['rankings'], ['stats']):
+            expected = cli_runner.invoke(cli, ['--db', temp_db] + command).output
+            result = cli_runner.invoke(cli, ['--db', temp_db] + command + ['--snapshot', path])
+            assert result.exit_code == 0
+            assert result.output == expected
+        
+        app = create_app('default', db_path=temp_db)
+        app.config['SNAPSHOT_FILE'] = path
+        with app.app_context():
+            snapshot = get_snapshot()
+            assert isinstance(snapshot, MappedSnapshot)
+            assert list(snapshot.scores) == [95.0, 75.0, 85.0]
+            assert snapshot.students[2] == ('Bob Johnson', 'bob@example.com')
+        
+        cli_runner.invoke(cli, ['--db', temp_db, 'delete-grade', '--grade-id', '1', '--confirm'])
+        expected = cli_runner.invoke(cli, ['--db', temp_db, 'rankings']).output
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'rankings', '--snapshot', path])
+        assert result.output == expected
+        assert 'Bob Johnson' in expected.split('Alice Smith')[0]
+
+
+class TestRenderReportCards:
+    def _populate(self, cli_runner, temp_db):
+        for name, email in [('Alice <Smith>', 'alice@example.com'), ('Bob Johnson', 'bob@example.com'),
+                            ('Charlie Brown', 'charlie@example.com')]:
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', email])
+        for student_id, subject, score in [('1', 'Math', '95'), ('1', 'Art', '75'), ('2', 'Math', '85')]:
+            cli_runner.invoke(cli, [
+                '--db', temp_db,
+                'add-grade', '--student-id', student_id, '--subject', subject, '--score', score
+            ])
+    
+    def test_render_report_cards(self, cli_runner, temp_db, tmp_path):
+        """Test rendering report cards with worker processes and resuming."""
+        self._populate(cli_runner, temp_db)
+        output_dir = tmp_path / 'cards'
+        args = ['--db', temp_db, 'render-report-cards', '--output-dir', str(output_dir),
+                '--workers', '2', '--batch-size', '1']
+        result = cli_runner.invoke(cli, args)
+        assert result.exit_code == 0
+        assert 'Rendered: 2' in result.output
+        assert sorted(os.listdir(output_dir)) == ['student-1.html', 'student-2.html']
+        
+        card = (output_dir / 'student-1.html').read_text()
+        assert 'Alice &lt;Smith&gt;' in card
+        assert '85.00' in card
+        assert 'Art' in card and 'Math' in card
+        
+        (output_dir / 'student-2.html').unlink()
+        result = cli_runner.invoke(cli, args)
+        assert 'Rendered: 1' in result.output
+        assert 'Skipped (already rendered): 1' in result.output
+        
+        result = cli_runner.invoke(cli, args + ['--force', '--workers', '1'])
+        assert 'Rendered: 2' in result.output
+    
+    def test_render_report_cards_no_grades(self, cli_runner, temp_db, tmp_path):
+        """Test rendering when no student has grades."""
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'render-report-cards', '--output-dir', str(tmp_path / 'cards')
+        ])
+        assert result.exit_code == 0
+        assert 'No grades found' in result.output
+
+
+class TestAtRisk:
+    def test_at_risk(self, cli_runner, temp_db):
+        """Test listing students with a low average."""
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', email])
+        for student_id, scores in [('1', ['40', '50', '45']), ('2', ['90', '80', '85'])]:
+            for score in scores:
+                cli_runner.invoke(cli, [
+                    '--db', temp_db,
+                    'add-grade', '--student-id', student_id, '--subject', 'Math', '--score', score
+                ])
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'at-risk'])
+        assert result.exit_code == 0
+        assert 'Alice Smith' in result.output
+        assert 'average below 60' in result.output
+        assert 'Bob Johnson' not in result.output
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'at-risk', '--max-average', '95'])
+        assert 'Bob Johnson' in result.output
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'at-risk', '--min-grades', '4'])
+        assert 'No students at risk' in result.output
+
+
+class TestServe:
+    def test_benchmark_serve(self, cli_runner):
+        """Test serving a seeded database with one and two workers under load."""
+        result = cli_runner.invoke(cli, [
+            'benchmark-serve',
+            '--workers', '1,2',
+            '--duration', '0.5',
+            '--concurrency', '4',
+            '--students', '5'
+        ])
+        assert result.exit_code == 0, result.output
+        rows = [line for line in result.output.splitlines() if line.startswith('|') and 'Workers' not in line]
+        assert len(rows) == 2
+        assert all(row.split('|')[5].strip() == '0' for row in rows)
+    
+    def test_serve_survives_graceful_restart(self, tmp_path):
+        """Test that HUP replaces the workers while the server keeps answering."""
+        import signal
+        import time
+        import urllib.request
+        from app.loadtest import free_port, seed_database, start_server, stop_server
+        
+        db_path = str(tmp_path / 'serve.db')
+        student_ids = seed_database(db_path, students=3)
+        port = free_port()
+        process = start_server(db_path, port, workers=2)
+        try:
+            process.send_signal(signal.SIGHUP)
+            time.sleep(1)
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/grades/student/{student_ids[0]}') as response:
+                assert response.status == 200
+                assert b'Student 00001' in response.read()
+            assert process.poll() is None
+        finally:
+            stop_server(process)
+        assert process.returncode == 0
+    
+    def test_live_rankings_stream_outlives_worker_timeout(self, tmp_path):
+        """Test that an open rankings stream does not get its worker killed."""
+        import time
+        import urllib.request
+        from app.loadtest import free_port, seed_database, start_server, stop_server
+        
+        db_path = str(tmp_path / 'serve.db')
+        seed_database(db_path, students=3)
+        port = free_port()
+        process = start_server(db_path, port, workers=1, threads=1, timeout=1, extra_env={
+            'LIVE_RANKINGS_STREAM_SECONDS': '4', 'LIVE_RANKINGS_POLL_INTERVAL': '0.5'
+        })
+        try:
+            started = time.monotonic()
+            url = f'http://127.0.0.1:{port}/students/rankings/live?term=all&since=0'
+            with urllib.request.urlopen(url, timeout=10) as response:
+                body = response.read()
+            assert time.monotonic() - started >= 3.5
+            assert body.count(b': keepalive') >= 4
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=5) as response:
+                assert response.status == 200
+        finally:
+            stop_server(process)
+        assert process.returncode == 0
+    
+    def test_benchmark_serve_bad_workers(self, cli_runner):
+        """Test rejecting an invalid worker list."""
+        result = cli_runner.invoke(cli, ['benchmark-serve', '--workers', '1,x'])
+        assert result.exit_code == 2
+        assert 'comma-separated positive numbers' in result.output
+
+
+class TestLoadtest:
+    def test_loadtest_reports_routes(self, cli_runner, tmp_path):
+        """Test a mixed load test with form posts, saved results and a comparison."""
+        import json
+        
+        output = str(tmp_path / 'results.json')
+        args = [
+            'loadtest',
+            '--workers', '1',
+            '--duration', '1',
+            '--concurrency', '2',
+            '--students', '5',
+            '--mix', 'students=1,add_grade=1,add_student=1'
+        ]
+        result = cli_runner.invoke(cli, args + ['--output', output])
+        assert result.exit_code == 0, result.output
+        
+        with open(output) as f:
+            results = json.load(f)
+        assert results['config']['workers'] == 1
+        assert set(results['routes']) == {
+            'GET /students/', 'POST /grades/student/<id>/add', 'POST /students/create'
+        }
+        for stats in results['routes'].values():
+            assert stats['requests'] > 0
+            assert stats['errors'] == 0
+            assert stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms']
+        assert results['totals']['requests'] == sum(s['requests'] for s in results['routes'].values())
+        
+        result = cli_runner.invoke(cli, args + ['--compare', output])
+        assert result.exit_code == 0, result.output
+        assert 'p95 change' in result.output
+        assert '%' in result.output
+    
+    def test_loadtest_bad_mix(self, cli_runner):
+        """Test rejecting an unknown operation in the mix."""
+        result = cli_runner.invoke(cli, ['loadtest', '--mix', 'students=1,homepage=2'])
+        assert result.exit_code == 2
+        assert 'unknown operation "homepage"' in result.output
+
+
+class TestLookup:
+    def test_lookup_students(self, cli_runner, temp_db):
+        """Test looking up several students with chosen fields."""
+        for name in ('Ann', 'Ben'):
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', f'{name}@example.com'])
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-grade', '--student-id', '2', '--subject', 'Math', '--score', '70'])
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'lookup-students',
+            '--ids', '2,1,9',
+            '--fields', 'name,avg'
+        ])
+        assert result.exit_code == 0
+        lines = [line for line in result.output.splitlines() if line.startswith('|')]
+        assert [cell.strip() for cell in lines[0].strip('|').split('|')] == ['id', 'name', 'avg']
+        assert 'Ben' in lines[1] and '70' in lines[1]
+        assert 'Ann' in lines[2]
+        assert 'email' not in result.output
+        assert 'Not found: 9' in result.output
+    
+    def test_lookup_grades_json(self, cli_runner, temp_db, tmp_path):
+        """Test looking up grades from an IDs file as JSON."""
+        import json
+        
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', 'Ann', '--email', 'ann@example.com'])
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-grade', '--student-id', '1', '--subject', 'Math', '--score', '88'])
+        ids_file = tmp_path / 'ids.txt'
+        ids_file.write_text('1\n2\n')
+        
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'lookup-grades',
+            '--ids-file', str(ids_file),
+            '--fields', 'student,score',
+            '--json'
+        ])
+        assert result.exit_code == 0
+        assert json.loads(result.output) == {
+            'grades': [{'id': 1, 'student': 'Ann', 'score': 88.0}],
+            'missing': [2]
+        }
+    
+    def test_lookup_unknown_field(self, cli_runner, temp_db):
+        """Test rejecting a field that does not exist."""
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'lookup-students', '--ids', '1', '--fields', 'age'])
+        assert result.exit_code == 1
+        assert 'Unknown field(s): age' in result.output
+
+
+class TestImport:
+    def test_import_students(self, cli_runner, temp_db, tmp_path):
+        """Test importing students with invalid rows and duplicates across chunks."""
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', 'Alice Smith',
+                                '--email', 'alice@example.com'])
+        path = tmp_path / 'students.csv'
+        path.write_text(
+            'Name,Email\n'
+            'Alice Again,ALICE@example.com\n'
+            'Bob Johnson, Bob@Example.com \n'
+            ',nobody@example.com\n'
+            'Charlie Brown,not-an-email\n'
+            'Bobby Johnson,bob@example.com\n'
+            + ''.join(f'Student {i},student{i}@example.com\n' for i in range(20))
+        )
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'import-students', str(path),
+            '--workers', '2',
+            '--chunk-size', '3',
+            '--queue-size', '1'
+        ])
+        assert result.exit_code == 0
+        assert 'Inserted: 21' in result.output
+        assert 'Duplicates skipped: 2' in result.output
+        assert 'Invalid: 2' in result.output
+        assert 'missing name' in result.output
+        for stage in ('Parse', 'Validate', 'Insert'):
+            assert stage in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert Student.query.count() == 22
+            assert Student.query.filter_by(email='bob@example.com').one().name == 'Bob Johnson'
+            assert Student.query.filter_by(email='alice@example.com').one().name == 'Alice Smith'
+    
+    def test_import_grades(self, cli_runner, temp_db, tmp_path):
+        """Test importing grades by student ID and email, rejecting bad rows."""
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', email])
+        path = tmp_path / 'grades.csv'
+        path.write_text(
+            'email,subject,score,term\n'
+            'Alice@Example.com,Math,95,\n'
+            'bob@example.com,  Math ,85,\n'
+            'bob@example.com,Art,105,\n'
+            'bob@example.com,Art,abc,\n'
+            'carol@example.com,Art,70,\n'
+            'alice@example.com,Art,75,Spring 1999\n'
+        )
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'import-grades', str(path),
+            '--workers', '1',
+            '--chunk-size', '2'
+        ])
+        assert result.exit_code == 0
+        assert 'Inserted: 2' in result.output
+        assert 'Invalid: 4' in result.output
+        assert 'unknown student' in result.output
+        assert 'unknown term' in result.output
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            grades = sorted((grade.student.email, grade.subject, grade.score)
+                            for grade in Grade.query.options(db.joinedload(Grade.student)))
+            assert grades == [('alice@example.com', 'Math', 95.0), ('bob@example.com', 'Math', 85.0)]
+        
+        path.write_text('student_id,subject,score\n1,Art,80\n99,Art,70\n')
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'import-grades', str(path), '--workers', '2'])
+        assert result.exit_code == 0
+        assert 'Inserted: 1' in result.output
+        assert 'Invalid: 1' in result.output
+    
+    def test_import_missing_columns(self, cli_runner, temp_db, tmp_path):
+        """Test importing a file without the required columns."""
+        path = tmp_path / 'bad.csv'
+        path.write_text('email,score\nalice@example.com,90\n')
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'import-grades', str(path)])
+        assert result.exit_code == 1
+        assert '"subject"' in result.output
+
+
+class TestBackup:
+    def _populate(self, cli_runner, temp_db):
+        for name, email in [('Alice Smith', 'alice@example.com'), ('Bob Johnson', 'bob@example.com')]:
+            cli_runner.invoke(cli, ['--db', temp_db, 'add-student', '--name', name, '--email', email])
+    
+    def test_backup_and_restore(self, cli_runner, temp_db, tmp_path):
+        """Test a compressed backup taken in steps, then restoring it over later changes."""
+        self._populate(cli_runner, temp_db)
+        backup_dir = tmp_path / 'backups'
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'backup', '--dir', str(backup_dir), '--compress', '--pages', '1', '--sleep', '0'
+        ])
+        assert result.exit_code == 0
+        assert 'Integrity: ok' in result.output
+        backups = os.listdir(backup_dir)
+        assert len(backups) == 1 and backups[0].endswith('.db.gz')
+        
+        cli_runner.invoke(cli, ['--db', temp_db, 'delete-student', '--student-id', '1', '--confirm'])
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'restore', str(backup_dir / backups[0]), '--dir', str(backup_dir), '--confirm'
+        ])
+        assert result.exit_code == 0
+        assert 'restored successfully' in result.output
+        assert 'Previous database backed up to' in result.output
+        assert len(os.listdir(backup_dir)) == 2
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert sorted(s.email for s in Student.query.all()) == ['alice@example.com', 'bob@example.com']
+        
+        result = cli_runner.invoke(cli, ['--db', temp_db, 'list-backups', '--dir', str(backup_dir)])
+        assert result.exit_code == 0
+        assert backups[0] in result.output
+    
+    def test_backup_retention(self, cli_runner, temp_db, tmp_path):
+        """Test that only the newest backups are kept."""
+        self._populate(cli_runner, temp_db)
+        backup_dir = tmp_path / 'backups'
+        for _ in range(3):
+            result = cli_runner.invoke(cli, ['--db', temp_db, 'backup', '--dir', str(backup_dir), '--keep', '2'])
+            assert result.exit_code == 0
+        assert 'Deleted old backup' in result.output
+        assert len(os.listdir(backup_dir)) == 2
+    
+    def test_restore_invalidates_caches_of_every_process(self, cli_runner, temp_db, tmp_path):
+        """Test that caches built before a restore are not used after it, here or elsewhere."""
+        from app.backup import backup_database, restore_database
+        from app.leaderboard import get_leaderboard
+        from app.services import GradeService, StudentService, SubjectService
+        
+        self._populate(cli_runner, temp_db)
+        cli_runner.invoke(cli, ['--db', temp_db, 'add-grade', '--student-id', '1', '--subject', 'Math', '--score', '80'])
+        restoring = create_app('default', db_path=temp_db)
+        other = create_app('default', db_path=temp_db)
+        with restoring.app_context():
+            backup = backup_database(str(tmp_path / 'backups'))['path']
+        
+        def warm(app):
+            with app.app_context():
+                GradeService.create_grade(2, 'Chemistry', 90.0)
+                StudentService.get_student_record(2)
+                assert len(get_leaderboard()) == 2
+                db.session.remove()
+        
+        warm(restoring)
+        warm(other)
+        with restoring.app_context():
+            result = restore_database(backup, backup_current=False)
+            assert result['epoch'] == 1
+            assert 'student_caches' not in restoring.extensions or not restoring.extensions['student_caches']
+        
+        for app in (restoring, other):
+            with app.app_context():
+                assert SubjectService.find_id('Chemistry') is None
+                assert StudentService.get_cache().get(2) is None
+                assert len(get_leaderboard()) == 1
+                db.session.remove()
+        
+        with other.app_context():
+            # Chemistry's old id now belongs to another subject.
+            art = SubjectService.resolve_id('Art')
+            db.session.commit()
+            assert GradeService.create_grade(2, 'Chemistry', 70.0).subject == 'Chemistry'
+            db.session.remove()
+        with restoring.app_context():
+            assert SubjectService.resolve_id('Art') == art
+            assert GradeService.create_grade(2, 'Chemistry', 60.0).subject == 'Chemistry'
+            assert [item.student_id for item in get_leaderboard().top(2)] == [1, 2]
+            db.session.remove()
+    
+    def test_restore_rejects_invalid_file(self, cli_runner, temp_db, tmp_path):
+        """Test that a corrupt backup is rejected before anything is replaced."""
+        self._populate(cli_runner, temp_db)
+        bad = tmp_path / 'bad.db'
+        bad.write_bytes(b'not a database' * 100)
+        result = cli_runner.invoke(cli, [
+            '--db', temp_db,
+            'restore', str(bad), '--dir', str(tmp_path / 'backups'), '--confirm'
+        ])
+        assert result.exit_code == 1
+        assert 'not a valid database' in result.output
+        assert not (tmp_path / 'backups').exists()
+        
+        app = create_app('default', db_path=temp_db)
+        with app.app_context():
+            assert Student.query.count() == 2
@@ -1,4 +1,6 @@
+import json
 import pytest
+from datetime import date, datetime
 from app.models import db, Student, Grade
 
 
@@ -50,6 +52,34 @@ class TestStudentRoutes:
         assert response.status_code == 200
         assert b'Email already registered' in response.data
     
+    def test_create_student_duplicate_email_ignores_case(self, client, app, sample_student):
+        from sqlalchemy import event
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.post('/students/create', data={
+                'name': 'Another Student',
+                'email': 'John@Example.COM'
+            })
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        
+        assert b'Email already registered' in response.data
+        assert not any(s.startswith('SELECT') and 'students' in s for s in statements)
+        assert Student.query.count() == 1
+    
+    def test_edit_student_to_taken_email(self, client, app, sample_students):
+        alice, bob = Student.query.order_by(Student.id).limit(2).all()
+        response = client.post(f'/students/{bob.id}/edit', data={
+            'name': 'Bob Johnson',
+            'email': 'ALICE@example.com'
+        })
+        assert b'Email already registered' in response.data
+        db.session.expire_all()
+        assert db.session.get(Student, bob.id).email == 'bob@example.com'
+    
     def test_create_student_invalid_email(self, client):
         response = client.post('/students/create', data={
             'name': 'Test Student',
@@ -221,6 +251,52 @@ class TestExportRoutes:
         assert b'Grade ID,Student Name,Subject,Score,Date' in response.data
         assert b'Jane Doe' in response.data
         assert b'Math' in response.data
+    
+    def _pivot_grades(self, app, sample_students):
+        with app.app_context():
+            alice, bob, _ = Student.query.order_by(Student.id).all()
+            for student, subject, score, day in [
+                (alice, 'Math', 90.0, 3), (alice, 'Math', 70.0, 5), (alice, 'Art', 60.0, 1),
+                (bob, 'Science', 80.0, 2), (bob, 'Math', 85.0, 2), (bob, 'Math', 95.0, 1),
+            ]:
+                db.session.add(Grade(student_id=student.id, subject=subject, score=score,
+                                     created_at=datetime(2025, 1, day)))
+            db.session.commit()
+    
+    def test_export_pivot_csv(self, app, client, sample_students):
+        self._pivot_grades(app, sample_students)
+        expected = {
+            'latest': ['1,Alice Smith,alice@example.com,60.0,70.0,', '2,Bob Johnson,bob@example.com,,85.0,80.0'],
+            'mean': ['1,Alice Smith,alice@example.com,60.0,80.0,', '2,Bob Johnson,bob@example.com,,90.0,80.0'],
+            'max': ['1,Alice Smith,alice@example.com,60.0,90.0,', '2,Bob Johnson,bob@example.com,,95.0,80.0'],
+        }
+        for snapshot in (False, True):
+            app.config['ANALYTICS_SNAPSHOT'] = snapshot
+            for aggregate, rows in expected.items():
+                response = client.get(f'/export/pivot?aggregate={aggregate}')
+                assert response.status_code == 200
+                assert response.mimetype == 'text/csv'
+                lines = response.get_data(as_text=True).splitlines()
+                assert lines == ['ID,Name,Email,Art,Math,Science'] + rows
+    
+    def test_export_pivot_without_numpy(self, app, sample_students, monkeypatch):
+        from app import snapshot as snapshot_module
+        from app.services import ExportService
+        
+        pytest.importorskip('numpy')
+        self._pivot_grades(app, sample_students)
+        with app.app_context():
+            app.config['ANALYTICS_SNAPSHOT'] = True
+            for aggregate in ExportService.PIVOT_AGGREGATES:
+                vectorized = list(ExportService.pivot(aggregate=aggregate)[1])
+                monkeypatch.setattr(snapshot_module, 'numpy', None)
+                assert list(ExportService.pivot(aggregate=aggregate)[1]) == vectorized
+                monkeypatch.undo()
+    
+    def test_export_pivot_unknown_aggregate(self, client, student_with_grades):
+        response = client.get('/export/pivot?aggregate=median', follow_redirects=True)
+        assert response.status_code == 200
+        assert b'Unknown aggregate' in response.data
 
 
 class TestFormValidation:
@@ -264,3 +340,1007 @@ class TestCascadeDelete:
             
             remaining_grades = Grade.query.filter_by(student_id=student_id).count()
             assert remaining_grades == 0
+
+
+class TestSubjects:
+    def test_subjects_are_interned(self, client, app, sample_student):
+        for subject in ['History', 'history', '  HISTORY ']:
+            client.post(f'/grades/student/{sample_student.id}/add', data={
+                'student_id': sample_student.id,
+                'subject': subject,
+                'score': 80
+            })
+        
+        with app.app_context():
+            from app.models import Subject
+            assert Subject.query.count() == 1
+            grades = Grade.query.all()
+            assert len(grades) == 3
+            assert {grade.subject for grade in grades} == {'History'}
+    
+    def test_rolled_back_subject_is_evicted(self, app):
+        from app.models import Subject
+        from app.services import SubjectService
+        
+        with app.app_context():
+            subject_id = SubjectService.resolve_id('Physics')
+            db.session.rollback()
+            assert db.session.get(Subject, subject_id) is None
+            assert SubjectService.get_cache().get_id('physics') is None
+
+
+class TestTermScoping:
+    def test_grades_default_to_current_term(self, client, app, sample_student):
+        from datetime import date, timedelta
+        from sqlalchemy.orm import joinedload
+        from app.services import TermService
+        
+        with app.app_context():
+            today = date.today()
+            TermService.create_term('current', today - timedelta(days=30), today + timedelta(days=30))
+        
+        client.post(f'/grades/student/{sample_student.id}/add', data={
+            'student_id': sample_student.id,
+            'subject': 'History',
+            'score': 88
+        })
+        
+        with app.app_context():
+            grade = Grade.query.options(joinedload(Grade.term)).one()
+            assert grade.term.name == 'current'
+    
+    def test_rankings_by_term(self, client, app, sample_students):
+        from datetime import date
+        from app.services import GradeService, TermService
+        
+        with app.app_context():
+            old = TermService.create_term('old', date(2020, 1, 1), date(2020, 6, 30))
+            alice = Student.query.filter_by(name='Alice Smith').first()
+            bob = Student.query.filter_by(name='Bob Johnson').first()
+            GradeService.create_grade(alice.id, 'Math', 90, term=old)
+            GradeService.create_grade(bob.id, 'Math', 80)
+        
+        response = client.get('/students/rankings?term=old')
+        assert b'Term: old' in response.data
+        assert b'Alice Smith' in response.data
+        assert b'Bob Johnson' not in response.data
+        
+        response = client.get('/students/rankings?term=all')
+        assert b'All terms' in response.data
+        assert b'Bob Johnson' in response.data
+        
+        response = client.get('/students/rankings?term=missing', follow_redirects=True)
+        assert b'Term &#34;missing&#34; not found' in response.data
+
+
+class TestDistrict:
+    @pytest.fixture
+    def district_app(self, tmp_path):
+        from app import create_app
+        from app.services import GradeService, StudentService
+        from flask import g
+        
+        shards = {'north': str(tmp_path / 'north.db'), 'south': str(tmp_path / 'south.db')}
+        app = create_app('testing', shards=shards)
+        for school, name, email, score in [('north', 'Alice Smith', 'alice@example.com', 90),
+                                           ('south', 'Bob Johnson', 'bob@example.com', 80)]:
+            with app.app_context():
+                g.shard = school
+                student = StudentService.create_student(name, email)
+                GradeService.create_grade(student.id, 'Math', score)
+        return app
+    
+    def test_request_routed_to_school(self, district_app):
+        client = district_app.test_client()
+        response = client.get('/students/?school=south')
+        assert b'Bob Johnson' in response.data
+        assert b'Alice Smith' not in response.data
+        
+        client.get('/district/school/north')
+        response = client.get('/students/')
+        assert b'Alice Smith' in response.data
+        assert b'Bob Johnson' not in response.data
+    
+    def test_unknown_school(self, district_app):
+        response = district_app.test_client().get('/students/?school=east')
+        assert response.status_code == 404
+    
+    def test_district_rankings(self, district_app):
+        response = district_app.test_client().get('/district/rankings')
+        assert response.status_code == 200
+        assert b'District Rankings' in response.data
+        assert response.data.index(b'Alice Smith') < response.data.index(b'Bob Johnson')
+    
+    def test_district_export(self, district_app):
+        response = district_app.test_client().get('/district/export/students')
+        assert response.mimetype == 'text/csv'
+        assert b'School,ID,Name,Email' in response.data
+        assert b'north,1,Alice Smith' in response.data
+        assert b'south,1,Bob Johnson' in response.data
+
+
+class TestBulkDelete:
+    def test_bulk_delete_students(self, client, app, sample_students, student_with_grades):
+        with app.app_context():
+            ids = [s.id for s in Student.query.filter(Student.name != 'Charlie Brown').all()]
+        
+        response = client.post('/students/bulk-delete', data={'student_ids': ids}, follow_redirects=True)
+        assert b'Deleted 3 student(s) and 3 grade(s).' in response.data
+        
+        with app.app_context():
+            assert [s.name for s in Student.query.all()] == ['Charlie Brown']
+            assert Grade.query.count() == 0
+    
+    def test_bulk_delete_nothing_selected(self, client):
+        response = client.post('/students/bulk-delete', follow_redirects=True)
+        assert b'No students selected.' in response.data
+
+
+class TestCurve:
+    def test_curve_preview(self, client, app, student_with_grades):
+        response = client.post('/grades/curve', data={
+            'subject': 'Math',
+            'method': 'add',
+            'value': 20,
+            'preview': 'Preview'
+        })
+        assert response.status_code == 200
+        assert b'Preview: Math' in response.data
+        assert b'1 grade(s) affected, 1 clamped' in response.data
+        
+        with app.app_context():
+            assert Grade.query.filter_by(subject='Math').one().score == 85.0
+    
+    def test_curve_apply_sends_signal(self, client, app, student_with_grades):
+        from app.signals import grades_changed
+        
+        received = []
+        
+        def on_change(sender, **kwargs):
+            received.append(kwargs)
+        
+        with grades_changed.connected_to(on_change, app):
+            response = client.post('/grades/curve', data={
+                'subject': 'Math',
+                'method': 'multiply',
+                'value': 1.1,
+                'apply': 'Apply Curve'
+            }, follow_redirects=True)
+        
+        assert b'Curve applied to 1 grade(s)!' in response.data
+        assert received == [{'student_ids': None, 'shard': None}]
+        with app.app_context():
+            assert Grade.query.filter_by(subject='Math').one().score == pytest.approx(93.5)
+
+
+class TestRetryOnLock:
+    def test_does_not_commit_callers_pending_changes(self, app, sample_student):
+        from app.services import GradeService
+        
+        db.session.get(Student, sample_student.id).name = 'Pending Name'
+        with pytest.raises(RuntimeError, match='uncommitted changes'):
+            GradeService.create_grade(sample_student.id, 'Math', 90.0)
+        db.session.rollback()
+        assert db.session.get(Student, sample_student.id).name == 'John Doe'
+        assert Grade.query.count() == 0
+    
+    @pytest.fixture
+    def locked_app(self, tmp_path, monkeypatch):
+        """A file-backed app and a function that holds its write lock briefly."""
+        import sqlite3
+        import threading
+        from app import create_app
+        from app.config import TestingConfig
+        from app.retry import retry_stats
+        
+        monkeypatch.setattr(TestingConfig, 'DB_BUSY_TIMEOUT', 0.05)
+        path = str(tmp_path / 'locked.db')
+        file_app = create_app('testing', db_path=path)
+        file_app.config.update(DB_RETRY_ATTEMPTS=100, DB_RETRY_BASE_DELAY=0.01, DB_RETRY_MAX_DELAY=0.05)
+        blockers = []
+        
+        def hold_lock(seconds=0.3):
+            blocker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            blocker.execute('BEGIN IMMEDIATE')
+            release = threading.Timer(seconds, blocker.execute, ('ROLLBACK',))
+            release.start()
+            blockers.append((blocker, release))
+        
+        with file_app.app_context():
+            retry_stats.reset()
+            yield file_app, hold_lock
+            for blocker, release in blockers:
+                release.join()
+                blocker.close()
+            db.session.remove()
+            db.engine.dispose()
+    
+    def test_bulk_delete_retries_while_write_lock_is_held(self, locked_app):
+        from app.retry import retry_stats
+        from app.services import GradeService, StudentService
+        
+        file_app, hold_lock = locked_app
+        ids = [StudentService.create_student(f'Student {n}', f's{n}@example.com').id for n in range(5)]
+        GradeService.create_grade(ids[0], 'Math', 90.0)
+        db.session.commit()
+        
+        hold_lock()
+        deleted = StudentService.bulk_delete_students(ids[:4], chunk_size=2)
+        
+        assert deleted == {'students': 4, 'grades': 1}
+        assert [s.id for s in Student.query.all()] == ids[4:]
+        counts = retry_stats.snapshot()['_delete_chunk']
+        assert counts['retries'] > 0
+        assert counts['failures'] == 0
+    
+    def test_roster_apply_retries_while_write_lock_is_held(self, locked_app):
+        from app.retry import retry_stats
+        from app.services import RosterService
+        
+        file_app, hold_lock = locked_app
+        diff = {
+            'inserts': [{'name': 'Ann', 'email': 'ann@example.com'}, {'name': 'Ben', 'email': 'ben@example.com'}],
+            'updates': [],
+            'deletes': [],
+        }
+        
+        hold_lock()
+        counts = RosterService.apply(diff, chunk_size=1)
+        
+        assert counts['inserted'] == 2
+        assert Student.query.count() == 2
+        assert retry_stats.snapshot()['_execute_chunk']['retries'] > 0
+    
+    def test_archive_term_retries_while_write_lock_is_held(self, locked_app, tmp_path):
+        from datetime import date
+        from app.archive import archive_term
+        from app.models import Term
+        from app.retry import retry_stats
+        from app.services import GradeService, StudentService
+        
+        file_app, hold_lock = locked_app
+        term = Term(name='2023-fall', start_date=date(2023, 9, 1), end_date=date(2023, 12, 31))
+        db.session.add(term)
+        db.session.commit()
+        student_id = StudentService.create_student('John Doe', 'john@example.com').id
+        GradeService.create_grade(student_id, 'Math', 90.0, term=term)
+        db.session.commit()
+        
+        hold_lock()
+        moved = archive_term(term, str(tmp_path / 'archive.db'))
+        
+        assert moved == 1
+        assert Grade.query.count() == 0
+        assert db.session.get(Term, term.id).is_archived
+        assert retry_stats.snapshot()['_move_grades']['retries'] > 0
+
+
+class TestGroupCommit:
+    @pytest.fixture
+    def group_app(self, app):
+        app.config['GRADE_GROUP_COMMIT'] = True
+        yield app
+        writer = app.extensions.get('group_commit')
+        if writer is not None:
+            writer.stop()
+    
+    def test_add_grade_through_writer(self, client, group_app, sample_student):
+        response = client.post(f'/grades/student/{sample_student.id}/add', data={
+            'student_id': sample_student.id,
+            'subject': 'History',
+            'score': 88.5
+        }, follow_redirects=True)
+        
+        assert b'Grade added successfully!' in response.data
+        metrics = group_app.extensions['group_commit'].metrics.snapshot()
+        assert metrics['rows'] == 1
+        assert metrics['failures'] == 0
+        with group_app.app_context():
+            assert Grade.query.filter_by(subject='History').one().score == 88.5
+    
+    def test_failed_row_does_not_fail_batch(self, group_app, sample_student):
+        from app.group_commit import get_group_writer
+        
+        with group_app.app_context():
+            writer = get_group_writer()
+            good = writer.submit(sample_student.id, 'Art', 70.0)
+            bad = writer.submit(9999, 'Latin', 60.0)
+            also_good = writer.submit(sample_student.id, 'Music', 80.0)
+            
+            assert good.result(timeout=5)
+            assert also_good.result(timeout=5)
+            with pytest.raises(Exception):
+                bad.result(timeout=5)
+            
+            db.session.commit()
+            subjects = {grade.subject for grade in Grade.query.all()}
+            assert subjects == {'Art', 'Music'}
+            assert writer.metrics.snapshot()['failures'] == 1
+    
+    def test_batch_retries_while_write_lock_is_held(self, tmp_path, monkeypatch):
+        import sqlite3
+        import threading
+        from app import create_app
+        from app.config import TestingConfig
+        from app.group_commit import get_group_writer
+        from app.retry import retry_stats
+        
+        monkeypatch.setattr(TestingConfig, 'DB_BUSY_TIMEOUT', 0.05)
+        path = str(tmp_path / 'grades.db')
+        file_app = create_app('testing', db_path=path)
+        file_app.config.update(GRADE_GROUP_COMMIT=True, DB_RETRY_ATTEMPTS=100,
+                               DB_RETRY_BASE_DELAY=0.01, DB_RETRY_MAX_DELAY=0.05)
+        with file_app.app_context():
+            student = Student(name='John Doe', email='john@example.com')
+            db.session.add(student)
+            db.session.commit()
+            student_id = student.id
+            # Do not hold a read transaction that would block the writer's commit.
+            db.session.commit()
+            retry_stats.reset()
+            
+            blocker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            blocker.execute('BEGIN IMMEDIATE')
+            release = threading.Timer(0.3, blocker.execute, ('ROLLBACK',))
+            release.start()
+            writer = get_group_writer()
+            try:
+                grade_id = writer.submit(student_id, 'Art', 70.0).result(timeout=10)
+            finally:
+                release.join()
+                blocker.close()
+                writer.stop()
+            
+            assert db.session.get(Grade, grade_id).score == 70.0
+            counts = retry_stats.snapshot()['GroupCommitWriter._write']
+            assert counts['retries'] > 0
+            assert counts['failures'] == 0
+
+
+class TestLeaderboard:
+    def test_board_follows_grade_changes(self, app, sample_students):
+        from app.leaderboard import get_leaderboard
+        from app.services import GradeService, StudentService
+        
+        with app.app_context():
+            alice, bob, charlie = (Student.query.filter_by(email=email).one()
+                                   for email in ('alice@example.com', 'bob@example.com', 'charlie@example.com'))
+            GradeService.create_grade(alice.id, 'Math', 80.0)
+            GradeService.create_grade(bob.id, 'Math', 70.0)
+            
+            board = get_leaderboard()
+            assert [item.student_id for item in board.top(10)] == [alice.id, bob.id]
+            
+            GradeService.create_grade(bob.id, 'English', 100.0)
+            GradeService.create_grade(charlie.id, 'Math', 60.0)
+            assert get_leaderboard() is board
+            assert board.rank_of(bob.id).rank == 1
+            assert board.rank_of(bob.id).count == 2
+            assert board.rank_of(charlie.id).rank == 3
+            assert [item.student_id for item in board.page(2, 2)] == [charlie.id]
+            
+            StudentService.delete_student(bob.id)
+            assert board.rank_of(bob.id) is None
+            assert board.rank_of(alice.id).rank == 1
+            assert len(board) == 2
+    
+    def test_board_follows_writes_of_other_processes(self, tmp_path):
+        from app import create_app
+        from app.leaderboard import get_leaderboard
+        from app.services import GradeService
+        
+        path = str(tmp_path / 'grades.db')
+        writer, reader = create_app('testing', db_path=path), create_app('testing', db_path=path)
+        with writer.app_context():
+            alice = Student(name='Alice Smith', email='alice@example.com')
+            bob = Student(name='Bob Johnson', email='bob@example.com')
+            db.session.add_all([alice, bob])
+            db.session.commit()
+            alice_id, bob_id = alice.id, bob.id
+            math = GradeService.create_grade(alice_id, 'Math', 90.0).id
+            GradeService.create_grade(bob_id, 'Math', 80.0)
+        with reader.app_context():
+            board = get_leaderboard()
+            assert [item.student_id for item in board.top(10)] == [alice_id, bob_id]
+        
+        with writer.app_context():
+            GradeService.create_grade(bob_id, 'Art', 100.0)
+            GradeService.delete_grade(math)
+        with reader.app_context():
+            assert get_leaderboard() is board
+            assert [item.student_id for item in board.top(10)] == [bob_id]
+            assert board.rank_of(bob_id).count == 2
+        response = reader.test_client().get(f'/grades/student/{bob_id}')
+        assert b'<strong>Rank:</strong> 1 of 1' in response.data
+    
+    def test_grades_page_shows_rank(self, client, student_with_grades):
+        response = client.get(f'/grades/student/{student_with_grades.id}')
+        assert b'<strong>Rank:</strong> 1 of 1' in response.data
+    
+    def test_rankings_pagination(self, client, app, sample_students, monkeypatch):
+        from app.blueprints import students
+        
+        monkeypatch.setattr(students, 'RANKINGS_PER_PAGE', 2)
+        with app.app_context():
+            for score, student in zip((90.0, 80.0, 70.0), Student.query.order_by(Student.id)):
+                db.session.add(Grade(student_id=student.id, subject='Math', score=score))
+            db.session.commit()
+        
+        response = client.get('/students/rankings?page=2')
+        assert b'Page 2 of 2' in response.data
+        assert b'Charlie Brown' in response.data
+        assert b'Alice Smith' not in response.data
+    
+    def test_rankings_top_k_by_subject(self, client, app, sample_students):
+        with app.app_context():
+            alice, bob, charlie = Student.query.order_by(Student.id).all()
+            db.session.add_all([
+                Grade(student_id=alice.id, subject='Math', score=70.0),
+                Grade(student_id=alice.id, subject='English', score=100.0),
+                Grade(student_id=bob.id, subject='Math', score=90.0),
+                Grade(student_id=charlie.id, subject='Math', score=80.0)
+            ])
+            db.session.commit()
+        
+        response = client.get('/students/rankings?term=all&subject=Math&limit=2')
+        assert b'Top 2' in response.data
+        assert b'Bob Johnson' in response.data
+        assert b'Charlie Brown' in response.data
+        assert b'Alice Smith' not in response.data
+
+
+class TestAnalyticsSnapshot:
+    def _reports(self, app, enabled):
+        from app.services import StudentService, GradeService, ExportService
+        
+        app.config['ANALYTICS_SNAPSHOT'] = enabled
+        return (
+            StudentService.get_rankings(),
+            StudentService.get_rankings(subject='Math', limit=1),
+            GradeService.get_subject_stats(),
+            ExportService.get_student_rows(),
+            ExportService.get_grade_rows()
+        )
+    
+    def test_snapshot_matches_sql_after_changes(self, app, sample_students):
+        from app.services import GradeService, StudentService
+        from app.snapshot import get_snapshot
+        
+        with app.app_context():
+            alice, bob, charlie = Student.query.order_by(Student.id).all()
+            GradeService.create_grade(alice.id, 'Math', 70.0)
+            GradeService.create_grade(bob.id, 'Math', 90.0)
+            last = GradeService.create_grade(bob.id, 'Art', 50.0)
+            
+            app.config['ANALYTICS_SNAPSHOT'] = True
+            snapshot = get_snapshot()
+            assert len(snapshot) == 3
+            
+            GradeService.delete_grade(last.id)
+            GradeService.create_grade(charlie.id, 'English', 85.0)
+            GradeService.update_grade(alice.grades[0].id, 'Math', 95.0)
+            StudentService.update_student(bob.id, 'Robert Johnson', 'bob@example.com')
+            
+            assert self._reports(app, True) == self._reports(app, False)
+            refreshed = get_snapshot()
+            assert refreshed is not snapshot
+            assert refreshed.students[bob.id][0] == 'Robert Johnson'
+            assert refreshed.nbytes == len(refreshed.ids) * 8 * 6
+            # The published snapshot is left as it was for threads still using it.
+            assert len(snapshot) == 3
+            assert snapshot.students[bob.id][0] == 'Bob Johnson'
+            assert get_snapshot() is refreshed
+    
+    def test_refresh_does_not_disturb_readers(self, tmp_path):
+        import threading
+        from app import create_app
+        from app.services import GradeService, StudentService
+        from app.snapshot import get_snapshot
+        
+        app = create_app('testing', db_path=str(tmp_path / 'snapshot.db'))
+        app.config['ANALYTICS_SNAPSHOT'] = True
+        with app.app_context():
+            student_ids = [
+                StudentService.create_student(f'Student {i}', f's{i}@example.com').id for i in range(20)
+            ]
+            for i in range(400):
+                GradeService.create_grade(student_ids[i % 20], f'Subject {i % 7}', float(i % 100))
+            get_snapshot()
+            db.session.remove()
+        
+        errors = []
+        done = threading.Event()
+        
+        def read():
+            with app.app_context():
+                while not done.is_set():
+                    try:
+                        snapshot = get_snapshot()
+                        db.session.remove()
+                        count = len(snapshot)
+                        for _ in range(3):
+                            assert sum(c for _, _, c in snapshot.rankings()) == count
+                            snapshot.pivot_cells('latest')
+                            snapshot.grade_rows()
+                    except Exception as e:
+                        errors.append(e)
+                        return
+        
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for thread in readers:
+            thread.start()
+        with app.app_context():
+            for i in range(60):
+                grade = GradeService.create_grade(student_ids[i % 20], 'Art', 50.0 + i % 50)
+                if i % 3 == 0:
+                    GradeService.delete_grade(grade.id - 5)
+                get_snapshot()
+                db.session.remove()
+        done.set()
+        for thread in readers:
+            thread.join()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        assert errors == []
+    
+    def test_snapshot_rebuilds_after_log_is_pruned(self, app, student_with_grades):
+        from app.snapshot import get_snapshot
+        
+        with app.app_context():
+            app.config['ANALYTICS_SNAPSHOT'] = True
+            snapshot = get_snapshot()
+            db.session.add(Grade(student_id=student_with_grades.id, subject='Art', score=60.0))
+            db.session.add(Grade(student_id=student_with_grades.id, subject='Music', score=70.0))
+            db.session.commit()
+            db.session.execute(db.text('DELETE FROM change_log WHERE id < (SELECT max(id) FROM change_log)'))
+            db.session.commit()
+            
+            rebuilt = get_snapshot()
+            assert rebuilt is not snapshot
+            assert len(rebuilt) == 5
+    
+    def test_change_log_stays_bounded(self, app, student_with_grades):
+        from app.models import install_change_log_pruning
+        from app.snapshot import get_snapshot
+        
+        with app.app_context():
+            install_change_log_pruning(db.session.connection(), retention=50, every=10)
+            db.session.commit()
+            app.config['ANALYTICS_SNAPSHOT'] = True
+            snapshot = get_snapshot()
+            for i in range(100):
+                db.session.add(Grade(student_id=student_with_grades.id, subject='Art', score=float(i)))
+                db.session.commit()
+            
+            count, oldest, newest = db.session.execute(db.text(
+                'SELECT count(*), min(id), max(id) FROM change_log'
+            )).one()
+            assert count <= 50 + 10
+            assert newest - oldest < 50 + 10
+            rebuilt = get_snapshot()
+            assert rebuilt is not snapshot
+            assert len(rebuilt) == 103
+
+
+class TestTrends:
+    def _add(self, student_id, subject, score, day):
+        grade = Grade(student_id=student_id, subject=subject, score=score, created_at=datetime(2025, 1, day))
+        db.session.add(grade)
+        db.session.commit()
+        return grade
+    
+    def _recomputed(self):
+        return db.session.execute(db.text(
+            'SELECT student_id, coalesce(term_id, 0), count(*), sum(score), '
+            "sum(julianday(created_at) - julianday('2000-01-01')) FROM grades "
+            'GROUP BY student_id, coalesce(term_id, 0) ORDER BY 1, 2'
+        )).all()
+    
+    def _maintained(self):
+        return db.session.execute(db.text(
+            'SELECT student_id, term_key, n, sum_y, sum_x FROM student_trends ORDER BY 1, 2'
+        )).all()
+    
+    def test_trend_sums_follow_every_write(self, app, sample_students):
+        from app.schema import add_student_trends
+        from app.services import CurveService, GradeService, StudentService, TermService
+        
+        with app.app_context():
+            alice, bob, charlie = Student.query.order_by(Student.id).all()
+            grade = self._add(alice.id, 'Math', 80.0, 1)
+            self._add(alice.id, 'Art', 70.0, 11)
+            self._add(bob.id, 'Math', 90.0, 2)
+            self._add(charlie.id, 'Math', 50.0, 3)
+            term = TermService.create_term('2025-spring', date(2025, 1, 1), date(2025, 6, 30))
+            GradeService.create_grade(bob.id, 'Art', 65.0, term=term)
+            GradeService.update_grade(grade.id, 'Math', 85.0)
+            CurveService.curve('Math', 'add', 5)
+            StudentService.delete_student(charlie.id)
+            
+            maintained = self._maintained()
+            assert [row[:3] for row in maintained] == [row[:3] for row in self._recomputed()]
+            for got, expected in zip(maintained, self._recomputed()):
+                assert got[3:] == pytest.approx(expected[3:])
+            
+            db.session.execute(db.text('DROP TRIGGER trend_grades_insert'))
+            db.session.execute(db.text('DELETE FROM student_trends'))
+            assert add_student_trends(db.session.connection()) is not None
+            db.session.commit()
+            assert [row[:3] for row in self._maintained()] == [row[:3] for row in self._recomputed()]
+    
+    def test_grade_trends_on_grades_page(self, app, client, sample_students):
+        from app.services import TrendService
+        
+        with app.app_context():
+            alice = Student.query.order_by(Student.id).first()
+            ids = [self._add(alice.id, 'Math', score, day).id for score, day in [(80.0, 1), (70.0, 11), (60.0, 21)]]
+            trends = TrendService.get_grade_trends(alice.id, window=2)
+            assert [trends[i].running_average for i in ids] == [80.0, 75.0, 70.0]
+            assert [trends[i].moving_average for i in ids] == [80.0, 75.0, 65.0]
+            assert trends[ids[0]].slope is None
+            assert trends[ids[2]].slope == pytest.approx(-30.0)
+            assert TrendService.get_student_trend(alice.id)['slope'] == pytest.approx(-30.0)
+            alice_id = alice.id
+        
+        response = client.get(f'/grades/student/{alice_id}?window=2')
+        assert response.status_code == 200
+        assert b'Moving Avg (2)' in response.data
+        assert b'-30.0</span> points per 30 days' in response.data
+    
+    def test_at_risk_report(self, app, client, sample_students):
+        with app.app_context():
+            alice, bob, charlie = Student.query.order_by(Student.id).all()
+            for score, day in [(90.0, 1), (75.0, 11), (62.0, 21)]:
+                self._add(alice.id, 'Math', score, day)
+            for score, day in [(50.0, 1), (55.0, 11), (52.0, 21)]:
+                self._add(bob.id, 'Math', score, day)
+            for score, day in [(95.0, 1), (96.0, 11), (97.0, 21)]:
+                self._add(charlie.id, 'Math', score, day)
+        
+        response = client.get('/students/at-risk')
+        assert response.status_code == 200
+        assert b'Alice Smith' in response.data
+        assert b'falling 42.0 points per 30 days' in response.data
+        assert b'Bob Johnson' in response.data
+        assert b'average below 60' in response.data
+        assert b'Charlie Brown' not in response.data
+        
+        response = client.get('/students/at-risk?min_grades=4')
+        assert b'No students are at risk' in response.data
+
+
+class TestLiveRankings:
+    def _events(self, response):
+        events = []
+        for block in response.get_data(as_text=True).split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':') and ': ' in line)
+            if 'event' in fields:
+                events.append((fields['event'], fields.get('id'), json.loads(fields['data'])))
+        return events
+    
+    def _setup(self, app, sample_students):
+        app.config['LIVE_RANKINGS_STREAM_SECONDS'] = 0.3
+        app.config['LIVE_RANKINGS_POLL_INTERVAL'] = 0.05
+        alice, bob, charlie = Student.query.order_by(Student.id).all()
+        db.session.add_all([
+            Grade(student_id=alice.id, subject='Math', score=80.0),
+            Grade(student_id=bob.id, subject='Math', score=70.0)
+        ])
+        db.session.commit()
+        return alice.id, bob.id, charlie.id
+    
+    def test_stream_pushes_rank_changes(self, client, app, sample_students):
+        from app.services import GradeService
+        
+        alice_id, bob_id, charlie_id = self._setup(app, sample_students)
+        response = client.get('/students/rankings')
+        assert b'/students/rankings/live?term=all&amp;since=0' in response.data
+        
+        GradeService.create_grade(bob_id, 'English', 100.0)
+        charlie_grade_id = GradeService.create_grade(charlie_id, 'Math', 50.0).id
+        events = self._events(client.get('/students/rankings/live?term=all&since=0'))
+        assert [(event, event_id) for event, event_id, _ in events] == [('rankings', '1')]
+        delta = events[0][2]
+        assert delta['total'] == 3
+        assert delta['removed'] == []
+        assert [(c['id'], c['rank'], c['average'], c['count']) for c in delta['changes']] == [
+            (bob_id, 1, 85.0, 2), (alice_id, 2, 80.0, 1), (charlie_id, 3, 50.0, 1)
+        ]
+        assert delta['changes'][0]['name'] == 'Bob Johnson'
+        
+        GradeService.delete_grade(charlie_grade_id)
+        events = self._events(client.get('/students/rankings/live?term=all',
+                                         headers={'Last-Event-ID': '1'}))
+        assert [(event, event_id) for event, event_id, _ in events] == [('rankings', '2')]
+        assert events[0][2]['removed'] == [charlie_id]
+    
+    def test_subscribers_share_one_computation(self, client, app, sample_students):
+        from app.services import GradeService
+        
+        _, bob_id, _ = self._setup(app, sample_students)
+        client.get('/students/rankings')
+        feed = app.extensions['ranking_feeds'][(None, None)]
+        assert feed.computations == 1
+        
+        GradeService.create_grade(bob_id, 'English', 100.0)
+        first = self._events(client.get('/students/rankings/live?since=0'))
+        second = self._events(client.get('/students/rankings/live?since=0'))
+        assert first == second
+        assert len(first) == 1
+        assert feed.computations == 2
+    
+    def test_stream_asks_for_reload_when_history_is_gone(self, client, app, sample_students):
+        self._setup(app, sample_students)
+        events = self._events(client.get('/students/rankings/live', headers={'Last-Event-ID': '42'}))
+        assert [event for event, _, _ in events] == ['reload']
+    
+    def test_filtered_rankings_are_not_live(self, client, app, sample_students):
+        self._setup(app, sample_students)
+        response = client.get('/students/rankings?subject=Math')
+        assert b'data-live-url' not in response.data
+
+
+class TestLookupApi:
+    def _seed(self, app):
+        students = [Student(name=f'Student {i:04d}', email=f's{i}@example.com') for i in range(1000)]
+        db.session.add_all(students)
+        db.session.commit()
+        db.session.add_all([
+            Grade(student_id=students[0].id, subject='Math', score=80.0),
+            Grade(student_id=students[0].id, subject='Art', score=90.0)
+        ])
+        db.session.commit()
+        return [student.id for student in students]
+    
+    def test_lookup_students_sparse_fields(self, client, app):
+        from sqlalchemy import event
+        
+        ids = self._seed(app)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.get(f'/api/students?ids={ids[1]},{ids[0]},99999&fields=name')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert response.status_code == 200
+        assert response.get_json() == {
+            'students': [{'id': ids[1], 'name': 'Student 0001'}, {'id': ids[0], 'name': 'Student 0000'}],
+            'missing': [99999]
+        }
+        assert len(statements) == 1
+        assert 'grades' not in statements[0] and 'email' not in statements[0]
+    
+    def test_lookup_students_post_is_chunked(self, client, app):
+        from sqlalchemy import event
+        
+        ids = self._seed(app)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.post('/api/students', json={'ids': ids, 'fields': ['avg', 'count', 'grades']})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        data = response.get_json()
+        assert [record['id'] for record in data['students']] == ids
+        assert data['students'][0]['avg'] == 85.0
+        assert [grade['subject'] for grade in data['students'][0]['grades']] == ['Math', 'Art']
+        assert data['students'][1] == {'id': ids[1], 'avg': None, 'count': 0, 'grades': []}
+        # Two chunks of at most 900 IDs, each with one student and one grade query.
+        assert len([s for s in statements if ' IN (' in s]) == 4
+    
+    def test_lookup_grades(self, client, student_with_grades):
+        response = client.get('/api/grades?ids=1,2&fields=student,subject,score')
+        assert response.get_json() == {
+            'grades': [
+                {'id': 1, 'student': 'Jane Doe', 'subject': 'Math', 'score': 85.0},
+                {'id': 2, 'student': 'Jane Doe', 'subject': 'English', 'score': 90.0}
+            ],
+            'missing': []
+        }
+    
+    def test_lookup_rejects_bad_requests(self, client):
+        response = client.get('/api/students?ids=1&fields=name,password')
+        assert response.status_code == 400
+        assert 'Unknown field(s): password' in response.get_json()['error']
+        assert client.get('/api/grades?ids=1,x').status_code == 400
+        assert client.get('/api/grades').get_json() == {'error': 'No IDs given.'}
+
+
+class TestLoadingStrategies:
+    def _count_selects(self, func):
+        from sqlalchemy import event
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return result, len([s for s in statements if s.startswith('SELECT')])
+    
+    def test_selectin_loads_all_grades_in_one_query(self, app, sample_students):
+        from app.services import StudentService
+        
+        for student in Student.query.all():
+            db.session.add(Grade(student_id=student.id, subject='Math', score=80.0))
+        db.session.commit()
+        db.session.expunge_all()
+        
+        counts, selects = self._count_selects(
+            lambda: [len(s.grades) for s in StudentService.get_all_students(grades='selectin')]
+        )
+        assert counts == [1, 1, 1]
+        assert selects == 2
+    
+    def test_joined_loads_student_with_grades(self, app, student_with_grades):
+        from app.services import StudentService
+        
+        db.session.expunge_all()
+        scores, selects = self._count_selects(
+            lambda: [g.score for g in StudentService.get_student_by_id(student_with_grades.id, grades='joined').grades]
+        )
+        assert sorted(scores) == [78.0, 85.0, 90.0]
+        assert selects == 1
+    
+    def test_lazy_access_raises_in_tests(self, app, student_with_grades):
+        from sqlalchemy.exc import InvalidRequestError
+        from app.services import StudentService
+        
+        db.session.expunge_all()
+        for strategy in ('lazy', 'raise'):
+            student = StudentService.get_student_by_id(student_with_grades.id, grades=strategy)
+            with pytest.raises(InvalidRequestError):
+                student.grades
+            db.session.expunge_all()
+        
+        app.config['RAISE_ON_LAZY_LOAD'] = False
+        assert len(StudentService.get_student_by_id(student_with_grades.id).grades) == 3
+    
+    def test_unknown_strategy(self, app):
+        from app.services import StudentService
+        
+        with pytest.raises(ValueError, match='Unknown loading strategy "eager"'):
+            StudentService.get_all_students(grades='eager')
+
+
+class TestStudentCache:
+    def test_pages_read_student_through_cache(self, client, sample_student):
+        client.get(f'/grades/student/{sample_student.id}/add')
+        client.post(f'/grades/student/{sample_student.id}/add', data={
+            'student_id': sample_student.id, 'subject': 'Math', 'score': 90
+        })
+        response = client.get(f'/grades/student/{sample_student.id}')
+        assert b'Grades for John Doe' in response.data
+        
+        stats = client.get('/api/cache/students').get_json()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+        assert stats['hit_rate'] == pytest.approx(2 / 3)
+    
+    def test_update_and_delete_invalidate(self, app, sample_student):
+        from app.services import StudentService
+        
+        assert StudentService.get_student_record(sample_student.id).name == 'John Doe'
+        StudentService.update_student(sample_student.id, 'Johnny Doe', 'john@example.com')
+        assert StudentService.get_student_record(sample_student.id).name == 'Johnny Doe'
+        StudentService.delete_student(sample_student.id)
+        assert StudentService.get_student_record(sample_student.id) is None
+        assert StudentService.get_cache().stats()['invalidations'] == 2
+    
+    def test_size_limit_evicts_least_recently_used(self, app, sample_students):
+        from app.services import StudentService
+        
+        app.config['STUDENT_CACHE_SIZE'] = 2
+        first, second, third = [student.id for student in Student.query.order_by(Student.id)]
+        db.session.commit()
+        for student_id in (first, second, first, third):
+            StudentService.get_student_record(student_id)
+            db.session.commit()
+        
+        cache = StudentService.get_cache()
+        assert len(cache) == 2
+        assert cache.get(second) is None
+        assert cache.get(first).id == first
+        assert cache.stats()['evictions'] == 1
+    
+    def test_sees_changes_from_other_processes(self, tmp_path):
+        import sqlite3
+        from app import create_app
+        from app.services import StudentService
+        
+        db_path = str(tmp_path / 'cache.db')
+        app = create_app('testing', db_path=db_path)
+        with app.app_context():
+            student_id = StudentService.create_student('John Doe', 'john@example.com').id
+            db.session.remove()
+            assert StudentService.get_student_record(student_id).name == 'John Doe'
+            db.session.remove()
+            
+            other = sqlite3.connect(db_path)
+            other.execute("UPDATE students SET name = 'Johnny Doe' WHERE id = ?", (student_id,))
+            other.commit()
+            assert StudentService.get_student_record(student_id).name == 'Johnny Doe'
+            db.session.remove()
+            
+            other.execute('DELETE FROM students WHERE id = ?', (student_id,))
+            other.commit()
+            other.close()
+            assert StudentService.get_student_record(student_id) is None
+            db.session.remove()
+            db.engine.dispose()
+    
+    def test_grade_for_deleted_student(self, app, sample_student):
+        from app.services import GradeService, StudentNotFoundError, StudentService, StudentSummary
+        
+        student_id = sample_student.id
+        cache = StudentService.get_cache()
+        StudentService.get_student_record(student_id)
+        db.session.commit()
+        # As if another process deleted the student after this one looked it up.
+        db.session.execute(db.text('DELETE FROM students WHERE id = :id'), {'id': student_id})
+        db.session.commit()
+        cache.put(StudentSummary(student_id, 'John Doe', 'john@example.com'), cache.generation)
+        
+        with pytest.raises(StudentNotFoundError):
+            GradeService.create_grade(student_id, 'Math', 90.0)
+        assert cache.get(student_id) is None
+        assert Grade.query.count() == 0
+    
+    def test_stale_read_is_not_cached(self):
+        from app.services import StudentCache, StudentSummary
+        
+        cache = StudentCache(10)
+        generation = cache.generation
+        old = StudentSummary(1, 'Old Name', 'old@example.com')
+        cache.invalidate({1})
+        cache.put(old, generation)
+        assert cache.get(1) is None
+    
+    def test_concurrent_updates_leave_cache_consistent(self, tmp_path):
+        import threading
+        from app import create_app
+        from app.services import StudentService
+        
+        app = create_app('testing', db_path=str(tmp_path / 'cache.db'))
+        with app.app_context():
+            student_id = StudentService.create_student('Name 0', 'student@example.com').id
+            db.session.remove()
+        
+        seen = []
+        done = threading.Event()
+        
+        def write(worker):
+            with app.app_context():
+                for n in range(25):
+                    StudentService.update_student(student_id, f'Name {worker}-{n}', 'student@example.com')
+                    db.session.remove()
+        
+        def read():
+            with app.app_context():
+                while not done.is_set():
+                    seen.append(StudentService.get_student_record(student_id).name)
+                    db.session.remove()
+        
+        writers = [threading.Thread(target=write, args=(worker,)) for worker in range(3)]
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        
+        with app.app_context():
+            current = db.session.execute(db.select(Student.name).where(Student.id == student_id)).scalar()
+            assert StudentService.get_student_record(student_id).name == current
+            assert all(name.startswith('Name ') for name in seen)
+            stats = StudentService.get_cache().stats()
+            assert stats['invalidations'] == 75
+            assert stats['hits'] > 0
+            db.session.remove()
+            db.engine.dispose()